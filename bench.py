@@ -0,0 +1,377 @@
+# bench.py
+# End-to-end throughput benchmark for bot.py: synthetic user sessions are replayed
+# through the real handlers (dispatcher -> telebot -> handlers -> storage) against
+# the local fake Bot API (fake_telegram.py) and a fake OpenAI-compatible vision
+# endpoint, so nothing leaves the machine.
+#
+# Each virtual client runs whole sessions and waits for each update to be handled
+# before sending the next one, so callbacks carry the id of the message the bot
+# actually showed:
+#   /start, 🛒 Магазин, shop_weapon_list_N, prod_open_, prod_nav_, prod_add_ x2,
+#   open_cart, cart_checkout, payment photo
+# Every --admin-every'th session is an admin one instead: check_payment_{id} on
+# an order awaiting check, then 📊 Статистика.
+#
+# Run:
+#   python bench.py                                   - 1k/10k/100k users, JSON storage
+#   python bench.py --users 10000 --storage sqlite --concurrency 32 --out bench.json
+#
+# Output (stdout and --out): one JSON document with a result per dataset size:
+# updates/sec, per-update latency (queue + handling) p50/p95/p99, handler latency
+# per handler, storage bytes written per update, Bot API calls per update.
+# The per-user 3 s cooldown is disabled inside the benchmark and LLM_RPM is raised
+# (--llm-rpm), so the numbers are the bot's own cost rather than the rate limits.
+
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+PRODUCT_TYPES = ("weapon", "armor", "escort")
+
+# ================== DATASET ==================
+
+def generate_dataset(data_dir: str, users: int, products: int, seed: int) -> Dict[str, Any]:
+    # writes config/users/products/orders .json; user 1 is the admin
+    rnd = random.Random(seed)
+    catalog = []
+    for pid in range(1, products + 1):
+        ptype = PRODUCT_TYPES[pid % 3]
+        catalog.append({
+            "id": pid, "type": ptype, "title": f"{ptype.title()} {pid}", "category": f"Категория {pid % 17}",
+            "price": rnd.randint(5, 500),
+            "description": "Уровень 3, полный комплект. " * rnd.randint(1, 12),
+        })
+    user_map = {}
+    for uid in range(1, users + 1):
+        user_map[str(uid)] = {
+            "username": f"user{uid}", "cart": [rnd.randint(1, products) for _ in range(rnd.randint(0, 3))],
+            "is_admin": uid == 1, "awaiting_payment_order_id": None,
+        }
+    orders = []
+    awaiting = []
+    now = int(time.time())
+    for oid in range(1, users // 2 + 1):
+        items = rnd.sample(catalog, 2)
+        status = rnd.choice(("pending_payment", "awaiting_check", "rejected"))
+        order = {
+            "id": oid, "user_id": rnd.randint(2, max(2, users)), "username": "", "items": items,
+            "total": sum(i["price"] for i in items), "status": status, "created_ts": now - rnd.randint(0, 86400 * 30),
+            "payment_photo_file_id": f"photo-seed-{oid}" if status != "pending_payment" else None,
+            "ai_verdict_last": None,
+        }
+        if status == "awaiting_check":
+            order["admins_notified_ts"] = order["created_ts"]  # do not re-run the pre-screen for the seed
+            awaiting.append(oid)
+        orders.append(order)
+    config = {
+        "admin_password": "bench", "payment_phone": "+99360000000", "order_manager_username": "support",
+        "super_admin_ids": [1], "product_id_seq": products,
+    }
+    for name, data in (("config.json", config), ("users.json", user_map),
+                       ("products.json", catalog), ("orders.json", orders)):
+        with open(os.path.join(data_dir, name), "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+    return {
+        "weapons": [p["id"] for p in catalog if p["type"] == "weapon"],
+        "awaiting_check": awaiting,
+    }
+
+# ================== FAKE LLM ==================
+
+VISION_REPLY = (
+    "```bash\nСтатус: оплата подтверждена\nУверенность: высокая\nСовпадение суммы: да\n"
+    "Найденная сумма: 100 TMT\nРекомендация:\n- подтвердить\n```"
+)
+
+def serve_fake_llm(latency_ms: float) -> ThreadingHTTPServer:
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True
+
+        def log_message(self, *args):
+            pass
+
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)) or b"{}")
+            if latency_ms:
+                time.sleep(latency_ms / 1000)
+            data = json.dumps({
+                "id": "bench", "object": "chat.completion", "created": int(time.time()), "model": body.get("model", ""),
+                "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": VISION_REPLY}}],
+                "usage": {"prompt_tokens": 900, "completion_tokens": 60, "total_tokens": 960},
+            }).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+# ================== RUN ONE DATASET ==================
+
+def _pct(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(q * len(values)))] * 1000, 2)
+
+def run_one(args) -> Dict[str, Any]:
+    data_dir = os.getcwd()
+    seed = generate_dataset(data_dir, args.one, args.products, args.seed)
+
+    sys.path.insert(0, REPO_DIR)
+    import fake_telegram
+    fake = fake_telegram.FakeTelegram(latency_ms=args.api_latency)
+    api = fake_telegram.serve(fake, port=0)
+    llm_server = serve_fake_llm(args.llm_latency)
+    os.environ.update({
+        "BOT_TOKEN": "123456:bench", "GROQ_API_KEY": "bench",
+        "TELEGRAM_API_URL": f"http://127.0.0.1:{api.server_port}",
+        "LLM_BASE_URL": f"http://127.0.0.1:{llm_server.server_port}",
+        "STORAGE_BACKEND": args.storage, "BOT_WORKERS": str(args.workers),
+        "LLM_RPM": str(args.llm_rpm),
+    })
+
+    import bot as B
+    from telebot import types
+
+    if args.storage == "sqlite":
+        B.migrate_json_to_sqlite()
+    B.ensure_files()
+    B.COOLDOWN_SECONDS = 0
+    B.LATENCY_SAMPLES = 10 ** 7
+
+    # ---------- storage I/O accounting ----------
+    io = {"bytes": 0, "writes": 0}
+    io_lock = threading.Lock()
+
+    def count_io(n: int):
+        with io_lock:
+            io["bytes"] += n
+            io["writes"] += 1
+
+    def wrap(name, size):
+        orig = getattr(B, name)
+
+        def wrapper(*a, **kw):
+            count_io(size(*a, **kw))
+            return orig(*a, **kw)
+        setattr(B, name, wrapper)
+
+    wrap("atomic_write_text", lambda path, text, **_: len(text.encode("utf-8")))
+    wrap("_journal_append", lambda path, records: len(json.dumps(records, ensure_ascii=False).encode("utf-8")) + 1)
+    wrap("jsonl_append_log", lambda rec: len(json.dumps(rec, ensure_ascii=False).encode("utf-8")) + 1)
+    wrap("sql_append_log", lambda rec: len(json.dumps(rec, ensure_ascii=False).encode("utf-8")))
+    wrap("_sql_write", lambda table, upserts, deletes, base=None:
+         sum(len(str(v).encode("utf-8")) for row in upserts for v in row) + 8 * len(deletes))
+
+    # ---------- completion tracking ----------
+    done: Dict[int, threading.Event] = {}
+    process = B._process_one_update
+
+    def tracked(update):
+        try:
+            process(update)
+        finally:
+            ev = done.pop(update.update_id, None)
+            if ev is not None:
+                ev.set()
+
+    B._process_one_update = tracked
+    B.start_dispatcher(args.workers, max_pending=10 ** 6)
+
+    ids = iter(range(1, 10 ** 9))
+    ids_lock = threading.Lock()
+    latencies: List[float] = []
+    rnd = random.Random(args.seed)
+
+    def send(update_dict: Dict[str, Any]):
+        with ids_lock:
+            update_dict["update_id"] = next(ids)
+        u = types.Update.de_json(update_dict)
+        ev = done[u.update_id] = threading.Event()
+        t0 = time.perf_counter()
+        B.dispatcher.submit(B.update_key(u), u)
+        ev.wait(60)
+        latencies.append(time.perf_counter() - t0)
+
+    def user(uid):
+        return {"id": uid, "is_bot": False, "first_name": f"u{uid}", "username": f"user{uid}"}
+
+    def message(uid, text=None, photo=None):
+        m = {"message_id": rnd.randint(1, 10 ** 9), "date": int(time.time()), "chat": {"id": uid, "type": "private"}, "from": user(uid)}
+        if photo:
+            m["photo"] = [{"file_id": photo, "file_unique_id": "u" + photo, "width": 800, "height": 1600}]
+        else:
+            m["text"] = text
+            if text.startswith("/"):
+                m["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text)}]
+        send({"message": m})
+
+    def callback(uid, data):
+        shown = B.last_clean_message.get(uid)
+        mid = shown.get("id") if isinstance(shown, dict) else (shown or 1)
+        send({"callback_query": {
+            "id": str(rnd.getrandbits(40)), "chat_instance": str(uid), "from": user(uid), "data": data,
+            "message": {"message_id": mid, "date": int(time.time()), "chat": {"id": uid, "type": "private"}, "text": "…"},
+        }})
+
+    weapons = seed["weapons"]
+    pages = max(1, len(weapons) // 6)
+
+    def user_session(uid: int, r: random.Random):
+        message(uid, "/start")
+        message(uid, "🛒 Магазин")
+        for page in range(r.randint(1, 3)):
+            callback(uid, f"shop_weapon_list_{min(page, pages - 1)}")
+        idx = r.randrange(len(weapons))
+        callback(uid, f"prod_open_weapon_{weapons[idx]}")
+        callback(uid, f"prod_nav_weapon_{min(idx + 1, len(weapons) - 1)}")
+        callback(uid, f"prod_add_{weapons[idx]}")
+        callback(uid, f"prod_add_{r.choice(weapons)}")
+        callback(uid, "open_cart")
+        callback(uid, "cart_checkout")
+        message(uid, photo=f"pay-{uid}-{r.getrandbits(32)}")
+
+    def admin_session(r: random.Random):
+        if seed["awaiting_check"]:
+            callback(1, f"check_payment_{r.choice(seed['awaiting_check'])}")
+        message(1, "📊 Статистика")
+
+    next_session = iter(range(10 ** 9))
+
+    def client(total: int, seed_offset: int):
+        r = random.Random(args.seed * 1000 + seed_offset)
+        while True:
+            with ids_lock:
+                n = next(next_session)
+            if n >= total:
+                return
+            if args.admin_every and n % args.admin_every == args.admin_every - 1:
+                admin_session(r)
+            else:
+                user_session(r.randint(2, args.one), r)
+
+    def run_sessions(total: int):
+        threads = [threading.Thread(target=client, args=(total, i), daemon=True) for i in range(args.concurrency)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        B.dispatcher.drain(60)
+
+    # warm-up: caches, connections, first-write paths; not measured
+    run_sessions(args.warmup)
+    B.flush_pending_writes()
+    B.handler_latency.clear()
+    B.handler_calls.clear()
+    latencies.clear()
+    io.update(bytes=0, writes=0)
+    api_before = dict(fake.stats()["calls"])
+    next_session = iter(range(10 ** 9))
+
+    t0 = time.perf_counter()
+    run_sessions(args.sessions)
+    B.flush_pending_writes()  # write-behind saves are part of the cost
+    wall = time.perf_counter() - t0
+
+    updates = len(latencies)
+    api_calls = {k: v - api_before.get(k, 0) for k, v in fake.stats()["calls"].items() if v - api_before.get(k, 0)}
+    handlers = {}
+    for name, samples in B.handler_latency.items():
+        vals = list(samples)
+        handlers[name] = {"calls": len(vals), "p50_ms": _pct(vals, 0.5), "p95_ms": _pct(vals, 0.95), "p99_ms": _pct(vals, 0.99)}
+    return {
+        "users": args.one,
+        "products": args.products,
+        "storage": args.storage,
+        "concurrency": args.concurrency,
+        "workers": args.workers,
+        "sessions": args.sessions,
+        "updates": updates,
+        "seconds": round(wall, 3),
+        "updates_per_sec": round(updates / wall, 1) if wall else 0.0,
+        "latency_ms": {"p50": _pct(latencies, 0.5), "p95": _pct(latencies, 0.95), "p99": _pct(latencies, 0.99)},
+        "handlers": handlers,
+        "storage_bytes_per_update": round(io["bytes"] / updates, 1) if updates else 0.0,
+        "storage_writes_per_update": round(io["writes"] / updates, 3) if updates else 0.0,
+        "api_calls_per_update": round(sum(api_calls.values()) / updates, 3) if updates else 0.0,
+        "api_calls": api_calls,
+    }
+
+# ================== MAIN ==================
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR,
+                              capture_output=True, text=True, timeout=10).stdout.strip()
+    except Exception:
+        return ""
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="End-to-end throughput benchmark for bot.py")
+    ap.add_argument("--users", default="1000,10000,100000", help="dataset sizes, comma separated")
+    ap.add_argument("--products", type=int, default=3000)
+    ap.add_argument("--storage", choices=("json", "sqlite"), default="json")
+    ap.add_argument("--sessions", type=int, default=200, help="measured sessions per dataset")
+    ap.add_argument("--warmup", type=int, default=20)
+    ap.add_argument("--concurrency", type=int, default=16, help="virtual clients running sessions at once")
+    ap.add_argument("--workers", type=int, default=8, help="BOT_WORKERS")
+    ap.add_argument("--admin-every", type=int, default=10, help="every Nth session is an admin check (0 = none)")
+    ap.add_argument("--api-latency", type=float, default=0, help="fake Bot API latency, ms")
+    ap.add_argument("--llm-latency", type=float, default=0, help="fake vision model latency, ms")
+    ap.add_argument("--llm-rpm", type=float, default=6000, help="LLM_RPM for the run (production default is 30)")
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--out", default=None, help="also write the JSON result here")
+    ap.add_argument("--one", type=int, default=None, help=argparse.SUPPRESS)  # internal: run one dataset here
+    args = ap.parse_args()
+
+    if args.one is not None:
+        print(json.dumps(run_one(args), ensure_ascii=False))
+        sys.exit(0)
+
+    runs = []
+    for size in [int(s) for s in args.users.split(",") if s.strip()]:
+        # a fresh process and data dir per dataset: bot.py keeps module-level state
+        with tempfile.TemporaryDirectory(prefix=f"bench-{size}-") as data_dir:
+            argv = list(sys.argv[1:])
+            if "--out" in argv:
+                i = argv.index("--out")
+                del argv[i:i + 2]
+            argv = [a for a in argv if not a.startswith("--out=")]
+            cmd = [sys.executable, os.path.abspath(__file__), "--one", str(size)] + argv
+            proc = subprocess.run(cmd, cwd=data_dir, capture_output=True, text=True)
+            if proc.returncode != 0:
+                print(proc.stdout + proc.stderr, file=sys.stderr)
+                sys.exit(proc.returncode)
+            runs.append(json.loads(proc.stdout.strip().splitlines()[-1]))
+            r = runs[-1]
+            print(f"{size} users: {r['updates_per_sec']} upd/s, p95 {r['latency_ms']['p95']} ms, "
+                  f"{r['storage_bytes_per_update']} B written/update", file=sys.stderr)
+
+    result = {
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "timestamp": int(time.time()),
+        "runs": runs,
+    }
+    text = json.dumps(result, ensure_ascii=False, indent=2)
+    print(text)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
@@ -1,26 +1,66 @@
 # bot.py
 # Deluxe Metro Shop – Telegram bot for Metro Royal (PUBG Mobile)
 # Requirements:
-#   pip install pyTelegramBotAPI groq
+#   pip install pyTelegramBotAPI groq aiohttp   (aiohttp only for --async)
 #
 # ENV:
 #   set BOT_TOKEN=...
 #   set GROQ_API_KEY=...
+#   set STORAGE_BACKEND=sqlite   (optional; migrate once with: python bot.py --migrate-sqlite)
+#   set BOT_WORKERS=8            (optional; parallel update workers)
+#   set STATE_BACKEND=sqlite     (optional; keep dialog states across restarts/processes)
+#   set TELEGRAM_API_URL=http://127.0.0.1:8081   (optional; e.g. python fake_telegram.py)
+#   set LLM_BASE_URL=http://127.0.0.1:8080   (optional; OpenAI-compatible server, serves /openai/v1/...)
+#   set LLM_FALLBACKS=model=fallback1,fallback2;other=...   (optional; see LLM GATEWAY)
+#
+# Run:
+#   python bot.py           - threaded polling
+#   python bot.py --async   - asyncio runtime (AsyncTeleBot + AsyncGroq)
+#   python bot.py --webhook - built-in HTTP endpoint instead of polling
+#                             (WEBHOOK_URL, WEBHOOK_SECRET, WEBHOOK_PORT, WEBHOOK_PATH)
+#   python bot.py --cluster 4 [--webhook]
+#                           - 4 worker processes behind one ingress; needs
+#                             STORAGE_BACKEND=sqlite and STATE_BACKEND=sqlite
 #
 # Vision model:
 #   meta-llama/llama-4-scout-17b-16e-instruct
 
 import telebot
 from telebot import types
+from telebot.apihelper import ApiTelegramException
+import asyncio
+import csv
+import functools
+import io
+import itertools
 import json
 import os
+import pickle
 import sys
 import time
 import hashlib
+import hmac
+import random
+import secrets
 import traceback
 import re
+import atexit
+import shutil
+import signal
+import socket
+import sqlite3
+import subprocess
+import tempfile
+import threading
+from collections import OrderedDict, deque
+from collections.abc import Sequence
+from concurrent.futures import ThreadPoolExecutor
+from socketserver import ThreadingMixIn
+from types import MappingProxyType
 from typing import Any, Dict, List, Optional, Tuple
-from groq import Groq
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer, make_server
+import requests
+from groq import APIConnectionError, Groq
 
 # ================== НАСТРОЙКИ ==================
 
@@ -32,91 +72,1007 @@ if not TOKEN:
 if not GROQ_API_KEY:
     raise RuntimeError("GROQ_API_KEY is not set. Please export GROQ_API_KEY env var.")
 
-bot = telebot.TeleBot(TOKEN, parse_mode="HTML")
-groq_client = Groq(api_key=GROQ_API_KEY)
+# another Bot API server, e.g. a local fake_telegram.py for tests and benchmarks
+TELEGRAM_API_URL = os.environ.get("TELEGRAM_API_URL", "https://api.telegram.org").strip().rstrip("/")
+if TELEGRAM_API_URL != "https://api.telegram.org":
+    telebot.apihelper.API_URL = TELEGRAM_API_URL + "/bot{0}/{1}"
+    telebot.apihelper.FILE_URL = TELEGRAM_API_URL + "/file/bot{0}/{1}"
+
+# threaded=False: updates are fanned out by our own dispatcher (see DISPATCHER)
+bot = telebot.TeleBot(TOKEN, parse_mode="HTML", threaded=False)
+# LLM_BASE_URL points the Groq clients at any OpenAI-compatible server (e.g. a local fake);
+# retries are ours (see LLM GATEWAY), so the SDK's own retry loop is off
+LLM_BASE_URL = os.environ.get("LLM_BASE_URL", "").strip() or None
+LLM_TIMEOUT = float(os.environ.get("LLM_TIMEOUT", "45"))
+groq_client = Groq(api_key=GROQ_API_KEY, base_url=LLM_BASE_URL, timeout=LLM_TIMEOUT, max_retries=0)
 
 DATA_DIR = "."
 CONFIG_FILE = os.path.join(DATA_DIR, "config.json")
 PRODUCTS_FILE = os.path.join(DATA_DIR, "products.json")
 USERS_FILE = os.path.join(DATA_DIR, "users.json")
 ORDERS_FILE = os.path.join(DATA_DIR, "orders.json")
-LOGS_FILE = os.path.join(DATA_DIR, "logs.json")
+LOGS_FILE = os.path.join(DATA_DIR, "logs.json")  # legacy; imported once into LOGS_DIR
 AI_MEMORY_FILE = os.path.join(DATA_DIR, "ai_memory.json")
+BROADCASTS_FILE = os.path.join(DATA_DIR, "broadcasts.json")
+SQLITE_FILE = os.path.join(DATA_DIR, "shop.db")
+
+# "json" (default) keeps the *.json files; "sqlite" stores users/products/orders/logs,
+# config and broadcasts in SQLITE_FILE
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "json").strip().lower()
 
 COOLDOWN_SECONDS = 3
 PAGINATION_PAGE_SIZE = 6
 DESCRIPTION_PREVIEW_LEN = 160
 
-last_clean_message: Dict[int, int] = {}
-last_activity: Dict[int, float] = {}
-states: Dict[int, Dict[str, Any]] = {}  # unified state machine
+# ================== JSON HELPERS ==================
 
-pending_ai_actions: Dict[str, Dict[str, Any]] = {}
+DEFAULT_CONFIG = {
+    "admin_password": "1234",
+    "payment_phone": "TMT_PHONE",
+    "order_manager_username": "order_manager_username",  # support username
+    "super_admin_ids": [],
+    "restart_script_path": "c:/Users/Admin/Desktop/magazin/bot.py"
+}
 
-# ================== JSON HELPERS ==================
+def read_json_file(path, default):
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except Exception:
+        return default
 
 def ensure_files():
-    if not os.path.exists(CONFIG_FILE):
+    if STORAGE_BACKEND == "sqlite":
+        sql_conn()
+        # the first start on SQLite takes over config.json / broadcasts.json
+        for path, default in [(CONFIG_FILE, DEFAULT_CONFIG), (BROADCASTS_FILE, {})]:
+            table = _sql_table(path)
+            if not sql_load(table):
+                data = read_json_file(path, default)
+                if isinstance(data, dict) and data:
+                    sql_upsert(table, list(data.items()))
+    elif not os.path.exists(CONFIG_FILE):
         with open(CONFIG_FILE, "w", encoding="utf-8") as f:
-            json.dump({
-                "admin_password": "1234",
-                "payment_phone": "TMT_PHONE",
-                "order_manager_username": "order_manager_username",  # support username
-                "super_admin_ids": [],
-                "restart_script_path": "c:/Users/Admin/Desktop/magazin/bot.py"
-            }, f, ensure_ascii=False, indent=2)
+            json.dump(DEFAULT_CONFIG, f, ensure_ascii=False, indent=2)
 
     for path, default in [
         (PRODUCTS_FILE, []),
         (USERS_FILE, {}),
         (ORDERS_FILE, []),
-        (LOGS_FILE, []),
         (AI_MEMORY_FILE, {})
     ]:
+        if _sql_table(path):
+            continue
         if not os.path.exists(path):
             with open(path, "w", encoding="utf-8") as f:
                 json.dump(default, f, ensure_ascii=False, indent=2)
 
-def load_json(path, default):
+def _file_sig(path) -> Optional[Tuple[int, int, int]]:
     try:
-        with open(path, "r", encoding="utf-8") as f:
-            return json.load(f)
-    except Exception:
-        return default
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+# users.json and orders.json are journaled: put_users / order writes append the
+# touched records to <file>.journal (one JSON line per write: {id: user} for
+# users, [order, ...] for orders) instead of rewriting the whole file on every
+# cart click or status change. Loading replays the journal; after
+# USERS_JOURNAL_MAX / ORDERS_JOURNAL_MAX lines the file is rewritten once and
+# the journal emptied.
+USERS_JOURNAL_MAX = int(os.environ.get("USERS_JOURNAL_MAX", "1000"))
+ORDERS_JOURNAL_MAX = int(os.environ.get("ORDERS_JOURNAL_MAX", "1000"))
+JOURNALED_FILES = {USERS_FILE, ORDERS_FILE}
+_journal_lines: Dict[str, int] = {}
+
+def _journal_path(path) -> str:
+    return f"{path}.journal"
+
+def _store_sig(path):
+    sig = _file_sig(path)
+    if sig is not None and path in JOURNALED_FILES:
+        return sig + (_file_sig(_journal_path(path)),)
+    return sig
+
+def _replay_journal(path, data) -> int:
+    # applies path.journal to `data` in place -> lines applied. Dict stores merge
+    # each line; list stores (orders) replace records by "id" or append new ones
+    jpath = _journal_path(path)
+    applied = good = 0
+    positions = None
+    try:
+        with open(jpath, "rb") as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break  # torn by a crash mid-append
+                good += len(line)
+                try:
+                    records = json.loads(line)
+                except ValueError:
+                    continue
+                if isinstance(data, dict):
+                    data.update(records)
+                else:
+                    if positions is None:
+                        positions = {o.get("id"): i for i, o in enumerate(data) if isinstance(o, dict)}
+                    for o in records:
+                        pos = positions.get(o.get("id"))
+                        if pos is None:
+                            positions[o.get("id")] = len(data)
+                            data.append(o)
+                        else:
+                            data[pos] = o
+                applied += 1
+    except FileNotFoundError:
+        return 0
+    if good != os.path.getsize(jpath):
+        os.truncate(jpath, good)
+    return applied
+
+def _journal_append(path, records):
+    with open(_journal_path(path), "a", encoding="utf-8") as f:
+        f.write(json.dumps(records, ensure_ascii=False) + "\n")
+        f.flush()
+        if JSON_FSYNC:
+            os.fsync(f.fileno())
+
+def _write_journaled(path, data):
+    # caller holds store_lock(path): full rewrite, then an empty journal (replaying
+    # a journal that is already in the file is harmless, so a crash in between is fine)
+    atomic_write_text(path, json.dumps(data, ensure_ascii=False, indent=2))
+    with open(_journal_path(path), "w", encoding="utf-8"):
+        pass
+    _journal_lines[path] = 0
+    _json_cache[path] = {"sig": _store_sig(path), "data": data, "view": _make_view(data)}
+
+# Parsed stores, shared between handlers. A JSON entry is reloaded only when the
+# file's (mtime, size, inode) signature changes, i.e. when someone edited it by hand;
+# an SQLite entry when the table version in `meta` changes.
+# entry = {"sig": ..., "data": parsed, "view": read-only view,
+#          "dirty": True while a write-behind save is still pending}
+_json_cache: Dict[str, Dict[str, Any]] = {}
+_json_cache_lock = threading.RLock()
+_store_locks: Dict[str, threading.RLock] = {}
+
+def store_lock(path) -> threading.RLock:
+    # hold around a get_* -> mutate -> save_* cycle so concurrent handlers don't lose updates.
+    # Code holding several takes them in one order: orders, products, config, users
+    # (a read of a store may take its lock too, on a cache miss)
+    lock = _store_locks.get(path)
+    if lock is None:
+        with _json_cache_lock:
+            lock = _store_locks.setdefault(path, threading.RLock())
+    return lock
+
+def _make_view(data):
+    if isinstance(data, dict):
+        return MappingProxyType(data)
+    if isinstance(data, list):
+        return tuple(data)
+    return data
+
+def _cache_entry(path, default) -> Dict[str, Any]:
+    entry = _json_cache.get(path)
+    if entry is not None and entry.get("dirty"):
+        return entry
+    table = _sql_table(path)
+    sig = sql_version(table) if table else _store_sig(path)
+    if entry is not None and sig is not None and entry["sig"] == sig:
+        return entry
+    with store_lock(path):
+        entry = _json_cache.get(path)
+        # writers may have moved on while we waited for the lock; the sig from before is stale
+        sig = sql_version(table) if table else _store_sig(path)
+        if entry is not None and (entry.get("dirty") or (sig is not None and entry["sig"] == sig)):
+            return entry
+        if table:
+            data = sql_load(table)
+            entry = {"sig": sig, "data": data, "view": _make_view(data)}
+            _json_cache[path] = entry
+            return entry
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except Exception:
+            data = _restore_snapshot(path)
+            if data is None:
+                # do not cache failures: the next call retries the file. Readers get
+                # the default, but an unreadable file must never be written over
+                return {"sig": None, "data": default, "view": _make_view(default),
+                        "unreadable": os.path.exists(path)}
+        if path in JOURNALED_FILES and isinstance(data, (dict, list)):
+            _journal_lines[path] = _replay_journal(path, data)
+        entry = {"sig": sig, "data": data, "view": _make_view(data)}
+        _json_cache[path] = entry
+        return entry
+
+class StoreUnreadable(Exception):
+    pass
+
+def _writable_entry(path, default) -> Dict[str, Any]:
+    # the cache entry a write builds on; refuses a store whose file exists but
+    # cannot be parsed (and has no snapshot), instead of replacing it with the default
+    entry = _cache_entry(path, default)
+    if entry.get("unreadable"):
+        raise StoreUnreadable(f"{path} is unreadable; fix or restore it before writing")
+    return entry
+
+def load_json(path, default):
+    # private, mutable copy for read-modify-write callers: a deep copy of the cached
+    # data (pickle round trip, C speed) instead of parsing the file again
+    return pickle.loads(pickle.dumps(_cache_entry(path, default)["data"], pickle.HIGHEST_PROTOCOL))
+
+def load_json_view(path, default):
+    # shared read-only view (MappingProxyType / tuple); nested records must not be mutated
+    return _cache_entry(path, default)["view"]
 
 def save_json(path, data):
-    with open(path, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+    table = _sql_table(path)
+    with store_lock(path):
+        if table:
+            entry = _cache_entry(path, data)
+            ver = sql_save_diff(table, entry["data"], data, entry["sig"])
+            _json_cache[path] = {"sig": ver, "data": data, "view": _make_view(data)}
+            return
+        _writable_entry(path, data)
+        # write-through: the saved object becomes the cached one
+        if path in JOURNALED_FILES:
+            _write_journaled(path, data)
+            return
+        if JSON_WRITE_DELAY > 0 and path not in JSON_SYNC_FILES:
+            _json_cache[path] = {"sig": None, "data": data, "view": _make_view(data), "dirty": True}
+            _schedule_write(path, data)
+            return
+        text = json.dumps(data, ensure_ascii=False, indent=2)
+        atomic_write_text(path, text)
+        _json_cache[path] = {"sig": _file_sig(path), "data": data, "view": _make_view(data)}
+
+# ================== CRASH-SAFE WRITES ==================
+# Files are replaced atomically (temp file + fsync + rename), so a crash or
+# restart_self() mid-save leaves either the old or the new version, never a
+# truncated one. Saves are synchronous by default. JSON_WRITE_DELAY > 0 opts in
+# to write-behind: the write happens on a background thread that coalesces
+# bursts and handlers only update the in-memory cache, so a crash can lose the
+# last JSON_WRITE_DELAY seconds of saves. Orders, config (order/payment state,
+# id sequences) and broadcasts (the cancel flag) are always written before
+# save_json returns.
+
+JSON_WRITE_DELAY = float(os.environ.get("JSON_WRITE_DELAY", "0"))
+JSON_SYNC_FILES = {ORDERS_FILE, CONFIG_FILE, BROADCASTS_FILE}
+JSON_FSYNC = os.environ.get("JSON_FSYNC", "1").strip() != "0"
+BACKUP_DIR = os.path.join(DATA_DIR, "backups")
+JSON_SNAPSHOT_INTERVAL = int(os.environ.get("JSON_SNAPSHOT_INTERVAL", "0"))  # seconds, 0 = off
+JSON_SNAPSHOT_KEEP = 24
+
+_write_pending: Dict[str, Any] = {}
+_write_cond = threading.Condition()
+_write_busy = False
+_writer_thread: Optional[threading.Thread] = None
+_last_snapshot: Dict[str, float] = {}
+
+def atomic_write_text(path, text: str, snapshot: bool = True):
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(text)
+        f.flush()
+        if JSON_FSYNC:
+            os.fsync(f.fileno())
+    if snapshot:
+        _take_snapshot(path)
+    os.replace(tmp, path)
+    if JSON_FSYNC and os.name == "posix":
+        fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+def _snapshot_files(path) -> List[str]:
+    prefix = os.path.basename(path) + "."
+    try:
+        names = [n for n in os.listdir(BACKUP_DIR) if n.startswith(prefix)]
+    except OSError:
+        return []
+    return [os.path.join(BACKUP_DIR, n) for n in sorted(names)]
+
+def _take_snapshot(path):
+    if JSON_SNAPSHOT_INTERVAL <= 0 or not os.path.exists(path):
+        return
+    t = time.time()
+    if t - _last_snapshot.get(path, 0) < JSON_SNAPSHOT_INTERVAL:
+        return
+    _last_snapshot[path] = t
+    os.makedirs(BACKUP_DIR, exist_ok=True)
+    shutil.copy2(path, os.path.join(BACKUP_DIR, os.path.basename(path) + time.strftime(".%Y%m%d-%H%M%S", time.localtime(t))))
+    for old in _snapshot_files(path)[:-JSON_SNAPSHOT_KEEP]:
+        try:
+            os.remove(old)
+        except OSError:
+            pass
+
+def _restore_snapshot(path):
+    # newest readable snapshot of a corrupted store, or None
+    if not os.path.exists(path):
+        return None
+    for snap in reversed(_snapshot_files(path)):
+        try:
+            with open(snap, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except Exception:
+            continue
+    return None
+
+def _schedule_write(path, data):
+    global _writer_thread
+    with _write_cond:
+        _write_pending[path] = data
+        if _writer_thread is None:
+            _writer_thread = threading.Thread(target=_writer_loop, name="json-writer", daemon=True)
+            _writer_thread.start()
+        _write_cond.notify_all()
+
+def _write_store_file(path, data):
+    text = json.dumps(data, ensure_ascii=False, indent=2)
+    atomic_write_text(path, text)
+    with store_lock(path):
+        entry = _json_cache.get(path)
+        with _write_cond:
+            superseded = path in _write_pending
+        if entry is not None and entry["data"] is data and not superseded:
+            _json_cache[path] = {**entry, "sig": _file_sig(path), "dirty": False}
+
+def _writer_loop():
+    global _write_busy
+    while True:
+        with _write_cond:
+            while not _write_pending:
+                _write_cond.wait()
+            _write_busy = True
+        time.sleep(JSON_WRITE_DELAY)  # let a burst of saves collapse into one write
+        with _write_cond:
+            batch = dict(_write_pending)
+            _write_pending.clear()
+        for path, data in batch.items():
+            try:
+                _write_store_file(path, data)
+            except Exception as e:
+                log_error("json_writer", e, extra={"path": path})
+                with _write_cond:
+                    _write_pending.setdefault(path, data)
+                time.sleep(1)
+        with _write_cond:
+            _write_busy = False
+            _write_cond.notify_all()
+
+def flush_pending_writes(timeout: float = 10.0) -> bool:
+    with _write_cond:
+        return _write_cond.wait_for(lambda: not _write_pending and not _write_busy, timeout)
+
+atexit.register(flush_pending_writes)
 
 def get_config():
     return load_json(CONFIG_FILE, {})
 
+def config_view():
+    return load_json_view(CONFIG_FILE, {})
+
 def save_config(cfg):
     save_json(CONFIG_FILE, cfg)
 
 def get_products():
     return load_json(PRODUCTS_FILE, [])
 
+def products_view():
+    return load_json_view(PRODUCTS_FILE, [])
+
 def save_products(products):
     save_json(PRODUCTS_FILE, products)
+    invalidate_catalog_cache()
 
 def get_users():
     return load_json(USERS_FILE, {})
 
+def users_view():
+    return load_json_view(USERS_FILE, {})
+
 def save_users(users):
     save_json(USERS_FILE, users)
 
 def get_orders():
     return load_json(ORDERS_FILE, [])
 
+def orders_view():
+    return load_json_view(ORDERS_FILE, [])
+
 def save_orders(orders):
     save_json(ORDERS_FILE, orders)
 
 def get_logs():
-    return load_json(LOGS_FILE, [])
+    if STORAGE_BACKEND == "sqlite":
+        return sql_query_logs()
+    return jsonl_query_logs()
 
 def save_logs(logs):
-    save_json(LOGS_FILE, logs)
+    if STORAGE_BACKEND == "sqlite":
+        sql_replace_logs(logs)
+        return
+    jsonl_replace_logs(logs)
+
+def new_user_record(username: Optional[str] = "") -> Dict[str, Any]:
+    return {"username": username or "", "cart": [], "is_admin": False, "awaiting_payment_order_id": None}
+
+def put_user(user_id, record: Dict[str, Any]):
+    put_users({user_id: record})
+
+def put_users(records: Dict[Any, Dict[str, Any]]):
+    # writes only the touched records (an SQLite row / a journal line each). Existing
+    # records are replaced in place: the dict keeps its size, so readers iterating a
+    # view are safe. A new user copies the dict and gets a new view instead.
+    changed = {str(k): r for k, r in records.items()}
+    with store_lock(USERS_FILE):
+        entry = _writable_entry(USERS_FILE, {})
+        users = entry["data"]
+        if STORAGE_BACKEND == "sqlite":
+            sig = sql_upsert("users", list(changed.items()), entry["sig"])
+        else:
+            _journal_append(USERS_FILE, changed)
+            _journal_lines[USERS_FILE] = _journal_lines.get(USERS_FILE, 0) + 1
+            sig = _store_sig(USERS_FILE)
+        users = _cache_users(entry, changed, sig)
+        if STORAGE_BACKEND != "sqlite" and _journal_lines[USERS_FILE] >= USERS_JOURNAL_MAX:
+            _write_journaled(USERS_FILE, users)
+
+def _cache_users(entry: Dict[str, Any], changed: Dict[str, Dict[str, Any]], sig) -> Dict[str, Any]:
+    # caller holds store_lock(USERS_FILE) and has written `changed`
+    users = entry["data"]
+    view = entry["view"]
+    if not all(k in users for k in changed):
+        users = dict(users)
+        view = _make_view(users)
+    users.update(changed)
+    _json_cache[USERS_FILE] = {"sig": sig, "data": users, "view": view}
+    return users
+
+def update_config(fields: Dict[str, Any]):
+    with store_lock(CONFIG_FILE):
+        cfg = get_config()
+        cfg.update(fields)
+        save_config(cfg)
+
+def add_product(fields: Dict[str, Any]) -> int:
+    with store_lock(PRODUCTS_FILE):
+        products = get_products()
+        pid = generate_product_id()
+        products.append({"id": pid, **fields})
+        save_products(products)
+    return pid
+
+def update_product(pid: int, fields: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    with store_lock(PRODUCTS_FILE):
+        products = get_products()
+        p = next((x for x in products if x.get("id") == pid), None)
+        if not p:
+            return None
+        p.update(fields)
+        save_products(products)
+    return p
+
+def remove_product(pid: int) -> bool:
+    with store_lock(PRODUCTS_FILE):
+        products = get_products()
+        kept = [x for x in products if x.get("id") != pid]
+        if len(kept) == len(products):
+            return False
+        save_products(kept)
+    return True
+
+# ================== ORDER STORE ==================
+# Orders are only appended or replaced in place, so the index keeps list
+# positions: id -> position, user_id -> ids, status -> ids, payment photo
+# (file_unique_id) -> ids. Our own writes derive a new view and index
+# copy-on-write and publish them together, so a reader always gets an index
+# built for the view it holds. Both are split into chunks / shards that the
+# copy shares, so one order update costs O(n / chunks), not O(n).
+# Ids come from a persistent sequence (order_id_seq in config.json).
+
+ORDER_VIEW_CHUNK = 1024
+
+class ChunkedView(Sequence):
+    # read-only list of orders kept in ORDER_VIEW_CHUNK-sized tuples; replace()
+    # and append() return a new view sharing every chunk but the one they touch
+    __slots__ = ("_chunks", "_len")
+
+    def __init__(self, items=()):
+        items = tuple(items)
+        self._chunks = tuple(items[i:i + ORDER_VIEW_CHUNK] for i in range(0, len(items), ORDER_VIEW_CHUNK))
+        self._len = len(items)
+
+    @classmethod
+    def _of(cls, chunks, length) -> "ChunkedView":
+        new = cls.__new__(cls)
+        new._chunks = chunks
+        new._len = length
+        return new
+
+    def __len__(self) -> int:
+        return self._len
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return tuple(self)[i]
+        if i < 0:
+            i += self._len
+        if not 0 <= i < self._len:
+            raise IndexError(i)
+        return self._chunks[i // ORDER_VIEW_CHUNK][i % ORDER_VIEW_CHUNK]
+
+    def __iter__(self):
+        for chunk in self._chunks:
+            yield from chunk
+
+    def replace(self, pos: int, item) -> "ChunkedView":
+        chunks = list(self._chunks)
+        c, i = divmod(pos, ORDER_VIEW_CHUNK)
+        chunks[c] = chunks[c][:i] + (item,) + chunks[c][i + 1:]
+        return self._of(tuple(chunks), self._len)
+
+    def append(self, item) -> "ChunkedView":
+        chunks = list(self._chunks)
+        if chunks and len(chunks[-1]) < ORDER_VIEW_CHUNK:
+            chunks[-1] = chunks[-1] + (item,)
+        else:
+            chunks.append((item,))
+        return self._of(tuple(chunks), self._len + 1)
+
+class ShardedMap:
+    # dict split into SHARDS sub-dicts; copy() shares them all and a write copies
+    # only the shard it touches. A published map is never written again.
+    SHARDS = 64
+    __slots__ = ("_shards", "_owned", "_len")
+
+    def __init__(self):
+        self._shards = [{} for _ in range(self.SHARDS)]
+        self._owned = [True] * self.SHARDS
+        self._len = 0
+
+    def copy(self) -> "ShardedMap":
+        new = ShardedMap.__new__(ShardedMap)
+        new._shards = list(self._shards)
+        new._owned = [False] * self.SHARDS
+        new._len = self._len
+        return new
+
+    def _shard(self, key) -> Dict[Any, Any]:
+        return self._shards[hash(key) % self.SHARDS]
+
+    def _writable(self, key) -> Dict[Any, Any]:
+        i = hash(key) % self.SHARDS
+        if not self._owned[i]:
+            self._shards[i] = dict(self._shards[i])
+            self._owned[i] = True
+        return self._shards[i]
+
+    def get(self, key, default=None):
+        return self._shard(key).get(key, default)
+
+    def __getitem__(self, key):
+        return self._shard(key)[key]
+
+    def __contains__(self, key) -> bool:
+        return key in self._shard(key)
+
+    def __len__(self) -> int:
+        return self._len
+
+    def __iter__(self):
+        for shard in self._shards:
+            yield from shard
+
+    def items(self):
+        for shard in self._shards:
+            yield from shard.items()
+
+    def set(self, key, value):
+        shard = self._writable(key)
+        if key not in shard:
+            self._len += 1
+        shard[key] = value
+
+    def pop(self, key, default=None):
+        if key not in self._shard(key):
+            return default
+        self._len -= 1
+        return self._writable(key).pop(key)
+
+class OrderIndex:
+    def __init__(self, orders):
+        self.by_id = ShardedMap()     # id -> position
+        self.by_user = ShardedMap()   # user_id -> ShardedMap(id -> None)
+        self.by_status = ShardedMap()
+        self.by_photo = ShardedMap()
+        self.max_id = 0
+        self._owned: Optional[set] = None  # (table, key) buckets private to a copy; None = all
+        for i, o in enumerate(orders):
+            if isinstance(o, dict):
+                self.add(i, o)
+
+    def copy(self) -> "OrderIndex":
+        # tables and buckets stay shared with self until a write copies a shard
+        new = OrderIndex(())
+        new.by_id = self.by_id.copy()
+        new.by_user = self.by_user.copy()
+        new.by_status = self.by_status.copy()
+        new.by_photo = self.by_photo.copy()
+        new.max_id = self.max_id
+        new._owned = set()
+        return new
+
+    def ids(self, name: str, key) -> List[int]:
+        # ids in a user / status / photo bucket, oldest first
+        return sorted(getattr(self, name).get(key) or ())
+
+    def _bucket(self, name: str, key) -> ShardedMap:
+        table = getattr(self, name)
+        bucket = table.get(key)
+        if bucket is not None and (self._owned is None or (name, key) in self._owned):
+            return bucket
+        bucket = bucket.copy() if bucket is not None else ShardedMap()
+        table.set(key, bucket)
+        if self._owned is not None:
+            self._owned.add((name, key))
+        return bucket
+
+    def _drop(self, name: str, key, oid):
+        if key in getattr(self, name):
+            self._bucket(name, key).pop(oid)
+
+    def add(self, pos: int, o: Dict[str, Any]):
+        oid = o.get("id")
+        self.by_id.set(oid, pos)
+        self._bucket("by_user", o.get("user_id")).set(oid, None)
+        self._bucket("by_status", o.get("status")).set(oid, None)
+        if o.get("payment_photo_unique_id"):
+            self._bucket("by_photo", o["payment_photo_unique_id"]).set(oid, None)
+        if isinstance(oid, int) and oid > self.max_id:
+            self.max_id = oid
+
+    def replace(self, old: Dict[str, Any], new: Dict[str, Any]):
+        oid = old.get("id")
+        if old.get("user_id") != new.get("user_id"):
+            self._drop("by_user", old.get("user_id"), oid)
+            self._bucket("by_user", new.get("user_id")).set(oid, None)
+        if old.get("status") != new.get("status"):
+            self._drop("by_status", old.get("status"), oid)
+            self._bucket("by_status", new.get("status")).set(oid, None)
+        if old.get("payment_photo_unique_id") != new.get("payment_photo_unique_id"):
+            self._drop("by_photo", old.get("payment_photo_unique_id"), oid)
+            if new.get("payment_photo_unique_id"):
+                self._bucket("by_photo", new["payment_photo_unique_id"]).set(oid, None)
+
+_order_lock = threading.Lock()
+# (view, index) is replaced as one tuple, never changed in place
+_order_state: Dict[str, Any] = {"snap": None}
+
+def _order_snapshot() -> Tuple[Sequence, OrderIndex]:
+    view = orders_view()
+    snap = _order_state["snap"]
+    if snap is not None and snap[0] is view:
+        return snap
+    with _order_lock:
+        snap = _order_state["snap"]
+        if snap is None or snap[0] is not view:
+            snap = (view, OrderIndex(view))
+            _order_state["snap"] = snap
+        return snap
+
+def _orders_commit(changed: List[Dict[str, Any]]):
+    # caller holds store_lock(ORDERS_FILE). Writes only the changed orders (SQLite
+    # rows / one journal line), then replaces them in the cached list in place
+    # (load_json hands out copies, never that list) and publishes the new view
+    entry = _writable_entry(ORDERS_FILE, [])
+    view, index = _order_snapshot()
+    if STORAGE_BACKEND == "sqlite":
+        sig = sql_upsert("orders", [(o.get("id"), o) for o in changed], entry["sig"])
+    else:
+        _journal_append(ORDERS_FILE, changed)
+        _journal_lines[ORDERS_FILE] = _journal_lines.get(ORDERS_FILE, 0) + 1
+        sig = _store_sig(ORDERS_FILE)
+    orders = entry["data"]
+    new_view = view if isinstance(view, ChunkedView) else ChunkedView(view)
+    new_index = index.copy()
+    for o in changed:
+        pos = new_index.by_id.get(o.get("id"))
+        if pos is not None:
+            new_index.replace(new_view[pos], o)
+            new_view = new_view.replace(pos, o)
+            orders[pos] = o
+        else:
+            new_index.add(len(new_view), o)
+            new_view = new_view.append(o)
+            orders.append(o)
+    if STORAGE_BACKEND != "sqlite" and _journal_lines[ORDERS_FILE] >= ORDERS_JOURNAL_MAX:
+        _write_journaled(ORDERS_FILE, orders)
+        sig = _json_cache[ORDERS_FILE]["sig"]
+    _json_cache[ORDERS_FILE] = {"sig": sig, "data": orders, "view": new_view}
+    with _order_lock:
+        _order_state["snap"] = (new_view, new_index)
+
+def next_order_id() -> int:
+    with store_lock(ORDERS_FILE):
+        top = max(_order_snapshot()[1].max_id, int(config_view().get("order_id_seq", 0) or 0))
+        if STORAGE_BACKEND == "sqlite":
+            return sql_next_id("orders", top)
+        new_id = top + 1
+        update_config({"order_id_seq": new_id})
+    return new_id
+
+def get_order(order_id: int) -> Optional[Dict[str, Any]]:
+    view, index = _order_snapshot()
+    pos = index.by_id.get(order_id)
+    return view[pos] if pos is not None else None
+
+def orders_by_status(status: str) -> List[Dict[str, Any]]:
+    view, index = _order_snapshot()
+    return [view[index.by_id[oid]] for oid in index.ids("by_status", status)]
+
+def orders_of_user(user_id: int) -> List[Dict[str, Any]]:
+    view, index = _order_snapshot()
+    return [view[index.by_id[oid]] for oid in index.ids("by_user", user_id)]
+
+def orders_with_photo(unique_id: str) -> List[Dict[str, Any]]:
+    view, index = _order_snapshot()
+    return [view[index.by_id[oid]] for oid in index.ids("by_photo", unique_id)]
+
+def append_order(order: Dict[str, Any]):
+    with store_lock(ORDERS_FILE):
+        _orders_commit([order])
+
+def update_order(order_id: int, fields: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    with store_lock(ORDERS_FILE):
+        view, index = _order_snapshot()
+        pos = index.by_id.get(order_id)
+        if pos is None:
+            return None
+        order = {**view[pos], **fields}
+        _orders_commit([order])
+        return order
+
+# ================== SQLITE STORAGE ==================
+# Optional backend (STORAGE_BACKEND=sqlite): one row per user/product/order/log entry,
+# so a cart click updates one row instead of rewriting users.json. Config (one row
+# per key) and broadcasts (one row per job) live here too, so every --cluster
+# process reads and writes the same rows.
+# Records are stored as JSON in `data`; the other columns exist for indexes.
+
+SQL_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL);
+CREATE TABLE IF NOT EXISTS users (id TEXT PRIMARY KEY, is_admin INTEGER NOT NULL DEFAULT 0, data TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS users_admin_idx ON users(is_admin) WHERE is_admin = 1;
+CREATE TABLE IF NOT EXISTS products (id INTEGER PRIMARY KEY, type TEXT, data TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS products_type_idx ON products(type, id);
+CREATE TABLE IF NOT EXISTS orders (
+    id INTEGER PRIMARY KEY, user_id INTEGER, status TEXT, created_ts INTEGER, data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS orders_user_idx ON orders(user_id, id);
+CREATE INDEX IF NOT EXISTS orders_status_idx ON orders(status, id);
+CREATE TABLE IF NOT EXISTS config (id TEXT PRIMARY KEY, data TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS broadcasts (id TEXT PRIMARY KEY, data TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS logs (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT, timestamp INTEGER NOT NULL, type TEXT, user_id INTEGER, extra TEXT
+);
+CREATE INDEX IF NOT EXISTS logs_ts_idx ON logs(timestamp);
+CREATE INDEX IF NOT EXISTS logs_type_idx ON logs(type, timestamp);
+"""
+
+SQL_TABLES = {
+    USERS_FILE: "users", PRODUCTS_FILE: "products", ORDERS_FILE: "orders",
+    CONFIG_FILE: "config", BROADCASTS_FILE: "broadcasts",
+}
+SQL_COLUMNS = {
+    "users": ("id", "is_admin", "data"),
+    "products": ("id", "type", "data"),
+    "orders": ("id", "user_id", "status", "created_ts", "data"),
+    "config": ("id", "data"),
+    "broadcasts": ("id", "data"),
+}
+SQL_DICT_TABLES = {"users", "config", "broadcasts"}  # {key: record} stores; the rest are lists
+
+_sql_local = threading.local()
+
+def _sql_table(path) -> Optional[str]:
+    if STORAGE_BACKEND != "sqlite":
+        return None
+    return SQL_TABLES.get(path)
+
+def sql_conn() -> sqlite3.Connection:
+    # one connection per thread; autocommit mode, writes use explicit BEGIN IMMEDIATE
+    conn = getattr(_sql_local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(SQLITE_FILE, timeout=30, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(SQL_SCHEMA)
+        _sql_local.conn = conn
+    return conn
+
+def _sql_key(table: str, rec: Dict[str, Any]):
+    return rec.get("id")
+
+def _sql_row(table: str, key, rec: Dict[str, Any]) -> tuple:
+    data = json.dumps(rec, ensure_ascii=False)
+    if table == "users":
+        return (str(key), 1 if rec.get("is_admin") else 0, data)
+    if table in SQL_DICT_TABLES:
+        return (str(key), data)
+    if table == "products":
+        return (key, rec.get("type"), data)
+    return (key, rec.get("user_id"), rec.get("status"), rec.get("created_ts"), data)
+
+def _sql_bump(conn: sqlite3.Connection, table: str) -> int:
+    conn.execute(
+        "INSERT INTO meta(key, value) VALUES (?, 1) ON CONFLICT(key) DO UPDATE SET value = value + 1",
+        ("ver:" + table,)
+    )
+    return conn.execute("SELECT value FROM meta WHERE key = ?", ("ver:" + table,)).fetchone()[0]
+
+def sql_version(table: str) -> int:
+    row = sql_conn().execute("SELECT value FROM meta WHERE key = ?", ("ver:" + table,)).fetchone()
+    return row[0] if row else 0
+
+def sql_load(table: str):
+    rows = sql_conn().execute(f"SELECT id, data FROM {table} ORDER BY rowid").fetchall()
+    if table in SQL_DICT_TABLES:
+        return {k: json.loads(d) for k, d in rows}
+    return [json.loads(d) for _, d in rows]
+
+class StoreConflict(Exception):
+    pass
+
+def sql_write_many(writes: List[Tuple[str, List[tuple], List[Any], Optional[int]]],
+                   seqs: Optional[Dict[str, Tuple[int, int]]] = None) -> List[Optional[int]]:
+    # [(table, upserts, deletes, base)] in one transaction -> a version per write (see
+    # _sql_write). seqs: {name: (value the caller read, new value)}; if another process
+    # moved a sequence since, nothing is written and StoreConflict is raised
+    conn = sql_conn()
+    versions: List[Optional[int]] = []
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        for name, (seen, value) in (seqs or {}).items():
+            row = conn.execute("SELECT value FROM meta WHERE key = ?", ("seq:" + name,)).fetchone()
+            if (row[0] if row else 0) != seen:
+                raise StoreConflict(f"id sequence {name} changed, try again")
+            conn.execute(
+                "INSERT INTO meta(key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+                ("seq:" + name, value)
+            )
+        for table, upserts, deletes, base in writes:
+            cols = SQL_COLUMNS[table]
+            updates = ", ".join(f"{c} = excluded.{c}" for c in cols[1:])
+            if upserts:
+                conn.executemany(
+                    f"INSERT INTO {table}({', '.join(cols)}) VALUES ({', '.join('?' * len(cols))}) "
+                    f"ON CONFLICT(id) DO UPDATE SET {updates}",
+                    upserts
+                )
+            if deletes:
+                conn.executemany(f"DELETE FROM {table} WHERE id = ?", [(k,) for k in deletes])
+            prev = conn.execute("SELECT value FROM meta WHERE key = ?", ("ver:" + table,)).fetchone()
+            ver = _sql_bump(conn, table)
+            versions.append(None if base is not None and (prev[0] if prev else 0) != base else ver)
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    return versions
+
+def _sql_write(table: str, upserts: List[tuple], deletes: List[Any], base: Optional[int] = None) -> Optional[int]:
+    # returns the new table version, or None when another process wrote since `base`
+    # (the caller's cached copy then misses rows and must be reloaded)
+    return sql_write_many([(table, upserts, deletes, base)])[0]
+
+def sql_upsert(table: str, items: List[Tuple[Any, Dict[str, Any]]], base: Optional[int] = None) -> Optional[int]:
+    return _sql_write(table, [_sql_row(table, k, r) for k, r in items], [], base)
+
+def sql_seq(name: str) -> int:
+    # last id handed out by sql_next_id(name), without taking one
+    row = sql_conn().execute("SELECT value FROM meta WHERE key = ?", ("seq:" + name,)).fetchone()
+    return row[0] if row else 0
+
+def sql_next_id(name: str, floor: int = 0) -> int:
+    # atomic id sequence shared by every process: max(current, floor) + 1
+    conn = sql_conn()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.execute(
+            "INSERT INTO meta(key, value) VALUES (?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET value = MAX(value, excluded.value - 1) + 1",
+            ("seq:" + name, floor + 1)
+        )
+        value = conn.execute("SELECT value FROM meta WHERE key = ?", ("seq:" + name,)).fetchone()[0]
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    return value
+
+def sql_diff(table: str, old, new) -> Tuple[List[tuple], List[Any]]:
+    # translate a whole-store save into per-row upserts/deletes
+    if table in SQL_DICT_TABLES:
+        old_map, new_map = dict(old), dict(new)
+    else:
+        old_map = {_sql_key(table, r): r for r in old if isinstance(r, dict)}
+        new_map = {_sql_key(table, r): r for r in new if isinstance(r, dict)}
+    upserts = [_sql_row(table, k, r) for k, r in new_map.items() if k is not None and old_map.get(k) != r]
+    deletes = [k for k in old_map if k not in new_map]
+    return upserts, deletes
+
+def sql_save_diff(table: str, old, new, base: Optional[int] = None) -> Optional[int]:
+    return _sql_write(table, *sql_diff(table, old, new), base)
+
+SQL_LOGS_KEEP = 200000
+
+def sql_append_log(rec: Dict[str, Any]):
+    conn = sql_conn()
+    conn.execute(
+        "INSERT INTO logs(timestamp, type, user_id, extra) VALUES (?, ?, ?, ?)",
+        (rec.get("timestamp"), rec.get("type"), rec.get("user_id"), json.dumps(rec.get("extra") or {}, ensure_ascii=False))
+    )
+
+def sql_compact_logs() -> int:
+    # keep the newest SQL_LOGS_KEEP rows; run from the maintenance job
+    cur = sql_conn().execute(
+        "DELETE FROM logs WHERE seq <= (SELECT MAX(seq) FROM logs) - ?", (SQL_LOGS_KEEP,)
+    )
+    return cur.rowcount
+
+def sql_query_logs(since_ts: Optional[int] = None, until_ts: Optional[int] = None,
+                   limit: Optional[int] = None) -> List[Dict[str, Any]]:
+    # newest `limit` entries in [since_ts, until_ts], returned oldest first
+    q = "SELECT timestamp, type, user_id, extra FROM logs WHERE timestamp >= ? AND timestamp <= ? ORDER BY seq DESC"
+    args: List[Any] = [since_ts or 0, until_ts if until_ts is not None else 2 ** 62]
+    if limit:
+        q += " LIMIT ?"
+        args.append(limit)
+    rows = sql_conn().execute(q, args).fetchall()
+    return [{"timestamp": t, "type": ty, "user_id": u, "extra": json.loads(e or "{}")} for t, ty, u, e in reversed(rows)]
+
+def sql_replace_logs(logs: List[Dict[str, Any]]):
+    conn = sql_conn()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.execute("DELETE FROM logs")
+        conn.executemany(
+            "INSERT INTO logs(timestamp, type, user_id, extra) VALUES (?, ?, ?, ?)",
+            [(l.get("timestamp", 0), l.get("type"), l.get("user_id"), json.dumps(l.get("extra") or {}, ensure_ascii=False))
+             for l in logs if isinstance(l, dict)]
+        )
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+def migrate_json_to_sqlite() -> Dict[str, int]:
+    # one-shot import of the .json stores into SQLITE_FILE (existing rows are replaced)
+    users = read_json_file(USERS_FILE, {})
+    if isinstance(users, dict):
+        _replay_journal(USERS_FILE, users)
+    products = read_json_file(PRODUCTS_FILE, [])
+    orders = read_json_file(ORDERS_FILE, [])
+    if isinstance(orders, list):
+        _replay_journal(ORDERS_FILE, orders)
+    logs = read_json_file(LOGS_FILE, [])
+    config = read_json_file(CONFIG_FILE, {})
+    broadcasts = read_json_file(BROADCASTS_FILE, {})
+    sql_upsert("users", list(users.items()))
+    sql_upsert("products", [(p.get("id"), p) for p in products if isinstance(p, dict) and p.get("id") is not None])
+    sql_upsert("orders", [(o.get("id"), o) for o in orders if isinstance(o, dict) and o.get("id") is not None])
+    sql_upsert("config", list(config.items()))
+    sql_upsert("broadcasts", list(broadcasts.items()))
+    sql_replace_logs(logs)
+    with _json_cache_lock:
+        _json_cache.clear()
+    return {"users": len(users), "products": len(products), "orders": len(orders), "logs": len(logs),
+            "config": len(config), "broadcasts": len(broadcasts)}
 
 # ================== LOGS ==================
 
@@ -124,16 +1080,22 @@ def now_ts() -> int:
     return int(time.time())
 
 def log_event(event_type, user_id=None, extra=None):
-    logs = get_logs()
-    logs.append({
+    rec = {
         "timestamp": now_ts(),
         "type": event_type,
         "user_id": user_id,
         "extra": extra or {}
-    })
-    if len(logs) > 5000:
-        logs = logs[-5000:]
-    save_logs(logs)
+    }
+    if STORAGE_BACKEND == "sqlite":
+        sql_append_log(rec)
+        return
+    jsonl_append_log(rec)
+
+def query_logs(since_ts: Optional[int] = None, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+    now = now_ts()
+    if STORAGE_BACKEND == "sqlite":
+        return sql_query_logs(since_ts, now, limit)
+    return jsonl_query_logs(since_ts, now, limit)
 
 def log_error(where: str, err: Exception, user_id: Optional[int] = None, extra: Optional[dict] = None):
     log_event("error", user_id=user_id, extra={
@@ -143,6 +1105,160 @@ def log_error(where: str, err: Exception, user_id: Optional[int] = None, extra:
         **(extra or {})
     })
 
+# ================== EVENT LOG (JSONL) ==================
+# JSON backend: log_event appends one line to the current segment in LOGS_DIR.
+# Segments rotate by size/age; index.json keeps each segment's start timestamp so
+# time-range queries only open the segments that can contain matching entries.
+
+LOGS_DIR = os.path.join(DATA_DIR, "logs")
+LOGS_INDEX_FILE = os.path.join(LOGS_DIR, "index.json")
+LOG_SEGMENT_MAX_BYTES = 4 * 1024 * 1024
+LOG_SEGMENT_MAX_AGE = 86400
+LOG_RETENTION_SECONDS = 180 * 86400
+
+_log_lock = threading.RLock()
+_log_index: Optional[Dict[str, Any]] = None
+_log_fh = None
+
+def _log_write_index(index: Dict[str, Any]):
+    tmp = LOGS_INDEX_FILE + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(index, f, ensure_ascii=False)
+    os.replace(tmp, LOGS_INDEX_FILE)
+
+def _log_read_index() -> Dict[str, Any]:
+    try:
+        with open(LOGS_INDEX_FILE, "r", encoding="utf-8") as f:
+            index = json.load(f)
+        if isinstance(index, dict) and isinstance(index.get("segments"), list):
+            return index
+    except Exception:
+        pass
+    return {"segments": []}
+
+def _log_new_segment(index: Dict[str, Any], start_ts: int) -> Dict[str, Any]:
+    name = f"events-{start_ts}.jsonl"
+    n = 1
+    while any(s["name"] == name for s in index["segments"]):
+        n += 1
+        name = f"events-{start_ts}-{n}.jsonl"
+    seg = {"name": name, "start_ts": start_ts}
+    index["segments"].append(seg)
+    return seg
+
+def _log_get_index() -> Dict[str, Any]:
+    global _log_index
+    if _log_index is not None:
+        return _log_index
+    os.makedirs(LOGS_DIR, exist_ok=True)
+    index = _log_read_index()
+    if not index["segments"] and not index.get("legacy_imported"):
+        # carry over the old logs.json tail once
+        try:
+            with open(LOGS_FILE, "r", encoding="utf-8") as f:
+                legacy = [l for l in json.load(f) if isinstance(l, dict)]
+        except Exception:
+            legacy = []
+        if legacy:
+            seg = _log_new_segment(index, int(legacy[0].get("timestamp", 0)))
+            with open(os.path.join(LOGS_DIR, seg["name"]), "a", encoding="utf-8") as f:
+                for l in legacy:
+                    f.write(json.dumps(l, ensure_ascii=False) + "\n")
+        index["legacy_imported"] = True
+        _log_write_index(index)
+    _log_index = index
+    return index
+
+def _log_rotate_if_needed(ts: int):
+    global _log_fh
+    index = _log_get_index()
+    segs = index["segments"]
+    if segs and _log_fh is not None:
+        if ts - segs[-1]["start_ts"] < LOG_SEGMENT_MAX_AGE and _log_fh.tell() < LOG_SEGMENT_MAX_BYTES:
+            return
+    if segs and _log_fh is None:
+        # reopen the last segment after a restart unless it is already full/old
+        path = os.path.join(LOGS_DIR, segs[-1]["name"])
+        size = os.path.getsize(path) if os.path.exists(path) else 0
+        if ts - segs[-1]["start_ts"] < LOG_SEGMENT_MAX_AGE and size < LOG_SEGMENT_MAX_BYTES:
+            _log_fh = open(path, "a", encoding="utf-8")
+            return
+    if _log_fh is not None:
+        _log_fh.close()
+        _log_fh = None
+    seg = _log_new_segment(index, ts)
+    # retention: drop whole segments that ended before the cutoff
+    cutoff = ts - LOG_RETENTION_SECONDS
+    while len(segs) > 1 and segs[1]["start_ts"] < cutoff:
+        old = segs.pop(0)
+        try:
+            os.remove(os.path.join(LOGS_DIR, old["name"]))
+        except OSError:
+            pass
+    _log_write_index(index)
+    _log_fh = open(os.path.join(LOGS_DIR, seg["name"]), "a", encoding="utf-8")
+
+def jsonl_append_log(rec: Dict[str, Any]):
+    line = json.dumps(rec, ensure_ascii=False) + "\n"
+    with _log_lock:
+        _log_rotate_if_needed(int(rec.get("timestamp") or now_ts()))
+        _log_fh.write(line)
+        _log_fh.flush()
+
+def _log_read_segment(name: str) -> List[Dict[str, Any]]:
+    out = []
+    try:
+        with open(os.path.join(LOGS_DIR, name), "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    out.append(json.loads(line))
+                except ValueError:
+                    continue  # torn last line after a crash
+    except OSError:
+        pass
+    return out
+
+def jsonl_query_logs(since_ts: Optional[int] = None, until_ts: Optional[int] = None,
+                     limit: Optional[int] = None) -> List[Dict[str, Any]]:
+    # newest `limit` entries in [since_ts, until_ts], returned oldest first
+    with _log_lock:
+        segs = list(_log_get_index()["segments"])
+    lo = since_ts or 0
+    hi = until_ts if until_ts is not None else 2 ** 62
+    picked = []
+    for i, seg in enumerate(segs):
+        seg_end = segs[i + 1]["start_ts"] if i + 1 < len(segs) else 2 ** 62
+        if seg_end >= lo and seg["start_ts"] <= hi:
+            picked.append(seg)
+    result: List[Dict[str, Any]] = []
+    for seg in reversed(picked):
+        chunk = [l for l in _log_read_segment(seg["name"]) if lo <= int(l.get("timestamp", 0)) <= hi]
+        result = chunk + result
+        if limit and len(result) >= limit:
+            return result[-limit:]
+    return result
+
+def jsonl_replace_logs(logs: List[Dict[str, Any]]):
+    global _log_fh, _log_index
+    with _log_lock:
+        index = _log_get_index()
+        if _log_fh is not None:
+            _log_fh.close()
+            _log_fh = None
+        for seg in index["segments"]:
+            try:
+                os.remove(os.path.join(LOGS_DIR, seg["name"]))
+            except OSError:
+                pass
+        index["segments"] = []
+        logs = [l for l in logs if isinstance(l, dict)]
+        if logs:
+            seg = _log_new_segment(index, int(logs[0].get("timestamp", 0)))
+            with open(os.path.join(LOGS_DIR, seg["name"]), "w", encoding="utf-8") as f:
+                for l in logs:
+                    f.write(json.dumps(l, ensure_ascii=False) + "\n")
+        _log_write_index(index)
+
 # ================== SAFE EXECUTION ==================
 
 GENERIC_ERROR_TEXT = "Ой, что-то пошло не так. Попробуйте ещё раз."
@@ -162,7 +1278,17 @@ def safe_execute(where: str, user_id: Optional[int], chat_id: Optional[int], fn,
 # ================== UTILS ==================
 
 def safe_html(s: str) -> str:
-    return (s or "").replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+    # chained str.replace beats a one-pass translate()/regex escape on Cyrillic text
+    # (see microbench.py); the `in` checks skip the copies for clean text
+    if not s:
+        return ""
+    if "&" in s:
+        s = s.replace("&", "&amp;")
+    if "<" in s:
+        s = s.replace("<", "&lt;")
+    if ">" in s:
+        s = s.replace(">", "&gt;")
+    return s
 
 def short_hash(obj: Any) -> str:
     s = json.dumps(obj, ensure_ascii=False, sort_keys=True).encode("utf-8")
@@ -183,6 +1309,21 @@ def extract_first_fenced_block(text: str, fence: str = "bash") -> str:
         return text[i:].strip()
     return text[i:end2 + 3].strip()
 
+# typical AI self-references, applied in this order. Each pattern is tried only when
+# its literals occur in the casefolded text: a \b...\b scan with IGNORECASE costs
+# ~100 us on a few KB of Cyrillic, the substring checks a fraction of that.
+_AI_MENTION_PATTERNS = [
+    (("как", "ии"), re.compile(r"\bкак\s+ии\b", re.IGNORECASE)),
+    (("как", "ии"), re.compile(r"\bя\s+как\s+ии\b", re.IGNORECASE)),
+    (("—", "ии"), re.compile(r"\bя\s+—\s+ии\b", re.IGNORECASE)),
+    (("сгенерировано", "ии"), re.compile(r"\bсгенерировано\s+ии\b", re.IGNORECASE)),
+    (("интеллект",), re.compile(r"\bискусственн(ый|ая)\s+интеллект\b", re.IGNORECASE)),
+    (("chatgpt",), re.compile(r"\bchatgpt\b", re.IGNORECASE)),
+    (("llama",), re.compile(r"\bllama\b", re.IGNORECASE)),
+]
+_SPACE_RUN_RE = re.compile(r"[ \t]{2,}|\t")  # same result as [ \t]+ -> " ", without rewriting single spaces
+_BLANK_LINES_RE = re.compile(r"\n{3,}")
+
 def normalize_description(desc: str) -> str:
     """
     Remove AI mentions and clean whitespace. Keep it 'human store style'.
@@ -191,28 +1332,29 @@ def normalize_description(desc: str) -> str:
         return ""
     d = desc.strip()
 
-    # remove typical AI self-references
-    patterns = [
-        r"\bкак\s+ии\b",
-        r"\bя\s+как\s+ии\b",
-        r"\bя\s+—\s+ии\b",
-        r"\bсгенерировано\s+ии\b",
-        r"\bискусственн(ый|ая)\s+интеллект\b",
-        r"\bchatgpt\b",
-        r"\bllama\b"
-    ]
-    for p in patterns:
-        d = re.sub(p, "", d, flags=re.IGNORECASE)
+    folded = d.casefold()
+    for literals, pattern in _AI_MENTION_PATTERNS:
+        if all(lit in folded for lit in literals):
+            cut = pattern.sub("", d)
+            if cut != d:  # a removal can join text into a later pattern's literal
+                d, folded = cut, cut.casefold()
 
     # collapse whitespace
-    d = re.sub(r"[ \t]+", " ", d)
-    d = re.sub(r"\n{3,}", "\n\n", d)
+    if "\t" in d or "  " in d:
+        d = _SPACE_RUN_RE.sub(" ", d)
+    if "\n\n\n" in d:
+        d = _BLANK_LINES_RE.sub("\n\n", d)
     return d.strip()
 
 def preview_description(desc: str, limit: int = DESCRIPTION_PREVIEW_LEN) -> str:
     d = (desc or "").strip()
     if not d:
         return ""
+    if len(d) > limit:
+        # only the head is shown: drop \r from a slice instead of the whole text
+        head = d[:2 * limit].replace("\r", "")
+        if len(head) > limit:
+            return head[:limit].rstrip() + "…"
     d = d.replace("\r", "")
     if len(d) <= limit:
         return d
@@ -224,14 +1366,146 @@ def restart_self():
     if not script:
         script = os.path.abspath(__file__)
     script = os.path.abspath(script)
-    argv = [sys.executable, script]
+    if CLUSTER_SHARD is not None:
+        # a worker asks the ingress to restart the whole cluster
+        cluster_control.set("restart", now_ts())
+        return
+    argv = [sys.executable, script] + sys.argv[1:]
     log_event("bot_restart", extra={"argv": argv})
+    flush_pending_writes()
     os.execv(sys.executable, argv)
 
 # ================== STATES ==================
+# Per-user runtime state lives in StateStore instances: entries expire after a
+# TTL and the least recently used ones are dropped past a size cap. With
+# STATE_BACKEND=sqlite the persistent stores live in STATE_DB_FILE, so a
+# half-finished dialog survives restart_self() and is visible to every process.
+
+STATE_BACKEND = os.environ.get("STATE_BACKEND", "memory").strip().lower()
+STATE_DB_FILE = os.path.join(DATA_DIR, "state.db")
+STATE_MAX_ITEMS = int(os.environ.get("STATE_MAX_ITEMS", "100000"))
+STATE_SWEEP_EVERY = 500
+
+STATE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS state (
+    ns TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, expires REAL NOT NULL, PRIMARY KEY (ns, key)
+);
+CREATE INDEX IF NOT EXISTS state_expires_idx ON state(ns, expires);
+CREATE TABLE IF NOT EXISTS leases (name TEXT PRIMARY KEY, owner TEXT NOT NULL, expires REAL NOT NULL);
+CREATE TABLE IF NOT EXISTS update_queue (seq INTEGER PRIMARY KEY AUTOINCREMENT, shard INTEGER NOT NULL, payload TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS update_queue_shard_idx ON update_queue(shard, seq);
+"""
+
+_state_local = threading.local()
+
+def state_conn() -> sqlite3.Connection:
+    conn = getattr(_state_local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(STATE_DB_FILE, timeout=30, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(STATE_SCHEMA)
+        _state_local.conn = conn
+    return conn
+
+class StateStore:
+    def __init__(self, name: str, ttl: float, max_items: int = STATE_MAX_ITEMS, persistent: bool = False):
+        self.name = name
+        self.ttl = ttl
+        self.max_items = max_items
+        self.persistent = persistent and STATE_BACKEND == "sqlite"
+        self._items: "OrderedDict[Any, Tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._sets = 0
+
+    def get(self, key, default=None):
+        now = time.time()
+        if self.persistent:
+            row = state_conn().execute(
+                "SELECT value FROM state WHERE ns = ? AND key = ? AND expires > ?", (self.name, str(key), now)
+            ).fetchone()
+            return json.loads(row[0]) if row else default
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return default
+            if item[0] <= now:
+                del self._items[key]
+                return default
+            self._items.move_to_end(key)
+            return item[1]
+
+    def set(self, key, value):
+        expires = time.time() + self.ttl
+        self._sets += 1
+        if self.persistent:
+            conn = state_conn()
+            conn.execute(
+                "INSERT OR REPLACE INTO state(ns, key, value, expires) VALUES (?, ?, ?, ?)",
+                (self.name, str(key), json.dumps(value, ensure_ascii=False), expires)
+            )
+            if self._sets % STATE_SWEEP_EVERY == 0:
+                self._sweep_db(conn)
+            return
+        with self._lock:
+            self._items[key] = (expires, value)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+        if self._sets % STATE_SWEEP_EVERY == 0:
+            self.sweep()
+
+    def pop(self, key, default=None):
+        if self.persistent:
+            conn = state_conn()
+            conn.execute("BEGIN IMMEDIATE")  # only one process gets the value
+            try:
+                row = conn.execute("SELECT value, expires FROM state WHERE ns = ? AND key = ?", (self.name, str(key))).fetchone()
+                conn.execute("DELETE FROM state WHERE ns = ? AND key = ?", (self.name, str(key)))
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            return json.loads(row[0]) if row and row[1] > time.time() else default
+        with self._lock:
+            item = self._items.pop(key, None)
+        if item is None or item[0] <= time.time():
+            return default
+        return item[1]
+
+    def sweep(self):
+        if self.persistent:
+            self._sweep_db(state_conn())
+            return
+        now = time.time()
+        with self._lock:
+            for k in [k for k, (exp, _) in self._items.items() if exp <= now]:
+                del self._items[k]
+
+    def _sweep_db(self, conn: sqlite3.Connection):
+        conn.execute("DELETE FROM state WHERE ns = ? AND expires <= ?", (self.name, time.time()))
+        conn.execute(
+            "DELETE FROM state WHERE ns = ? AND key IN "
+            "(SELECT key FROM state WHERE ns = ? ORDER BY expires DESC LIMIT -1 OFFSET ?)",
+            (self.name, self.name, self.max_items)
+        )
+
+    def __len__(self):
+        if self.persistent:
+            row = state_conn().execute(
+                "SELECT COUNT(*) FROM state WHERE ns = ? AND expires > ?", (self.name, time.time())
+            ).fetchone()
+            return row[0]
+        return len(self._items)
+
+states = StateStore("states", ttl=24 * 3600, persistent=True)  # unified state machine
+pending_ai_actions = StateStore("ai_plans", ttl=6 * 3600, persistent=True)
+# Telegram only lets bots delete messages younger than 48h
+last_clean_message = StateStore("clean_msg", ttl=48 * 3600, persistent=True)
+last_activity = StateStore("activity", ttl=max(COOLDOWN_SECONDS, 60))
 
 def set_state(user_id: int, action: str, step: int = 0, data: Optional[dict] = None):
-    states[user_id] = {"action": action, "step": step, "data": data or {}}
+    states.set(user_id, {"action": action, "step": step, "data": data or {}})
 
 def get_state(user_id: int) -> Optional[dict]:
     return states.get(user_id)
@@ -239,6 +1513,157 @@ def get_state(user_id: int) -> Optional[dict]:
 def clear_state(user_id: int):
     states.pop(user_id, None)
 
+# ================== DISPATCHER ==================
+# Replaces TeleBot's shared worker pool: updates from the same user run strictly in
+# arrival order, different users run in parallel, and the backlog is bounded so a
+# burst blocks polling instead of growing memory.
+
+BOT_WORKERS = int(os.environ.get("BOT_WORKERS", "8"))
+BOT_MAX_PENDING = int(os.environ.get("BOT_MAX_PENDING", "1000"))
+LATENCY_SAMPLES = 500
+
+class UpdateDispatcher:
+    def __init__(self, process, workers: int = BOT_WORKERS, max_pending: int = BOT_MAX_PENDING):
+        self._process = process
+        self._cond = threading.Condition()
+        self._queues: Dict[Any, deque] = {}  # key -> items; present while the key is queued or running
+        self._ready: deque = deque()  # keys with work and no worker on them
+        self.max_pending = max_pending
+        self.pending = 0
+        self.active = 0
+        self._threads = [
+            threading.Thread(target=self._worker, name=f"dispatch-{i}", daemon=True) for i in range(workers)
+        ]
+        for t in self._threads:
+            t.start()
+
+    def submit(self, key, item, timeout: Optional[float] = None) -> bool:
+        # blocks while the backlog is full; False if it stays full for `timeout` seconds
+        with self._cond:
+            if not self._cond.wait_for(lambda: self.pending < self.max_pending, timeout):
+                return False
+            q = self._queues.get(key)
+            if q is None:
+                q = self._queues[key] = deque()
+                self._ready.append(key)
+            q.append(item)
+            self.pending += 1
+            self._cond.notify_all()
+            return True
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                while not self._ready:
+                    self._cond.wait()
+                key = self._ready.popleft()
+                item = self._queues[key][0]
+                self.active += 1
+            try:
+                self._process(item)
+            except Exception as e:
+                log_error("dispatcher", e)
+            finally:
+                with self._cond:
+                    q = self._queues[key]
+                    q.popleft()
+                    if q:
+                        self._ready.append(key)
+                    else:
+                        del self._queues[key]
+                    self.pending -= 1
+                    self.active -= 1
+                    self._cond.notify_all()
+
+    def drain(self, timeout: Optional[float] = None) -> bool:
+        with self._cond:
+            return self._cond.wait_for(lambda: self.pending == 0, timeout)
+
+    def stats(self) -> Dict[str, int]:
+        with self._cond:
+            return {
+                "queue_depth": self.pending - self.active,
+                "active": self.active,
+                "users_queued": len(self._queues),
+                "workers": len(self._threads),
+            }
+
+dispatcher: Optional[UpdateDispatcher] = None
+
+handler_latency: Dict[str, deque] = {}
+handler_calls: Dict[str, int] = {}
+
+def record_handler_latency(name: str, seconds: float):
+    samples = handler_latency.get(name)
+    if samples is None:
+        samples = handler_latency.setdefault(name, deque(maxlen=LATENCY_SAMPLES))
+    samples.append(seconds)
+    handler_calls[name] = handler_calls.get(name, 0) + 1
+
+def _percentile(sorted_values: List[float], q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+def handler_latency_stats() -> Dict[str, Dict[str, float]]:
+    out = {}
+    for name, samples in list(handler_latency.items()):
+        vals = sorted(samples)
+        out[name] = {
+            "calls": handler_calls.get(name, 0),
+            "p50_ms": round(_percentile(vals, 0.5) * 1000, 1),
+            "p95_ms": round(_percentile(vals, 0.95) * 1000, 1),
+            "max_ms": round((vals[-1] if vals else 0) * 1000, 1),
+        }
+    return out
+
+def update_key(update: types.Update):
+    # the sender's user id; falls back to chat id / update id for anonymous updates
+    for obj in (update.message, update.callback_query, update.edited_message):
+        if obj is None:
+            continue
+        if getattr(obj, "from_user", None) is not None:
+            return obj.from_user.id
+        if getattr(obj, "chat", None) is not None:
+            return obj.chat.id
+    return ("update", update.update_id)
+
+def _process_one_update(update: types.Update):
+    telebot.TeleBot.process_new_updates(bot, [update])
+
+def dispatch_updates(updates: List[types.Update]):
+    for u in updates:
+        if u.update_id > bot.last_update_id:
+            bot.last_update_id = u.update_id
+        dispatcher.submit(update_key(u), u)
+
+def start_dispatcher(workers: int = BOT_WORKERS, max_pending: int = BOT_MAX_PENDING,
+                     process=_process_one_update) -> UpdateDispatcher:
+    global dispatcher
+    if dispatcher is None:
+        dispatcher = UpdateDispatcher(process, workers, max_pending)
+        # polling calls bot.process_new_updates; route it through the dispatcher
+        bot.process_new_updates = dispatch_updates
+    return dispatcher
+
+def runtime_stats_text() -> str:
+    lines = []
+    if dispatcher is not None:
+        st = dispatcher.stats()
+        lines.append(
+            f"⚙️ Очередь: <b>{st['queue_depth']}</b> | в работе: <b>{st['active']}/{st['workers']}</b>"
+        )
+    lat = sorted(handler_latency_stats().items(), key=lambda kv: -kv[1]["p95_ms"])[:6]
+    for name, s in lat:
+        lines.append(f"• {name}: p50 {s['p50_ms']} мс, p95 {s['p95_ms']} мс ({s['calls']})")
+    api = sorted(tg_api_stats().items(), key=lambda kv: -kv[1]["p95_ms"])[:4]
+    for name, s in api:
+        lines.append(
+            f"📡 {name}: p50 {s['p50_ms']} мс, p95 {s['p95_ms']} мс ({s.get('calls', 0)}, повт. {s.get('retries', 0)}, ош. {s.get('errors', 0)})"
+        )
+    lines.extend(llm_stats_lines())
+    return "\n".join(lines)
+
 # ================== ANTISPAM ==================
 
 def check_cooldown(user_id):
@@ -246,7 +1671,7 @@ def check_cooldown(user_id):
     last = last_activity.get(user_id, 0)
     if t - last < COOLDOWN_SECONDS:
         return False
-    last_activity[user_id] = t
+    last_activity.set(user_id, t)
     return True
 
 def cooldown_guard(func):
@@ -272,113 +1697,142 @@ def cooldown_guard(func):
         except Exception:
             chat_id = None
 
-        return safe_execute(func.__name__, uid, chat_id, func, message_or_call)
+        t0 = time.perf_counter()
+        try:
+            return safe_execute(func.__name__, uid, chat_id, func, message_or_call)
+        finally:
+            record_handler_latency(func.__name__, time.perf_counter() - t0)
     return wrapper
 
 # ================== SEND CLEAN ==================
+# One "clean" message per chat: a new screen replaces the previous one. When the
+# callback came from that very message (message_id), the screen is edited in place
+# instead of delete+send, and nothing is sent at all if text and keyboard are unchanged.
+# last_clean_message keeps {"id", "text", "kb"} with content hashes of the current screen.
 
-def send_clean(chat_id, text, reply_markup=None, disable_web_page_preview=True):
-    global last_clean_message
+def _content_hash(s: str) -> str:
+    return hashlib.sha1(s.encode("utf-8")).hexdigest()[:16]
 
+def _markup_json(reply_markup) -> str:
+    if reply_markup is None:
+        return ""
+    return reply_markup if isinstance(reply_markup, str) else reply_markup.to_json()
+
+def _not_modified(e: Exception) -> bool:
+    return "message is not modified" in str(e)
+
+def edit_clean(chat_id, message_id: int, prev: Dict[str, Any], text: str, reply_markup,
+               disable_web_page_preview: bool) -> bool:
+    # -> False when the message can't be edited (too old, deleted...) and must be re-sent
+    text_h, kb_h = _content_hash(text), _content_hash(_markup_json(reply_markup))
+    try:
+        if prev.get("text") != text_h:
+            bot.edit_message_text(text, chat_id, message_id, reply_markup=reply_markup,
+                                  disable_web_page_preview=disable_web_page_preview)
+        elif prev.get("kb") != kb_h:
+            bot.edit_message_reply_markup(chat_id, message_id, reply_markup=reply_markup)
+    except Exception as e:
+        if not _not_modified(e):
+            return False
+    last_clean_message.set(chat_id, {"id": message_id, "text": text_h, "kb": kb_h})
+    return True
+
+def send_clean(chat_id, text, reply_markup=None, disable_web_page_preview=True, message_id: Optional[int] = None):
     if isinstance(reply_markup, types.ReplyKeyboardMarkup):
         return bot.send_message(chat_id, text, reply_markup=reply_markup, disable_web_page_preview=disable_web_page_preview)
 
     old = last_clean_message.get(chat_id)
+    if isinstance(old, int):  # stored before content hashes were kept
+        old = {"id": old}
+    if old and message_id is not None and old.get("id") == message_id:
+        if edit_clean(chat_id, message_id, old, text, reply_markup, disable_web_page_preview):
+            return None
     if old:
         try:
-            bot.delete_message(chat_id, old)
+            bot.delete_message(chat_id, old["id"])
         except Exception:
             pass
 
     msg = bot.send_message(chat_id, text, reply_markup=reply_markup, disable_web_page_preview=disable_web_page_preview)
-    last_clean_message[chat_id] = msg.message_id
+    last_clean_message.set(chat_id, {
+        "id": msg.message_id, "text": _content_hash(text), "kb": _content_hash(_markup_json(reply_markup))
+    })
     return msg
 
 # ================== DATA MODEL HELPERS ==================
 
+def get_user_view(user_id) -> Optional[Dict[str, Any]]:
+    return users_view().get(str(user_id))
+
 def get_or_create_user(user_id, username):
-    users = get_users()
-    uid = str(user_id)
-    if uid not in users:
-        users[uid] = {
-            "username": username or "",
-            "cart": [],
-            "is_admin": False,
-            "awaiting_payment_order_id": None
-        }
-        save_users(users)
+    u = get_user_view(user_id)
+    if u is None:
+        u = new_user_record(username)
+        put_user(user_id, u)
         log_event("new_user", user_id=user_id, extra={"username": username})
-    else:
-        if username and users[uid].get("username") != username:
-            users[uid]["username"] = username
-            save_users(users)
-    return users[uid]
+        return u
+    changes = {}
+    if username and u.get("username") != username:
+        changes["username"] = username
+    if u.get("blocked"):
+        changes["blocked"] = False  # wrote to us again, so broadcasts reach them
+    if changes:
+        u = {**u, **changes}
+        put_user(user_id, u)
+    return u
 
 def update_user(user_id, data):
-    users = get_users()
-    uid = str(user_id)
-    if uid not in users:
-        users[uid] = {"username": "", "cart": [], "is_admin": False, "awaiting_payment_order_id": None}
-    users[uid].update(data)
-    save_users(users)
+    u = get_user_view(user_id)
+    rec = dict(u) if u is not None else new_user_record()
+    rec.update(data)
+    put_user(user_id, rec)
 
 def add_to_cart(user_id, product_id):
-    users = get_users()
-    uid = str(user_id)
-    if uid not in users:
+    u = get_user_view(user_id)
+    if u is None:
         return
-    users[uid].setdefault("cart", [])
-    users[uid]["cart"].append(product_id)
-    save_users(users)
+    put_user(user_id, {**u, "cart": list(u.get("cart") or []) + [product_id]})
     log_event("add_to_cart", user_id=user_id, extra={"product_id": product_id})
 
 def clear_cart(user_id):
-    users = get_users()
-    uid = str(user_id)
-    if uid not in users:
+    u = get_user_view(user_id)
+    if u is None:
         return
-    users[uid]["cart"] = []
-    save_users(users)
+    put_user(user_id, {**u, "cart": []})
     log_event("clear_cart", user_id=user_id)
 
 def get_cart_items(user_id):
-    users = get_users()
-    uid = str(user_id)
-    if uid not in users:
+    u = get_user_view(user_id)
+    if u is None:
         return []
-    cart_ids = users[uid].get("cart", [])
-    products = get_products()
-    by_id = {p.get("id"): p for p in products if isinstance(p, dict)}
+    cart_ids = u.get("cart", [])
+    by_id = catalog_index().by_id
     return [by_id[pid] for pid in cart_ids if pid in by_id]
 
-def generate_product_id(products):
-    ids = [p.get("id") for p in products if isinstance(p, dict)]
-    new_id = 1
-    while new_id in ids:
-        new_id += 1
+def generate_product_id():
+    # monotonic: ids of removed products are never handed out again
+    with store_lock(PRODUCTS_FILE):
+        top = max(catalog_index().max_id, int(config_view().get("product_id_seq", 0) or 0))
+        if STORAGE_BACKEND == "sqlite":
+            return sql_next_id("products", top)
+        new_id = top + 1
+        update_config({"product_id_seq": new_id})
     return new_id
 
-def generate_order_id(orders):
-    ids = [o.get("id") for o in orders if isinstance(o, dict)]
-    new_id = 1
-    while new_id in ids:
-        new_id += 1
-    return new_id
+def generate_order_id(orders=None):
+    return next_order_id()
 
 def find_product_by_id(pid: int) -> Optional[Dict[str, Any]]:
-    for p in get_products():
-        if p.get("id") == pid:
-            return p
-    return None
+    return catalog_index().by_id.get(pid)
 
 # ================== ADMINS ==================
 
 def is_admin(user_id):
-    users = get_users()
-    return str(user_id) in users and users[str(user_id)].get("is_admin", False)
+    u = get_user_view(user_id)
+    return u is not None and u.get("is_admin", False)
 
 def get_admin_ids():
-    return [int(uid) for uid, u in get_users().items() if u.get("is_admin")]
+    return [int(uid) for uid, u in users_view().items() if u.get("is_admin")]
 
 def user_chat_url(username: str) -> Optional[str]:
     if not username:
@@ -386,7 +1840,7 @@ def user_chat_url(username: str) -> Optional[str]:
     return f"https://t.me/{username}"
 
 def support_url() -> Optional[str]:
-    cfg = get_config()
+    cfg = config_view()
     u = (cfg.get("order_manager_username") or "").strip().replace("@", "")
     if not u:
         return None
@@ -436,6 +1890,11 @@ def admin_products_menu():
     kb.add(types.InlineKeyboardButton("❌ Удалить товар", callback_data="admin_delete_product"))
     kb.add(types.InlineKeyboardButton("✏️ Изменить цену", callback_data="admin_change_price"))
     kb.add(types.InlineKeyboardButton("✏️ Изменить описание", callback_data="admin_change_desc"))
+    kb.add(types.InlineKeyboardButton("📥 Импорт CSV/JSONL", callback_data="admin_catalog_import"))
+    kb.row(
+        types.InlineKeyboardButton("📤 Экспорт CSV", callback_data="admin_catalog_export_csv"),
+        types.InlineKeyboardButton("📤 Экспорт JSONL", callback_data="admin_catalog_export_jsonl"),
+    )
     kb.add(types.InlineKeyboardButton("⬅️ Назад", callback_data="admin_back_main"))
     return kb
 
@@ -481,13 +1940,444 @@ def admin_ai_menu():
     kb.add(types.InlineKeyboardButton("⬅️ Назад", callback_data="admin_back_main"))
     return kb
 
+# ================== BROADCAST ==================
+# Broadcasts run as background jobs: a shared token bucket keeps us under Telegram's
+# ~30 msg/s limit, 429s pause the whole bucket for retry_after, and users who
+# blocked the bot are flagged and skipped by later broadcasts. BROADCASTS_FILE
+# holds one small record per job (status, cancel flag, final counters). The
+# recipient list is written once to BROADCAST_DIR/<id>.recipients.json, and the
+# cursor with its counters is checkpointed to <id>.cursor.json after every chunk,
+# so a restart resumes the job without rewriting the recipients.
+
+BROADCAST_DIR = os.path.join(DATA_DIR, "broadcasts")  # per-job recipients and cursor
+BROADCAST_RATE = float(os.environ.get("BROADCAST_RATE", "25"))  # messages per second
+BROADCAST_CONCURRENCY = int(os.environ.get("BROADCAST_CONCURRENCY", "8"))
+BROADCAST_CHUNK = 200
+BROADCAST_MAX_RETRIES = 5
+BROADCAST_PROGRESS_EVERY = 3.0
+BROADCAST_LEASE_TTL = 120
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: Optional[float] = None):
+        self.rate = rate
+        self.capacity = burst or rate
+        self.tokens = self.capacity
+        self.ts = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self) -> float:
+        # takes a token and returns 0, or returns how long to wait before trying again
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.ts) * self.rate)
+            self.ts = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0.0
+            return (1 - self.tokens) / self.rate
+
+    def acquire(self):
+        while True:
+            wait = self.reserve()
+            if not wait:
+                return
+            time.sleep(wait)
+
+    def pause(self, seconds: float):
+        # nobody gets a token for `seconds` (Telegram's retry_after applies to the whole bot)
+        with self._lock:
+            self.tokens = min(self.tokens, 0) - seconds * self.rate
+
+broadcast_bucket = TokenBucket(BROADCAST_RATE)
+_broadcast_cancel: set = set()
+_broadcast_threads: Dict[int, threading.Thread] = {}
+
+def get_broadcasts() -> Dict[str, Dict[str, Any]]:
+    return load_json(BROADCASTS_FILE, {})
+
+def _broadcast_path(job_id: int, kind: str) -> str:
+    return os.path.join(BROADCAST_DIR, f"{job_id}.{kind}.json")
+
+def _read_broadcast_file(job_id: int, kind: str, default):
+    try:
+        with open(_broadcast_path(job_id, kind), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return default
+
+def _write_broadcast_file(job_id: int, kind: str, data):
+    os.makedirs(BROADCAST_DIR, exist_ok=True)
+    atomic_write_text(_broadcast_path(job_id, kind), json.dumps(data, ensure_ascii=False), snapshot=False)
+
+def broadcast_recipients(job: Dict[str, Any]) -> List[int]:
+    if "recipients" in job:  # jobs started before the split
+        return job["recipients"]
+    return _read_broadcast_file(job["id"], "recipients", [])
+
+def broadcast_cursor(job: Dict[str, Any]) -> Dict[str, int]:
+    cursor = {k: job.get(k, 0) for k in ("cursor", "sent", "blocked", "failed")}
+    cursor.update(_read_broadcast_file(job["id"], "cursor", {}))
+    return cursor
+
+def broadcast_cancel_requested(job_id: int) -> bool:
+    # broadcasts are always written through (a row in SQLite, or broadcasts.json)
+    # and the cache follows the table version / file signature, so this sees a
+    # cancel pressed on any worker
+    job = load_json_view(BROADCASTS_FILE, {}).get(str(job_id))
+    return bool(job and job.get("cancel_requested"))
+
+def mark_users_blocked(user_ids: List[int]):
+    # read the records under the users lock: a concurrent cart click is not overwritten
+    with store_lock(USERS_FILE):
+        users = users_view()
+        put_users({u: {**(users.get(str(u)) or new_user_record()), "blocked": True} for u in user_ids})
+
+def update_broadcast(job_id: int, fields: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    with store_lock(BROADCASTS_FILE):
+        jobs = get_broadcasts()
+        job = jobs.get(str(job_id))
+        if job is None:
+            return None
+        job.update(fields)
+        save_json(BROADCASTS_FILE, jobs)
+    return job
+
+def broadcast_send_one(user_id: int, text: str) -> str:
+    # -> "sent" | "blocked" | "failed"
+    for attempt in range(BROADCAST_MAX_RETRIES):
+        broadcast_bucket.acquire()
+        try:
+            bot.send_message(int(user_id), text)
+            return "sent"
+        except ApiTelegramException as e:
+            if e.error_code == 429:
+                retry_after = ((e.result_json or {}).get("parameters") or {}).get("retry_after", 1)
+                broadcast_bucket.pause(float(retry_after))
+                continue
+            desc = (e.description or "").lower()
+            if e.error_code == 403 or (e.error_code == 400 and "chat not found" in desc):
+                return "blocked"
+            return "failed"
+        except Exception:
+            time.sleep(min(2 ** attempt, 10))
+    return "failed"
+
+def broadcast_progress_text(job: Dict[str, Any]) -> str:
+    total = job.get("total", 0)
+    status = {"running": "идёт", "done": "завершена", "cancelled": "остановлена"}.get(job.get("status"), job.get("status"))
+    return (
+        f"📢 <b>Рассылка #{job['id']}</b> — {status}\n"
+        f"Обработано: <b>{job.get('cursor', 0)}/{total}</b>\n"
+        f"✅ Доставлено: {job.get('sent', 0)} | 🚫 Заблокировали: {job.get('blocked', 0)} | ⚠️ Ошибки: {job.get('failed', 0)}"
+    )
+
+def _broadcast_report(job: Dict[str, Any]):
+    kb = None
+    if job.get("status") == "running":
+        kb = types.InlineKeyboardMarkup()
+        kb.add(types.InlineKeyboardButton("⛔ Остановить", callback_data=f"bc_cancel_{job['id']}"))
+    try:
+        if job.get("progress_message_id"):
+            bot.edit_message_text(broadcast_progress_text(job), job["chat_id"], job["progress_message_id"], reply_markup=kb)
+        else:
+            msg = bot.send_message(job["chat_id"], broadcast_progress_text(job), reply_markup=kb)
+            update_broadcast(job["id"], {"progress_message_id": msg.message_id})
+    except Exception:
+        pass
+
+def _run_broadcast(job_id: int):
+    job = get_broadcasts().get(str(job_id))
+    lease = f"broadcast:{job_id}"
+    if not job or job.get("status") != "running" or not acquire_lease(lease, BROADCAST_LEASE_TTL):
+        _broadcast_threads.pop(job_id, None)  # finished, or another worker owns it
+        return
+    recipients = broadcast_recipients(job)
+    cursor = broadcast_cursor(job)
+    text = job["text"]
+    last_report = 0.0
+    with ThreadPoolExecutor(max_workers=BROADCAST_CONCURRENCY, thread_name_prefix=f"broadcast-{job_id}") as pool:
+        while cursor["cursor"] < len(recipients):
+            if job_id in _broadcast_cancel or broadcast_cancel_requested(job_id):
+                status = {"status": "cancelled"}
+                break
+            if not acquire_lease(lease, BROADCAST_LEASE_TTL):
+                _broadcast_threads.pop(job_id, None)
+                return
+            chunk = recipients[cursor["cursor"]:cursor["cursor"] + BROADCAST_CHUNK]
+            results = list(pool.map(lambda u: broadcast_send_one(u, text), chunk))
+            blocked = [u for u, r in zip(chunk, results) if r == "blocked"]
+            if blocked:
+                mark_users_blocked(blocked)
+            cursor = {
+                "cursor": cursor["cursor"] + len(chunk),
+                "sent": cursor["sent"] + results.count("sent"),
+                "blocked": cursor["blocked"] + len(blocked),
+                "failed": cursor["failed"] + results.count("failed"),
+            }
+            _write_broadcast_file(job_id, "cursor", cursor)
+            if time.time() - last_report >= BROADCAST_PROGRESS_EVERY:
+                last_report = time.time()
+                _broadcast_report({**(load_json_view(BROADCASTS_FILE, {}).get(str(job_id)) or job), **cursor})
+        else:
+            status = {"status": "done", "finished_ts": now_ts()}
+    # finished jobs keep only their record with the final counters
+    job = update_broadcast(job_id, {**status, **cursor}) or {**job, **status, **cursor}
+    for kind in ("recipients", "cursor"):
+        try:
+            os.remove(_broadcast_path(job_id, kind))
+        except OSError:
+            pass
+    _broadcast_cancel.discard(job_id)
+    _broadcast_threads.pop(job_id, None)
+    release_lease(lease)
+    _broadcast_report(job)
+    log_event("broadcast_finished", user_id=job.get("admin_id"), extra={
+        "job_id": job_id, "status": job.get("status"),
+        "sent": job.get("sent", 0), "blocked": job.get("blocked", 0), "failed": job.get("failed", 0)
+    })
+
+def _spawn_broadcast(job_id: int):
+    t = threading.Thread(target=safe_execute, args=("broadcast", None, None, _run_broadcast, job_id),
+                         name=f"broadcast-{job_id}", daemon=True)
+    _broadcast_threads[job_id] = t
+    t.start()
+
+def start_broadcast(admin_id: int, chat_id: int, text: str) -> Dict[str, Any]:
+    recipients = [int(uid) for uid, u in users_view().items() if not u.get("blocked")]
+    with store_lock(BROADCASTS_FILE):
+        jobs = get_broadcasts()
+        for old in jobs.values():
+            if old.get("status") != "running":
+                old.pop("recipients", None)  # left over from jobs started before the split
+        job_id = max((int(k) for k in jobs), default=0) + 1
+        if STORAGE_BACKEND == "sqlite":
+            job_id = sql_next_id("broadcasts", job_id - 1)  # unique across --cluster processes
+        # recipients first: a job record never points at a missing list
+        _write_broadcast_file(job_id, "recipients", recipients)
+        job = {
+            "id": job_id, "admin_id": admin_id, "chat_id": chat_id, "text": text,
+            "status": "running", "created_ts": now_ts(), "total": len(recipients),
+            "cursor": 0, "sent": 0, "blocked": 0, "failed": 0, "progress_message_id": None
+        }
+        jobs[str(job_id)] = job
+        save_json(BROADCASTS_FILE, jobs)
+    log_event("broadcast_started", user_id=admin_id, extra={"job_id": job_id, "recipients": len(recipients)})
+    _spawn_broadcast(job_id)
+    return job
+
+def resume_broadcasts():
+    for key, job in get_broadcasts().items():
+        if job.get("status") == "running" and int(key) not in _broadcast_threads:
+            _spawn_broadcast(int(key))
+
+def cancel_broadcast(job_id: int) -> bool:
+    # the flag in broadcasts.json reaches the job even when another worker runs it
+    job = get_broadcasts().get(str(job_id))
+    if not job or job.get("status") != "running":
+        return False
+    _broadcast_cancel.add(job_id)
+    update_broadcast(job_id, {"cancel_requested": True})
+    return True
+
+# ================== BOT API TRANSPORT ==================
+# All Bot API calls of the sync bot go through one pooled keep-alive requests.Session
+# (installed as telebot's CUSTOM_REQUEST_SENDER), sized for the update workers plus
+# broadcast senders. Timeouts depend on the method. 429 and 5xx are retried with
+# Telegram's retry_after. A 429 also pauses the broadcast bucket, since Telegram's
+# limit applies to the whole bot. Latency is sampled per API method.
+# (--async uses AsyncTeleBot's own aiohttp session.)
+
+TG_TRANSPORT = os.environ.get("TG_TRANSPORT", "1").strip() != "0"
+TG_POOL_SIZE = int(os.environ.get("TG_POOL_SIZE", "0")) or BOT_WORKERS + BROADCAST_CONCURRENCY + 4
+TG_CONNECT_TIMEOUT = 5
+TG_READ_TIMEOUT = 15
+TG_METHOD_TIMEOUTS = {"sendPhoto": 60, "sendDocument": 120, "getFile": 15, "answerCallbackQuery": 10}
+TG_MAX_RETRIES = int(os.environ.get("TG_MAX_RETRIES", "3"))
+TG_MAX_RETRY_AFTER = 10  # longer waits are left to the caller (e.g. the broadcast loop)
+
+tg_session = requests.Session()
+tg_session.mount("https://", requests.adapters.HTTPAdapter(pool_connections=2, pool_maxsize=TG_POOL_SIZE))
+tg_session.mount("http://", requests.adapters.HTTPAdapter(pool_connections=2, pool_maxsize=TG_POOL_SIZE))
+tg_api_latency: Dict[str, deque] = {}
+tg_api_counts: Dict[str, Dict[str, int]] = {}
+
+def _tg_retry_after(resp) -> Optional[float]:
+    try:
+        return float(resp.json().get("parameters", {}).get("retry_after"))
+    except Exception:
+        return None
+
+def _tg_record(api_method: str, seconds: float, outcome: str):
+    samples = tg_api_latency.get(api_method)
+    if samples is None:
+        samples = tg_api_latency.setdefault(api_method, deque(maxlen=LATENCY_SAMPLES))
+    samples.append(seconds)
+    counts = tg_api_counts.setdefault(api_method, {"calls": 0, "retries": 0, "errors": 0})
+    counts["calls" if outcome == "ok" else outcome] += 1
+
+def tg_request_sender(method, url, params=None, files=None, timeout=None, proxies=None):
+    api_method = url.rsplit("/", 1)[-1]
+    if api_method != "getUpdates":  # long polling keeps telebot's timeout
+        timeout = (TG_CONNECT_TIMEOUT, TG_METHOD_TIMEOUTS.get(api_method, TG_READ_TIMEOUT))
+    attempt = 0
+    while True:
+        t0 = time.perf_counter()
+        try:
+            resp = tg_session.request(method, url, params=params, files=files, timeout=timeout, proxies=proxies)
+        except requests.ConnectionError:
+            # includes connect timeouts: the request never reached Telegram, safe to resend
+            _tg_record(api_method, time.perf_counter() - t0, "errors")
+            if files or attempt >= TG_MAX_RETRIES:
+                raise
+            time.sleep(0.5 * 2 ** attempt)
+            attempt += 1
+            continue
+        elapsed = time.perf_counter() - t0
+        if resp.status_code != 429 and resp.status_code < 500:
+            _tg_record(api_method, elapsed, "ok")
+            return resp
+        wait = _tg_retry_after(resp) if resp.status_code == 429 else None
+        if wait:
+            broadcast_bucket.pause(wait)
+        # uploads are not retried: their file objects are already consumed
+        if files or attempt >= TG_MAX_RETRIES or (wait or 0) > TG_MAX_RETRY_AFTER:
+            _tg_record(api_method, elapsed, "errors")
+            return resp
+        _tg_record(api_method, elapsed, "retries")
+        time.sleep(wait or 0.5 * 2 ** attempt)
+        attempt += 1
+
+def tg_api_stats() -> Dict[str, Dict[str, float]]:
+    out = {}
+    for name, samples in list(tg_api_latency.items()):
+        vals = sorted(samples)
+        out[name] = {
+            **tg_api_counts.get(name, {}),
+            "p50_ms": round(_percentile(vals, 0.5) * 1000, 1),
+            "p95_ms": round(_percentile(vals, 0.95) * 1000, 1),
+        }
+    return out
+
+if TG_TRANSPORT:
+    telebot.apihelper.CUSTOM_REQUEST_SENDER = tg_request_sender
+
 # ================== SHOP LIST + PRODUCT PAGES (NEW) ==================
 
+# Rendered list pages keyed by (ptype, page, catalog version). The version
+# moves on every save_products() and whenever products.json is reloaded, so a
+# stale page is never served; browsing only re-renders after a catalog change.
+_catalog_lock = threading.Lock()
+_catalog_state: Dict[str, Any] = {"version": 0, "view": None, "index": None}
+_catalog_pages: Dict[Tuple[str, int, int], Tuple[str, str]] = {}
+# Product pages the same way, keyed by (ptype, idx, catalog version); bounded
+# because one catalog version can have thousands of them.
+PRODUCT_PAGE_CACHE = int(os.environ.get("PRODUCT_PAGE_CACHE", "1000"))
+_product_pages: "OrderedDict[Tuple[str, int, int], Tuple[str, str]]" = OrderedDict()
+
+class CatalogIndex:
+    # id -> product, type -> products sorted by id, id -> position inside its type
+    def __init__(self, products):
+        self.by_id: Dict[int, Dict[str, Any]] = {}
+        self.by_type: Dict[str, List[Dict[str, Any]]] = {}
+        self.position: Dict[int, int] = {}
+        self.max_id = 0
+        for p in products:
+            if not isinstance(p, dict):
+                continue
+            pid = p.get("id")
+            self.by_id[pid] = p
+            self.by_type.setdefault(p.get("type"), []).append(p)
+            if isinstance(pid, int) and pid > self.max_id:
+                self.max_id = pid
+        for items in self.by_type.values():
+            items.sort(key=_product_sort_key)
+            for i, p in enumerate(items):
+                self.position[p.get("id")] = i
+
+    def ids(self, ptype: str) -> List[int]:
+        return [p.get("id") for p in self.by_type.get(ptype, [])]
+
+def _product_sort_key(p: Dict[str, Any]):
+    try:
+        return (0, int(p.get("id", 0)))
+    except (TypeError, ValueError):
+        return (1, 0)
+
+def invalidate_catalog_cache():
+    with _catalog_lock:
+        _catalog_state["version"] += 1
+        _catalog_state["view"] = None
+        _catalog_state["index"] = None
+        _catalog_pages.clear()
+        _product_pages.clear()
+
+def catalog_version() -> int:
+    view = products_view()
+    with _catalog_lock:
+        if _catalog_state["view"] is not view:
+            _catalog_state["version"] += 1
+            _catalog_state["view"] = view
+            _catalog_state["index"] = None
+            _catalog_pages.clear()
+            _product_pages.clear()
+        return _catalog_state["version"]
+
+def catalog_index() -> CatalogIndex:
+    version = catalog_version()
+    index = _catalog_state["index"]
+    if index is None:
+        index = CatalogIndex(_catalog_state["view"] or products_view())
+        with _catalog_lock:
+            if _catalog_state["version"] == version:
+                _catalog_state["index"] = index
+    return index
+
 def paginate_products(ptype: str) -> List[Dict[str, Any]]:
-    return [p for p in get_products() if p.get("type") == ptype]
+    return catalog_index().by_type.get(ptype, [])
 
-def render_products_list_text(ptype: str, page: int) -> Tuple[str, int]:
+def catalog_page(ptype: str, page: int) -> Tuple[str, str]:
+    # (html text, keyboard JSON) for one list page, rendered once per catalog version
+    version = catalog_version()
     items = paginate_products(ptype)
+    pages = max(1, (len(items) + PAGINATION_PAGE_SIZE - 1) // PAGINATION_PAGE_SIZE)
+    page = max(0, min(page, pages - 1))
+    key = (ptype, page, version)
+    cached = _catalog_pages.get(key)
+    if cached is not None:
+        return cached
+    text, pages = render_products_list_text(ptype, page, items)
+    rendered = (text, products_list_kb(ptype, page, pages, items).to_json())
+    with _catalog_lock:
+        if _catalog_state["version"] == version:
+            _catalog_pages[key] = rendered
+    return rendered
+
+def product_page(ptype: str, idx: int) -> Tuple[str, str]:
+    # (html text, keyboard JSON) for one product page; descriptions are long, so the escape is paid once
+    version = catalog_version()
+    items = paginate_products(ptype)
+    idx = max(0, min(idx, len(items) - 1))
+    key = (ptype, idx, version)
+    with _catalog_lock:
+        cached = _product_pages.get(key)
+        if cached is not None:
+            _product_pages.move_to_end(key)
+            return cached
+    p = items[idx]
+    rendered = (
+        render_product_page_text(p, idx, len(items), ptype),
+        product_page_kb(ptype, idx, len(items), int(p.get("id"))).to_json(),
+    )
+    with _catalog_lock:
+        if _catalog_state["version"] == version:
+            _product_pages[key] = rendered
+            while len(_product_pages) > PRODUCT_PAGE_CACHE:
+                _product_pages.popitem(last=False)
+    return rendered
+
+def render_products_list_text(ptype: str, page: int, items: Optional[List[Dict[str, Any]]] = None) -> Tuple[str, int]:
+    if items is None:
+        items = paginate_products(ptype)
     total = len(items)
     pages = max(1, (total + PAGINATION_PAGE_SIZE - 1) // PAGINATION_PAGE_SIZE)
     page = max(0, min(page, pages - 1))
@@ -515,9 +2405,10 @@ def render_products_list_text(ptype: str, page: int) -> Tuple[str, int]:
             )
     return "\n".join(lines), pages
 
-def products_list_kb(ptype: str, page: int, pages: int) -> types.InlineKeyboardMarkup:
+def products_list_kb(ptype: str, page: int, pages: int, items: Optional[List[Dict[str, Any]]] = None) -> types.InlineKeyboardMarkup:
     kb = types.InlineKeyboardMarkup()
-    items = paginate_products(ptype)
+    if items is None:
+        items = paginate_products(ptype)
     start = page * PAGINATION_PAGE_SIZE
     end = start + PAGINATION_PAGE_SIZE
     part = items[start:end]
@@ -575,13 +2466,12 @@ def product_page_kb(ptype: str, idx: int, total: int, pid: int) -> types.InlineK
     return kb
 
 def products_sorted_by_id(ptype: str) -> List[Dict[str, Any]]:
-    items = paginate_products(ptype)
-    try:
-        return sorted(items, key=lambda x: int(x.get("id", 0)))
-    except Exception:
-        return items
+    return paginate_products(ptype)
 
 def find_index_by_id(items: List[Dict[str, Any]], pid: int) -> int:
+    i = catalog_index().position.get(pid)
+    if i is not None and i < len(items) and items[i].get("id") == pid:
+        return i
     for i, p in enumerate(items):
         if p.get("id") == pid:
             return i
@@ -589,7 +2479,7 @@ def find_index_by_id(items: List[Dict[str, Any]], pid: int) -> int:
 
 # ================== CART / ORDERS ==================
 
-def show_cart(chat_id: int, user_id: int):
+def show_cart(chat_id: int, user_id: int, message_id: Optional[int] = None):
     items = get_cart_items(user_id)
     if not items:
         send_clean(chat_id, "🧺 Ваша корзина пуста.", reply_markup=main_menu())
@@ -603,40 +2493,34 @@ def show_cart(chat_id: int, user_id: int):
     kb.add(types.InlineKeyboardButton("✅ Оформить заказ", callback_data="cart_checkout"))
     kb.add(types.InlineKeyboardButton("🗑 Очистить", callback_data="cart_clear"))
     kb.add(types.InlineKeyboardButton("🏠 Главное меню", callback_data="back_main_menu"))
-    send_clean(chat_id, "\n".join(lines), reply_markup=kb)
+    send_clean(chat_id, "\n".join(lines), reply_markup=kb, message_id=message_id)
 
 def create_order_for_user(user_id: int, username: Optional[str]):
     items = get_cart_items(user_id)
     if not items:
         return None
-    orders = get_orders()
-    order_id = generate_order_id(orders)
     total = sum(int(i.get("price", 0)) for i in items)
-    order = {
-        "id": order_id,
-        "user_id": user_id,
-        "username": username or "",
-        "items": items,
-        "total": total,
-        "status": "pending_payment",
-        "created_ts": now_ts(),
-        "payment_photo_file_id": None,
-        "ai_verdict_last": None
-    }
-    orders.append(order)
-    save_orders(orders)
+    with store_lock(ORDERS_FILE):
+        order_id = next_order_id()
+        order = {
+            "id": order_id,
+            "user_id": user_id,
+            "username": username or "",
+            "items": items,
+            "total": total,
+            "status": "pending_payment",
+            "created_ts": now_ts(),
+            "payment_photo_file_id": None,
+            "ai_verdict_last": None
+        }
+        append_order(order)
     log_event("order_created", user_id=user_id, extra={"order_id": order_id, "total": total})
     return order
 
 def reject_order(admin_id: int, order_id: int, reason: str) -> bool:
-    orders = get_orders()
-    o = next((x for x in orders if x.get("id") == order_id), None)
+    o = update_order(order_id, {"status": "rejected", "reject_reason": reason, "rejected_ts": now_ts()})
     if not o:
         return False
-    o["status"] = "rejected"
-    o["reject_reason"] = reason
-    o["rejected_ts"] = now_ts()
-    save_orders(orders)
     log_event("order_rejected", user_id=admin_id, extra={"order_id": order_id, "reason": reason})
 
     try:
@@ -673,7 +2557,16 @@ def send_order_log_to_admins(order):
         )
     msg_lines.append(f"\n💰 Сумма: <b>{order.get('total','?')} TMT</b>")
     msg_lines.append(f"📌 Статус: <b>{order.get('status','unknown')}</b>")
+    if order.get("photo_reused_in"):
+        msg_lines.append(photo_reuse_note(order))
+    if order.get("ai_verdict_last"):
+        msg_lines.append("\n🤖 <b>Предпроверка ИИ:</b>\n" + (verdict_summary(order["ai_verdict_last"]) or "—"))
     msg = "\n".join(msg_lines)
+    if len(msg) > 1024:
+        # photo captions are capped at 1024 chars: collapse the item list
+        items = order.get("items", [])
+        msg_lines = msg_lines[:5] + [f"• {len(items)} шт."] + msg_lines[5 + len(items):]
+        msg = "\n".join(msg_lines)
 
     kb = types.InlineKeyboardMarkup()
     kb.add(types.InlineKeyboardButton("🔍 Проверить (ИИ)", callback_data=f"check_payment_{order.get('id')}"))
@@ -700,9 +2593,560 @@ def dispute_admin_reply_kb(user_id: int, order_id: int) -> types.InlineKeyboardM
     kb.add(types.InlineKeyboardButton("✉️ Сообщение клиенту (заказ)", callback_data=f"order_msg_{order_id}"))
     return kb
 
+# ================== LLM GATEWAY ==================
+# Every Groq call goes through `llm`: per-model concurrency limit and request rate
+# (token bucket), retries with exponential backoff on 429/5xx/timeouts (honouring
+# retry-after), a circuit breaker per model and a fallback chain of models.
+# Latency and token usage are sampled per model for the admin stats.
+
+LLM_MAX_RETRIES = int(os.environ.get("LLM_MAX_RETRIES", "3"))
+LLM_CONCURRENCY = int(os.environ.get("LLM_CONCURRENCY", "4"))  # in-flight requests per model
+LLM_RPM = float(os.environ.get("LLM_RPM", "30"))               # requests per minute per model
+LLM_BURST = 5
+LLM_BACKOFF_BASE = 0.5
+LLM_BACKOFF_MAX = 8.0
+LLM_MAX_RETRY_AFTER = 20.0  # a longer retry-after skips to the next model instead of waiting
+LLM_BREAKER_FAILURES = 5
+LLM_BREAKER_COOLDOWN = 30.0
+
+# fallbacks must accept the same input (vision models fall back to vision models)
+LLM_DEFAULT_FALLBACKS = {
+    "meta-llama/llama-4-scout-17b-16e-instruct": ["meta-llama/llama-4-maverick-17b-128e-instruct"],
+    "llama-3.3-70b-versatile": ["llama-3.1-8b-instant"],
+}
+
+def parse_llm_fallbacks(spec: str) -> Dict[str, List[str]]:
+    # "model=fb1,fb2;other=fb3"
+    out: Dict[str, List[str]] = {}
+    for part in spec.split(";"):
+        model, _, chain = part.partition("=")
+        if model.strip():
+            out[model.strip()] = [m.strip() for m in chain.split(",") if m.strip()]
+    return out
+
+LLM_FALLBACKS = {**LLM_DEFAULT_FALLBACKS, **parse_llm_fallbacks(os.environ.get("LLM_FALLBACKS", ""))}
+
+def llm_model_chain(model: str) -> List[str]:
+    return [model] + [m for m in LLM_FALLBACKS.get(model, []) if m != model]
+
+class LLMUnavailable(Exception):
+    pass
+
+def llm_error_kind(e: Exception) -> str:
+    # "rate" (429) | "retry" (5xx, timeout, connection) | "fatal" (other 4xx, bad request...)
+    status = getattr(e, "status_code", None)
+    if status == 429:
+        return "rate"
+    if status is not None:
+        return "retry" if status >= 500 or status == 408 else "fatal"
+    if isinstance(e, APIConnectionError):  # includes APITimeoutError
+        return "retry"
+    return "fatal"
+
+def llm_retry_after(e: Exception) -> Optional[float]:
+    headers = getattr(getattr(e, "response", None), "headers", None) or {}
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after"):
+            return float(headers["retry-after"])
+    except (TypeError, ValueError):
+        pass
+    return None
+
+def llm_backoff(attempt: int) -> float:
+    return min(LLM_BACKOFF_MAX, LLM_BACKOFF_BASE * 2 ** attempt) * (0.5 + random.random() / 2)
+
+class CircuitBreaker:
+    # closed -> open after `failures` straight errors; after `cooldown` one probe
+    # request is let through (half-open) and its outcome closes or re-opens it
+    def __init__(self, failures: int = LLM_BREAKER_FAILURES, cooldown: float = LLM_BREAKER_COOLDOWN):
+        self.threshold = failures
+        self.cooldown = cooldown
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == "closed":
+                return True
+            now = time.monotonic()
+            if now - self.opened_at >= self.cooldown:
+                # also re-probes if the previous probe never reported back
+                self.state = "half_open"
+                self.opened_at = now
+                return True
+            return False
+
+    def success(self):
+        with self._lock:
+            self.state = "closed"
+            self.failures = 0
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == "half_open" or self.failures >= self.threshold:
+                self.state = "open"
+                self.opened_at = time.monotonic()
+
+class _ModelSlot:
+    def __init__(self):
+        self.sem = threading.BoundedSemaphore(LLM_CONCURRENCY)
+        self.bucket = TokenBucket(LLM_RPM / 60, burst=LLM_BURST)
+        self.breaker = CircuitBreaker()
+        self.hold_until = 0.0  # a 429's retry-after holds back every caller of this model
+        self.latency: deque = deque(maxlen=LATENCY_SAMPLES)
+        self.tokens: deque = deque(maxlen=LATENCY_SAMPLES)
+        self.counts = {"calls": 0, "errors": 0, "retries": 0, "fallbacks": 0, "tokens": 0}
+
+class _GatedStream:
+    # a streamed completion keeps its model's concurrency slot until exhausted or closed
+    def __init__(self, stream, release):
+        self._stream = stream
+        self._release = release
+
+    def __iter__(self):
+        try:
+            yield from self._stream
+        finally:
+            self.close()
+
+    def close(self):
+        release, self._release = self._release, None
+        if release is not None:
+            release()
+            _close_stream(self._stream)
+
+class _AsyncGatedStream(_GatedStream):
+    async def __aiter__(self):
+        try:
+            async for chunk in self._stream:
+                yield chunk
+        finally:
+            await self.close()
+
+    async def close(self):
+        release, self._release = self._release, None
+        if release is not None:
+            release()
+            await _aclose_stream(self._stream)
+
+class LLMGateway:
+    def __init__(self, client, aclient=None):
+        self.client = client
+        self.aclient = aclient  # AsyncGroq, set by run_async
+        self._slots: Dict[str, _ModelSlot] = {}
+        self._lock = threading.Lock()
+
+    def slot(self, model: str) -> _ModelSlot:
+        s = self._slots.get(model)
+        if s is None:
+            with self._lock:
+                s = self._slots.setdefault(model, _ModelSlot())
+        return s
+
+    def _record(self, s: _ModelSlot, started: float, resp, stream: bool):
+        s.breaker.success()
+        s.latency.append(time.monotonic() - started)  # for streams: time to the first byte
+        s.counts["calls"] += 1
+        usage = None if stream else getattr(resp, "usage", None)
+        if usage is not None and getattr(usage, "total_tokens", None):
+            s.tokens.append(usage.total_tokens)
+            s.counts["tokens"] += usage.total_tokens
+
+    def _failed(self, s: _ModelSlot, e: Exception, attempt: int) -> Optional[float]:
+        # -> seconds to wait before retrying this model, or None to move on to the next one
+        kind = llm_error_kind(e)
+        s.counts["errors"] += 1
+        if kind == "fatal":
+            s.breaker.success()  # the model answered; the request itself is the problem
+            return None
+        retry_after = llm_retry_after(e)
+        if kind == "rate":
+            if retry_after:
+                s.hold_until = max(s.hold_until, time.monotonic() + min(retry_after, LLM_MAX_RETRY_AFTER))
+        else:
+            s.breaker.failure()
+        if attempt >= LLM_MAX_RETRIES or not s.breaker.allow():
+            return None
+        if retry_after is not None and retry_after > LLM_MAX_RETRY_AFTER:
+            return None
+        s.counts["retries"] += 1
+        return max(retry_after or 0.0, llm_backoff(attempt))
+
+    def complete(self, **request):
+        stream = bool(request.get("stream"))
+        last: Exception = LLMUnavailable(f"{request.get('model')}: circuit open")
+        for i, model in enumerate(llm_model_chain(request["model"])):
+            s = self.slot(model)
+            if i:
+                s.counts["fallbacks"] += 1
+            for attempt in range(LLM_MAX_RETRIES + 1):
+                if not s.breaker.allow():
+                    break
+                hold = s.hold_until - time.monotonic()
+                if hold > 0:
+                    time.sleep(hold)
+                s.bucket.acquire()
+                s.sem.acquire()
+                started = time.monotonic()
+                try:
+                    resp = self.client.chat.completions.create(**{**request, "model": model})
+                except Exception as e:
+                    s.sem.release()
+                    last = e
+                    wait = self._failed(s, e, attempt)
+                    if wait is None:
+                        break
+                    time.sleep(wait)
+                    continue
+                self._record(s, started, resp, stream)
+                if stream:
+                    return _GatedStream(resp, s.sem.release)
+                s.sem.release()
+                return resp
+            log_event("llm_fallback", extra={"model": model, "error": str(last)[:200]})
+        raise last
+
+    async def _asem_acquire(self, sem: threading.BoundedSemaphore):
+        # the limit is shared with the sync path (thread pool), so poll instead of blocking the loop
+        delay = 0.01
+        while not sem.acquire(blocking=False):
+            await asyncio.sleep(delay)
+            delay = min(0.2, delay * 2)
+
+    async def acomplete(self, **request):
+        stream = bool(request.get("stream"))
+        last: Exception = LLMUnavailable(f"{request.get('model')}: circuit open")
+        for i, model in enumerate(llm_model_chain(request["model"])):
+            s = self.slot(model)
+            if i:
+                s.counts["fallbacks"] += 1
+            for attempt in range(LLM_MAX_RETRIES + 1):
+                if not s.breaker.allow():
+                    break
+                hold = s.hold_until - time.monotonic()
+                if hold > 0:
+                    await asyncio.sleep(hold)
+                wait = s.bucket.reserve()
+                while wait:
+                    await asyncio.sleep(wait)
+                    wait = s.bucket.reserve()
+                await self._asem_acquire(s.sem)
+                started = time.monotonic()
+                try:
+                    resp = await self.aclient.chat.completions.create(**{**request, "model": model})
+                except Exception as e:
+                    s.sem.release()
+                    last = e
+                    wait = self._failed(s, e, attempt)
+                    if wait is None:
+                        break
+                    await asyncio.sleep(wait)
+                    continue
+                self._record(s, started, resp, stream)
+                if stream:
+                    return _AsyncGatedStream(resp, s.sem.release)
+                s.sem.release()
+                return resp
+            log_event("llm_fallback", extra={"model": model, "error": str(last)[:200]})
+        raise last
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        out = {}
+        for model, s in list(self._slots.items()):
+            lat = sorted(s.latency)
+            tok = sorted(s.tokens)
+            out[model] = {
+                **s.counts,
+                "state": s.breaker.state,
+                "p50_ms": round(_percentile(lat, 0.5) * 1000, 1),
+                "p95_ms": round(_percentile(lat, 0.95) * 1000, 1),
+                "tokens_p50": _percentile(tok, 0.5),
+                "tokens_p95": _percentile(tok, 0.95),
+            }
+        return out
+
+llm = LLMGateway(groq_client)
+
+def llm_stats_lines() -> List[str]:
+    lines = []
+    for model, st in llm.stats().items():
+        state = "" if st["state"] == "closed" else f" ⛔ {st['state']}"
+        lines.append(
+            f"🤖 {model.split('/')[-1]}: p50 {st['p50_ms']} мс, p95 {st['p95_ms']} мс, "
+            f"токены p95 {st['tokens_p95']:g} | {st['calls']} ок, {st['errors']} ош., "
+            f"{st['retries']} повт., {st['fallbacks']} резерв{state}"
+        )
+    return lines
+
+# ================== AI STREAMING ==================
+# Long Groq answers are streamed into one Telegram message that is edited in
+# place at most every STREAM_EDIT_INTERVAL seconds (edits are rate limited).
+# Used by the AI operator (the plan preview grows action by action and the
+# confirm buttons appear as soon as the JSON closes) and the deep vision check.
+
+AI_STREAMING = os.environ.get("AI_STREAMING", "1").strip() != "0"
+STREAM_EDIT_INTERVAL = float(os.environ.get("STREAM_EDIT_INTERVAL", "1.2"))
+STREAM_MAX_CHARS = 3800  # below the 4096 message limit, leaves room for markup
+
+def stream_deltas(completion):
+    for chunk in completion:
+        if chunk.choices:
+            delta = chunk.choices[0].delta.content
+            if delta:
+                yield delta
+
+async def astream_deltas(completion):
+    async for chunk in completion:
+        if chunk.choices:
+            delta = chunk.choices[0].delta.content
+            if delta:
+                yield delta
+
+def _close_stream(completion):
+    close = getattr(completion, "close", None)
+    if close is not None:
+        try:
+            close()
+        except Exception:
+            pass
+
+async def _aclose_stream(completion):
+    close = getattr(completion, "close", None)
+    if close is not None:
+        try:
+            res = close()
+            if asyncio.iscoroutine(res):
+                await res
+        except Exception:
+            pass
+
+class StreamEditor:
+    # one message edited in place; intermediate updates are throttled, finish() is not
+    def __init__(self, chat_id: int, placeholder: str):
+        self.chat_id = chat_id
+        self.message_id: Optional[int] = None
+        self.last_text = placeholder
+        self.last_edit = 0.0
+        self.placeholder = placeholder
+
+    def due(self) -> bool:
+        return time.monotonic() - self.last_edit >= STREAM_EDIT_INTERVAL
+
+    def _changed(self, text: str, reply_markup) -> bool:
+        return text != self.last_text or reply_markup is not None
+
+    def start(self) -> "StreamEditor":
+        self.message_id = bot.send_message(self.chat_id, self.placeholder).message_id
+        self.last_edit = time.monotonic()
+        return self
+
+    def update(self, text: str, reply_markup=None, force: bool = False):
+        if not self._changed(text, reply_markup) or (not force and not self.due()):
+            return
+        try:
+            bot.edit_message_text(text, chat_id=self.chat_id, message_id=self.message_id, reply_markup=reply_markup)
+        except Exception as e:
+            if "message is not modified" not in str(e):
+                log_error("stream_edit", e)
+        self.last_text, self.last_edit = text, time.monotonic()
+
+    def finish(self, text: str, reply_markup=None):
+        self.update(text, reply_markup, force=True)
+
+class AsyncStreamEditor(StreamEditor):
+    async def start(self) -> "AsyncStreamEditor":
+        self.message_id = (await async_bot.send_message(self.chat_id, self.placeholder)).message_id
+        self.last_edit = time.monotonic()
+        return self
+
+    async def update(self, text: str, reply_markup=None, force: bool = False):
+        if not self._changed(text, reply_markup) or (not force and not self.due()):
+            return
+        try:
+            await async_bot.edit_message_text(text, chat_id=self.chat_id, message_id=self.message_id, reply_markup=reply_markup)
+        except Exception as e:
+            if "message is not modified" not in str(e):
+                log_error("stream_edit", e)
+        self.last_text, self.last_edit = text, time.monotonic()
+
+    async def finish(self, text: str, reply_markup=None):
+        await self.update(text, reply_markup, force=True)
+
+def stream_tail(text: str) -> str:
+    # the end of a growing answer, escaped for an HTML <pre> block
+    if len(text) > STREAM_MAX_CHARS:
+        text = "…" + text[-STREAM_MAX_CHARS:]
+    return safe_html(text)
+
+class PlanStreamParser:
+    # incremental reader of {"summary": ..., "actions": [{...}, ...]}: completed
+    # action objects are available while the rest of the JSON is still streaming
+    def __init__(self):
+        self.text = ""
+        self.actions: List[Dict[str, Any]] = []
+        self.start: Optional[int] = None
+        self.end: Optional[int] = None
+        self._pos = 0
+        self._depth = 0
+        self._in_str = False
+        self._esc = False
+        self._in_actions = False
+        self._obj_start: Optional[int] = None
+
+    @property
+    def closed(self) -> bool:
+        return self.end is not None
+
+    def feed(self, delta: str):
+        self.text += delta
+        text = self.text
+        while self._pos < len(text) and self.end is None:
+            i, ch = self._pos, text[self._pos]
+            self._pos += 1
+            if self._in_str:
+                if self._esc:
+                    self._esc = False
+                elif ch == "\\":
+                    self._esc = True
+                elif ch == '"':
+                    self._in_str = False
+                continue
+            if self.start is None:
+                if ch == "{":
+                    self.start, self._depth = i, 1
+                continue
+            if ch == '"':
+                self._in_str = True
+            elif ch in "{[":
+                if ch == "[" and self._depth == 1:
+                    self._in_actions = text[self.start:i].rstrip().rstrip(":").rstrip().endswith('"actions"')
+                elif ch == "{" and self._depth == 2 and self._in_actions:
+                    self._obj_start = i
+                self._depth += 1
+            elif ch in "}]":
+                self._depth -= 1
+                if ch == "}" and self._depth == 2 and self._in_actions and self._obj_start is not None:
+                    try:
+                        self.actions.append(json.loads(text[self._obj_start:i + 1]))
+                    except ValueError:
+                        pass
+                    self._obj_start = None
+                elif ch == "]" and self._depth == 1:
+                    self._in_actions = False
+                elif self._depth == 0:
+                    self.end = i + 1
+
+    def summary(self) -> str:
+        m = re.search(r'"summary"\s*:\s*"((?:[^"\\]|\\.)*)', self.text)
+        if not m:
+            return ""
+        try:
+            return json.loads('"' + m.group(1) + '"')
+        except ValueError:
+            return m.group(1)
+
+    def plan(self) -> Optional[Dict[str, Any]]:
+        if self.closed:
+            return ai_parse_json_strict(self.text[self.start:self.end])
+        return ai_parse_json_strict(self.text)
+
+def render_plan_preview(parser: PlanStreamParser) -> str:
+    lines = ["🧰 <b>План</b> (формируется…)"]
+    summary = parser.summary()
+    if summary:
+        lines.append(f"\n<b>Summary:</b> {safe_html(summary)}")
+    if parser.actions:
+        lines.append("\n<b>Actions:</b>")
+        for i, a in enumerate(parser.actions, 1):
+            lines.append(f"{i}) <code>{safe_html(str(a.get('type')))}</code> {safe_html(json.dumps(a.get('params', {}), ensure_ascii=False))}")
+    text = "\n".join(lines)
+    return text if len(text) <= STREAM_MAX_CHARS else text[:STREAM_MAX_CHARS].rsplit("\n", 1)[0] + "\n…"
+
 # ================== VISION ==================
 
-def ai_check_payment_image(order: Dict[str, Any], file_url: str, deep: bool = False) -> str:
+VISION_MODEL = "meta-llama/llama-4-scout-17b-16e-instruct"
+VISION_FALLBACK_VERDICT = "```bash\nСтатус: недостаточно данных\nУверенность: низкая\nКомментарий: ошибка анализа\n```"
+
+# Verdicts are cached per (photo file_unique_id, order total, deep): repeat
+# checks of the same screenshot skip get_file and the Groq call. Concurrent
+# checks of one key wait for a single request. Failed checks are not cached,
+# nor are streamed ones that ended without a closed verdict block: those fall
+# back to one regular call.
+VISION_CACHE_TTL = int(os.environ.get("VISION_CACHE_TTL", str(7 * 24 * 3600)))
+vision_cache = StateStore("vision", ttl=VISION_CACHE_TTL, persistent=True)
+_vision_inflight: Dict[str, threading.Lock] = {}
+_vision_inflight_lock = threading.Lock()
+
+def vision_cache_key(order: Dict[str, Any], deep: bool) -> str:
+    photo = order.get("payment_photo_unique_id") or order.get("payment_photo_file_id")
+    return f"{photo}:{order.get('total')}:{1 if deep else 0}"
+
+def cached_payment_verdict(order: Dict[str, Any], deep: bool) -> Optional[str]:
+    return vision_cache.get(vision_cache_key(order, deep))
+
+def payment_verdict(order: Dict[str, Any], file_url: str, deep: bool = False) -> str:
+    key = vision_cache_key(order, deep)
+    with _vision_inflight_lock:
+        lock = _vision_inflight.setdefault(key, threading.Lock())
+    with lock:
+        verdict = vision_cache.get(key)
+        if verdict is None:
+            verdict = ai_check_payment_image(order, file_url, deep)
+            if verdict != VISION_FALLBACK_VERDICT:
+                vision_cache.set(key, verdict)
+    with _vision_inflight_lock:
+        _vision_inflight.pop(key, None)
+    return verdict
+
+def streamed_verdict(text: str) -> Optional[str]:
+    # the verdict block of a finished stream, or None if the stream was cut
+    # short (no closed ```bash block) or the block is empty
+    marker = "```bash"
+    i = text.find(marker)
+    if i == -1:
+        return None
+    end = text.find("```", i + len(marker))
+    if end == -1 or not text[i + len(marker):end].strip():
+        return None
+    return extract_first_fenced_block(text.strip(), "bash")
+
+def payment_verdict_streamed(order: Dict[str, Any], file_url: str, chat_id: int, deep: bool = True) -> str:
+    header = f"🧠 <b>Проверка по заказу #{order.get('id')}</b>:\n\n"
+    editor = StreamEditor(chat_id, header + "…").start()
+    text = ""
+    completion = None
+    verdict = None
+    try:
+        completion = llm.complete(**{**payment_check_request(order, file_url, deep), "stream": True})
+        for delta in stream_deltas(completion):
+            text += delta
+            if editor.due():
+                editor.update(header + "<pre>" + stream_tail(text) + "</pre>")
+        verdict = streamed_verdict(text)
+    except Exception as e:
+        log_error("ai_check_payment_image_stream", e)
+    finally:
+        if completion is not None:
+            _close_stream(completion)
+    if verdict is None:
+        # empty or truncated stream: one regular call, cached by its own rules
+        verdict = payment_verdict(order, file_url, deep)
+    else:
+        vision_cache.set(vision_cache_key(order, deep), verdict)
+    editor.finish(header + stream_tail(verdict))
+    return verdict
+
+def photo_reuse_note(order: Dict[str, Any]) -> str:
+    ids = ", ".join(f"#{i}" for i in order.get("photo_reused_in") or [])
+    return f"⚠️ <b>Этот скриншот уже прислан к заказам {ids}</b>"
+
+def payment_check_request(order: Dict[str, Any], file_url: str, deep: bool = False) -> Dict[str, Any]:
+    # kwargs for chat.completions.create, shared by the sync and async clients
     mode = "DEEP" if deep else "STANDARD"
     instructions = (
         "Ты — эксперт по анализу фото/скриншотов подтверждения оплаты.\n"
@@ -736,36 +3180,305 @@ def ai_check_payment_image(order: Dict[str, Any], file_url: str, deep: bool = Fa
             {"type": "image_url", "image_url": {"url": file_url}}
         ]
     }]
+    return {
+        "model": VISION_MODEL,
+        "messages": messages,
+        "temperature": 0.2 if deep else 0.3,
+        "max_completion_tokens": 1400 if deep else 700,
+        "top_p": 1,
+        "stream": False,
+        "stop": None,
+    }
+
+def telegram_file_url(file_path: str) -> str:
+    return f"{TELEGRAM_API_URL}/file/bot{TOKEN}/{file_path}"
+
+def payment_check_target(data: str) -> Tuple[Optional[Dict[str, Any]], bool, Optional[str]]:
+    # check_payment_{id} / check_payment_deep_{id} -> (order, deep, alert text on error)
+    deep = data.startswith("check_payment_deep_")
     try:
-        completion = groq_client.chat.completions.create(
-            model="meta-llama/llama-4-scout-17b-16e-instruct",
-            messages=messages,
-            temperature=0.2 if deep else 0.3,
-            max_completion_tokens=1400 if deep else 700,
-            top_p=1,
-            stream=False,
-            stop=None
-        )
+        order_id = int(data.split("_")[-1])
+    except Exception:
+        return None, deep, "Некорректный ID."
+    order = get_order(order_id)
+    if not order:
+        return None, deep, "Заказ не найден."
+    if not order.get("payment_photo_file_id"):
+        return None, deep, "Фото отсутствует."
+    return order, deep, None
+
+def payment_check_card(order: Dict[str, Any], deep: bool) -> Tuple[str, types.InlineKeyboardMarkup]:
+    order_id = order.get("id")
+    kb = types.InlineKeyboardMarkup()
+    if order.get("username"):
+        kb.add(types.InlineKeyboardButton("💬 Перейти в чат", url=user_chat_url(order["username"])))
+    kb.add(types.InlineKeyboardButton("✉️ Отправить сообщение", callback_data=f"order_msg_{order_id}"))
+    kb.add(types.InlineKeyboardButton("❌ Заказ отклонён", callback_data=f"order_reject_{order_id}"))
+    caption = (
+        f"📦 Заказ <b>#{order_id}</b>\n"
+        f"Пользователь: <code>{order.get('user_id')}</code> @{order.get('username') or 'нет'}\n"
+        f"Сумма: <b>{order.get('total')} TMT</b>\n"
+        f"Режим: <b>{'подробный' if deep else 'обычный'}</b>"
+    )
+    if order.get("photo_reused_in"):
+        caption += "\n" + photo_reuse_note(order)
+    return caption, kb
+
+def ai_check_payment_image(order: Dict[str, Any], file_url: str, deep: bool = False) -> str:
+    try:
+        completion = llm.complete(**payment_check_request(order, file_url, deep))
         raw = completion.choices[0].message.content.strip()
         return extract_first_fenced_block(raw, "bash")
     except Exception as e:
         log_error("ai_check_payment_image", e)
-        return "```bash\nСтатус: недостаточно данных\nУверенность: низкая\nКомментарий: ошибка анализа\n```"
+        return VISION_FALLBACK_VERDICT
+
+# ================== PAYMENT PRE-SCREEN ==================
+# As soon as a payment photo arrives the standard vision check runs in the
+# background; admins are notified when it finishes, with the verdict already
+# in the message (and in the verdict cache for the "Проверить" button), but
+# never later than PRESCREEN_DEADLINE seconds: when the model is slow or down
+# the notification goes out without a verdict and a late verdict is only
+# stored on the order and in the cache.
+# Orders whose notification was lost to a restart are picked up again by
+# resume_prescreens().
+
+PRESCREEN_WORKERS = int(os.environ.get("PRESCREEN_WORKERS", "2"))
+PRESCREEN_QUEUE_SIZE = 500
+PRESCREEN_MAX_RETRIES = 3
+PRESCREEN_BACKOFF = 2.0
+PRESCREEN_DEADLINE = float(os.environ.get("PRESCREEN_DEADLINE", "5"))  # seconds
+
+_prescreen_queue: deque = deque()
+_prescreen_cond = threading.Condition()
+_prescreen_threads: List[threading.Thread] = []
+_prescreen_check_slots = threading.BoundedSemaphore(PRESCREEN_WORKERS)  # vision checks running at once
+
+def enqueue_prescreen(order_id: int) -> bool:
+    # False when the queue is full; the caller then notifies admins right away
+    with _prescreen_cond:
+        if len(_prescreen_queue) >= PRESCREEN_QUEUE_SIZE:
+            return False
+        if order_id in _prescreen_queue:
+            return True
+        _prescreen_queue.append(order_id)
+        if len(_prescreen_threads) < PRESCREEN_WORKERS:
+            t = threading.Thread(target=_prescreen_worker, name=f"prescreen-{len(_prescreen_threads)}", daemon=True)
+            _prescreen_threads.append(t)
+            t.start()
+        _prescreen_cond.notify()
+    return True
+
+def _prescreen_worker():
+    while True:
+        with _prescreen_cond:
+            while not _prescreen_queue:
+                _prescreen_cond.wait()
+            order_id = _prescreen_queue.popleft()
+        safe_execute("prescreen", None, None, prescreen_order, order_id)
+
+def _prescreen_verdict(order: Dict[str, Any]) -> Optional[str]:
+    verdict = cached_payment_verdict(order, False)
+    for attempt in range(PRESCREEN_MAX_RETRIES):
+        if verdict is not None and verdict != VISION_FALLBACK_VERDICT:
+            break
+        if attempt:
+            time.sleep(PRESCREEN_BACKOFF * 2 ** (attempt - 1))
+        try:
+            file_url = telegram_file_url(bot.get_file(order["payment_photo_file_id"]).file_path)
+        except Exception as e:
+            log_error("prescreen_get_file", e)
+            continue
+        verdict = payment_verdict(order, file_url)
+    if verdict is None or verdict == VISION_FALLBACK_VERDICT:
+        return None
+    return verdict
+
+def _prescreen_check(order: Dict[str, Any], state: Dict[str, Any], cond: threading.Condition):
+    # own daemon thread, so a hung model call never holds up shutdown
+    verdict = None
+    try:
+        # every slot busy for the whole deadline means the model is stuck: skip the check
+        if _prescreen_check_slots.acquire(timeout=PRESCREEN_DEADLINE):
+            try:
+                verdict = _prescreen_verdict(order)
+            finally:
+                _prescreen_check_slots.release()
+    finally:
+        with cond:
+            state["verdict"], state["done"] = verdict, True
+            cond.notify_all()
+            late = state["late"]
+    if late and verdict:
+        # admins were notified without it; keep it on the order
+        current = get_order(order["id"])
+        if current and not current.get("ai_verdict_last"):
+            update_order(order["id"], {"ai_verdict_last": verdict, "ai_verdict_last_ts": now_ts()})
+
+def prescreen_order(order_id: int):
+    order = get_order(order_id)
+    if not order or order.get("admins_notified_ts") or not order.get("payment_photo_file_id"):
+        return
+    state: Dict[str, Any] = {"verdict": None, "done": False, "late": False}
+    cond = threading.Condition()
+    threading.Thread(
+        target=safe_execute, args=("prescreen_check", None, None, _prescreen_check, order, state, cond),
+        name=f"prescreen-check-{order_id}", daemon=True,
+    ).start()
+    with cond:
+        cond.wait_for(lambda: state["done"], PRESCREEN_DEADLINE)
+        verdict = state["verdict"]
+        state["late"] = not state["done"]
+    fields: Dict[str, Any] = {"admins_notified_ts": now_ts()}
+    if verdict:
+        fields.update({"ai_verdict_last": verdict, "ai_verdict_last_ts": now_ts()})
+    order = update_order(order_id, fields)
+    if order:
+        send_order_log_to_admins(order)
+
+def resume_prescreens():
+    for o in orders_by_status("awaiting_check"):
+        if not o.get("admins_notified_ts") and owns_user(o.get("user_id")):
+            enqueue_prescreen(o["id"])
+
+def verdict_summary(verdict: str) -> str:
+    # the short lines of a vision verdict that fit into a photo caption
+    keep = ("Статус:", "Уверенность:", "Совпадение суммы:", "Найденная сумма:")
+    lines = [l.strip() for l in (verdict or "").splitlines()]
+    out = [l for l in lines if l.startswith(keep)]
+    if "Рекомендация:" in lines:
+        i = lines.index("Рекомендация:")
+        if i + 1 < len(lines) and lines[i + 1].startswith("-"):
+            out.append("Рекомендация: " + lines[i + 1].lstrip("- "))
+    return "\n".join(safe_html(l) for l in out)
 
 # ================== AI OPERATOR (IMPROVED PROMPT) ==================
 
 AI_OPERATOR_MODEL = "llama-3.3-70b-versatile"
 
-def build_full_context_for_ai() -> Dict[str, Any]:
+# The operator context is built per request within AI_CONTEXT_TOKENS:
+# secrets are never included, the catalog and orders are summarized as
+# aggregates, and only entities the request refers to (ids, title/category
+# words) are listed in full. Sections are added whole, in priority order, so
+# the JSON is never cut. The static part is cached per catalog/config version.
+AI_CONTEXT_TOKENS = int(os.environ.get("AI_CONTEXT_TOKENS", "4000"))
+AI_CONTEXT_SECRET_RE = re.compile(r"pass|token|secret|key|restart_script", re.I)
+AI_CONTEXT_MAX_MATCHES = 40
+# keeps the config view itself: an id() could be reused once the old view is collected
+_ai_static_ctx: Dict[str, Any] = {"version": None, "cfg": None, "value": None, "words": None}
+_ai_static_lock = threading.Lock()
+
+def estimate_tokens(text: str) -> int:
+    # ~3 chars per token for mixed Cyrillic/JSON
+    return len(text) // 3 + 1
+
+def _ctx_json(obj) -> str:
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+
+def _ctx_words(text: str) -> List[str]:
+    return [w for w in re.findall(r"\w+", (text or "").lower()) if len(w) >= 3 and not w.isdigit()]
+
+def _ai_static_context() -> Tuple[Dict[str, Any], Dict[str, List[int]]]:
+    # (config without secrets + catalog aggregates, word -> product ids)
+    cfg = config_view()
+    version = catalog_version()
+    with _ai_static_lock:
+        if _ai_static_ctx["version"] == version and _ai_static_ctx["cfg"] is cfg:
+            return _ai_static_ctx["value"], _ai_static_ctx["words"]
+    index = catalog_index()
+    catalog: Dict[str, Any] = {}
+    words: Dict[str, List[int]] = {}
+    for ptype, items in index.by_type.items():
+        prices = [p.get("price") for p in items if isinstance(p.get("price"), (int, float))]
+        catalog[str(ptype)] = {
+            "count": len(items),
+            "price_min": min(prices) if prices else None,
+            "price_max": max(prices) if prices else None,
+            "categories": sorted({str(p.get("category")) for p in items if p.get("category")})[:30],
+        }
+        for p in items:
+            for w in set(_ctx_words(f"{p.get('title', '')} {p.get('category', '')}")):
+                words.setdefault(w, []).append(p.get("id"))
+    value = {
+        "config": {k: v for k, v in cfg.items() if not AI_CONTEXT_SECRET_RE.search(k)},
+        "catalog": catalog,
+    }
+    with _ai_static_lock:
+        _ai_static_ctx.update({"version": version, "cfg": cfg, "value": value, "words": words})
+    return value, words
+
+def _ctx_product(p: Dict[str, Any]) -> Dict[str, Any]:
     return {
-        "config": get_config(),
-        "products": get_products(),
-        "users_count": len(get_users()),
-        "orders": get_orders()[-100:],
-        "logs_tail": get_logs()[-200:],
-        "server_time": now_ts(),
+        "id": p.get("id"), "type": p.get("type"), "title": p.get("title"), "category": p.get("category"),
+        "price": p.get("price"), "description": preview_description(p.get("description", ""), 80),
     }
 
+def _ctx_order(o: Dict[str, Any]) -> Dict[str, Any]:
+    verdict = (o.get("ai_verdict_last") or "").splitlines()
+    return {
+        "id": o.get("id"), "user_id": o.get("user_id"), "username": o.get("username"), "status": o.get("status"),
+        "total": o.get("total"), "created_ts": o.get("created_ts"), "items": len(o.get("items") or []),
+        "ai": next((l for l in verdict if l.startswith("Статус:")), None),
+    }
+
+def build_ai_context(user_text: str, budget: int = AI_CONTEXT_TOKENS) -> Dict[str, Any]:
+    static, words = _ai_static_context()
+    index = catalog_index()
+    ctx: Dict[str, Any] = dict(static)
+    ctx["server_time"] = now_ts()
+    ctx["users_count"] = len(users_view())
+    _, order_idx = _order_snapshot()
+    ctx["orders_by_status"] = {str(k): len(v) for k, v in order_idx.by_status.items() if v}
+    used = estimate_tokens(_ctx_json(ctx))
+
+    def add(section: str, item) -> bool:
+        nonlocal used
+        cost = estimate_tokens(_ctx_json(item)) + 1
+        if used + cost > budget:
+            return False
+        ctx.setdefault(section, []).append(item)
+        used += cost
+        return True
+
+    text = (user_text or "").lower()
+    numbers = [int(n) for n in re.findall(r"(?<!\w)\d+(?!\w)", text)][:20]
+    seen_products: set = set()
+    seen_orders: set = set()
+    # 1) entities referenced by id
+    for n in numbers:
+        p = index.by_id.get(n)
+        if p is not None and n not in seen_products and add("products", _ctx_product(p)):
+            seen_products.add(n)
+        o = get_order(n)
+        if o is not None and n not in seen_orders and add("orders", _ctx_order(o)):
+            seen_orders.add(n)
+        for o in orders_of_user(n)[-5:]:
+            if o["id"] not in seen_orders and add("orders", _ctx_order(o)):
+                seen_orders.add(o["id"])
+    # 2) products matching request words, best matches first
+    scores: Dict[Any, int] = {}
+    for w in _ctx_words(text):
+        for pid in words.get(w, ()):
+            scores[pid] = scores.get(pid, 0) + 1
+    for pid in sorted(scores, key=lambda k: -scores[k])[:AI_CONTEXT_MAX_MATCHES]:
+        if pid not in seen_products and index.by_id.get(pid) is not None:
+            if not add("products", _ctx_product(index.by_id[pid])):
+                break
+            seen_products.add(pid)
+    # 3) order queue and recent errors when the request is about them
+    if any(w in text for w in ("заказ", "order", "оплат", "чек")):
+        for o in orders_by_status("awaiting_check")[-10:]:
+            if o["id"] not in seen_orders and add("orders", _ctx_order(o)):
+                seen_orders.add(o["id"])
+    if any(w in text for w in ("лог", "log", "ошиб", "error")):
+        for rec in reversed(query_logs(now_ts() - 86400, limit=30)):
+            extra = rec.get("extra") or {}
+            item = {"ts": rec.get("timestamp"), "type": rec.get("type"), "user_id": rec.get("user_id"),
+                    "where": extra.get("where"), "error": (extra.get("error") or "")[:200] or None}
+            if not add("logs", {k: v for k, v in item.items() if v is not None}):
+                break
+    return ctx
+
 def ai_operator_system_prompt() -> str:
     return (
         "Ты — оператор админ-панели магазина Deluxe Metro Shop (Telegram).\n"
@@ -803,6 +3516,7 @@ def ai_operator_system_prompt() -> str:
         "- broadcast {text}\n"
         "- restart_bot {}\n"
         "- get_stats {}\n"
+        "- find_orders {status?: pending_payment|awaiting_check|rejected, user_id?}\n"
     )
 
 def ai_parse_json_strict(text: str) -> Optional[Dict[str, Any]]:
@@ -819,23 +3533,53 @@ def ai_parse_json_strict(text: str) -> Optional[Dict[str, Any]]:
     except Exception:
         return None
 
-def ai_operator_plan(admin_id: int, user_text: str) -> Tuple[str, Optional[Dict[str, Any]]]:
-    ctx = build_full_context_for_ai()
+def ai_operator_request(user_text: str) -> Dict[str, Any]:
+    ctx = build_ai_context(user_text)
     messages = [
         {"role": "system", "content": ai_operator_system_prompt()},
-        {"role": "system", "content": "КОНТЕКСТ:\n" + json.dumps(ctx, ensure_ascii=False)[:35000]},
+        {"role": "system", "content": "КОНТЕКСТ:\n" + _ctx_json(ctx)},
         {"role": "user", "content": user_text}
     ]
+    return {
+        "model": AI_OPERATOR_MODEL,
+        "messages": messages,
+        "temperature": 0.12,
+        "max_completion_tokens": 1800,
+        "top_p": 1,
+        "stream": False,
+        "stop": None,
+    }
+
+def render_ai_plan(admin_id: int, obj: Dict[str, Any]) -> Tuple[str, Optional[types.InlineKeyboardMarkup]]:
+    # registers the plan in pending_ai_actions; no keyboard means "needs clarification"
+    actions = obj.get("actions", [])
+    summary = obj.get("summary", "")
+    risk = (obj.get("risk") or "medium").lower()
+
+    if not actions:
+        return f"Нужно уточнение:\n{safe_html(summary)}", None
+
+    key = short_hash({"admin_id": admin_id, "ts": now_ts(), "actions": actions})
+    pending_ai_actions.set(key, {"admin_id": admin_id, "created_ts": now_ts(), "actions": actions, "summary": summary, "risk": risk})
+
+    lines = ["🧰 <b>План</b>"]
+    if risk == "high":
+        lines.append("⚠️ <b>Опасно</b>: проверьте внимательно.")
+    if summary:
+        lines.append(f"\n<b>Summary:</b> {safe_html(summary)}")
+    lines.append("\n<b>Actions:</b>")
+    for i, a in enumerate(actions, 1):
+        lines.append(f"{i}) <code>{a.get('type')}</code> {safe_html(json.dumps(a.get('params', {}), ensure_ascii=False))}")
+
+    kb = types.InlineKeyboardMarkup()
+    kb.add(types.InlineKeyboardButton("✅ Подтвердить", callback_data=f"ai_apply_{key}"))
+    kb.add(types.InlineKeyboardButton("🧪 Проверить без изменений", callback_data=f"ai_dry_{key}"))
+    kb.add(types.InlineKeyboardButton("❌ Отказаться", callback_data=f"ai_deny_{key}"))
+    return "\n".join(lines), kb
+
+def ai_operator_plan(admin_id: int, user_text: str) -> Tuple[str, Optional[Dict[str, Any]]]:
     try:
-        completion = groq_client.chat.completions.create(
-            model=AI_OPERATOR_MODEL,
-            messages=messages,
-            temperature=0.12,
-            max_completion_tokens=1800,
-            top_p=1,
-            stream=False,
-            stop=None
-        )
+        completion = llm.complete(**ai_operator_request(user_text))
         raw = completion.choices[0].message.content.strip()
     except Exception as e:
         log_error("ai_operator_plan", e, user_id=admin_id)
@@ -843,214 +3587,611 @@ def ai_operator_plan(admin_id: int, user_text: str) -> Tuple[str, Optional[Dict[
     obj = ai_parse_json_strict(raw)
     return raw, obj
 
-def execute_operator_action(admin_id: int, action: Dict[str, Any]) -> Tuple[bool, str, bool]:
+def ai_operator_plan_streamed(admin_id: int, chat_id: int, user_text: str):
+    editor = StreamEditor(chat_id, "🧰 Составляю план…").start()
+    parser = PlanStreamParser()
+    completion = None
+    try:
+        completion = llm.complete(**{**ai_operator_request(user_text), "stream": True})
+        for delta in stream_deltas(completion):
+            parser.feed(delta)
+            if parser.closed:
+                break  # the plan is complete; the rest is trailing text
+            if editor.due():
+                editor.update(render_plan_preview(parser))
+    except Exception as e:
+        log_error("ai_operator_plan_stream", e, user_id=admin_id)
+    finally:
+        if completion is not None:
+            _close_stream(completion)
+    obj = parser.plan()
+    if not obj:
+        editor.finish("Не удалось получить план. Попробуйте иначе.")
+        return
+    plan_text, kb = render_ai_plan(admin_id, obj)
+    editor.finish(plan_text, kb)
+
+# A plan runs as one batch: every store it touches is loaded once, all actions are
+# applied to working copies, and only if each of them succeeded is every changed
+# store written once (config, products, users). With SQLite that is one
+# transaction; JSON files are written one by one and a failure part way is
+# reported with the stores already saved. New product ids are numbered locally and
+# only reserved by the commit. Messages, broadcasts, order rejections and
+# restarts are side effects that run after the commit. A dry run goes through the
+# same steps and reports what would happen without writing.
+
+class PlanCommitError(Exception):
+    def __init__(self, written: List[str], store: str, error: Exception):
+        super().__init__(f"{store}: {error}")
+        self.written = written  # stores saved before `store` failed
+
+class PlanBatch:
+    def __init__(self, admin_id: int, dry_run: bool = False):
+        self.admin_id = admin_id
+        self.dry_run = dry_run
+        self._products: Optional[List[Dict[str, Any]]] = None
+        self._by_id: Dict[int, Dict[str, Any]] = {}
+        self._config: Optional[Dict[str, Any]] = None
+        self._users: Dict[str, Dict[str, Any]] = {}
+        self._changed_users: set = set()
+        self._next_pid: Optional[int] = None
+        self._pid_seq: Optional[int] = None  # SQLite: sequence value the local ids start from
+        self.dirty: set = set()
+        self.effects: List[Tuple[int, Any]] = []  # (result index, fn -> (ok, msg))
+        self.index = 0  # result slot of the action being applied
+
+    def defer(self, fn):
+        self.effects.append((self.index, fn))
+
+    def products(self) -> List[Dict[str, Any]]:
+        if self._products is None:
+            self._products = get_products()
+            self._by_id = {p.get("id"): p for p in self._products}
+        return self._products
+
+    def product(self, pid: int) -> Optional[Dict[str, Any]]:
+        self.products()
+        return self._by_id.get(pid)
+
+    def config(self) -> Dict[str, Any]:
+        if self._config is None:
+            self._config = get_config()
+        return self._config
+
+    def user(self, user_id) -> Optional[Dict[str, Any]]:
+        key = str(user_id)
+        if key not in self._users:
+            u = get_user_view(key)
+            if u is None:
+                return None
+            self._users[key] = dict(u)
+        return self._users[key]
+
+    def set_config(self, fields: Dict[str, Any]):
+        self.config().update(fields)
+        self.dirty.add("config")
+
+    def update_user(self, user_id, fields: Dict[str, Any]):
+        u = self.user(user_id)
+        if u is None:
+            u = self._users[str(user_id)] = new_user_record()
+        u.update(fields)
+        self._changed_users.add(str(user_id))
+        self.dirty.add("users")
+
+    def add_product(self, fields: Dict[str, Any]) -> int:
+        pid = self._new_product_id()
+        p = {"id": pid, **fields}
+        self.products().append(p)
+        self._by_id[pid] = p
+        self.dirty.add("products")
+        return pid
+
+    def update_product(self, pid: int, fields: Dict[str, Any]) -> bool:
+        p = self.product(pid)
+        if p is None:
+            return False
+        p.update(fields)
+        self.dirty.add("products")
+        return True
+
+    def remove_product(self, pid: int) -> bool:
+        p = self.product(pid)
+        if p is None:
+            return False
+        self._products.remove(p)
+        del self._by_id[pid]
+        self.dirty.add("products")
+        return True
+
+    def _new_product_id(self) -> int:
+        # same monotonic sequence as generate_product_id(), counted on in the batch;
+        # commit() reserves the ids (config copy / the SQLite sequence row)
+        if self._next_pid is None:
+            self._next_pid = max(catalog_index().max_id, int(self.config().get("product_id_seq", 0) or 0))
+            if STORAGE_BACKEND == "sqlite":
+                self._pid_seq = sql_seq("products")
+                self._next_pid = max(self._next_pid, self._pid_seq)
+        self._next_pid += 1
+        if STORAGE_BACKEND != "sqlite":
+            self.set_config({"product_id_seq": self._next_pid})
+        return self._next_pid
+
+    def commit(self):
+        # caller holds the products, config and users locks
+        if self.dry_run:
+            return
+        if STORAGE_BACKEND == "sqlite":
+            self._commit_sql()
+            return
+        # config first: a saved id sequence without its products only leaves a gap
+        written: List[str] = []
+        for store, save in (("config", lambda: save_config(self._config)),
+                            ("products", lambda: save_products(self._products)),
+                            ("users", lambda: put_users({k: self._users[k] for k in self._changed_users}))):
+            if store not in self.dirty:
+                continue
+            try:
+                save()
+            except Exception as e:
+                raise PlanCommitError(written, store, e) from e
+            written.append(store)
+
+    def _commit_sql(self):
+        writes = []
+        stores = [(CONFIG_FILE, "config", self._config), (PRODUCTS_FILE, "products", self._products)]
+        for path, table, data in stores:
+            if table in self.dirty:
+                entry = _cache_entry(path, data)
+                writes.append((table, *sql_diff(table, entry["data"], data), entry["sig"]))
+        changed = {k: self._users[k] for k in self._changed_users}
+        if "users" in self.dirty:
+            users_entry = _cache_entry(USERS_FILE, {})
+            writes.append(("users", [_sql_row("users", k, r) for k, r in changed.items()], [], users_entry["sig"]))
+        seqs = {"products": (self._pid_seq, self._next_pid)} if self._pid_seq is not None else None
+        versions = dict(zip([w[0] for w in writes], sql_write_many(writes, seqs)))
+        for path, table, data in stores:
+            if table in versions:
+                _json_cache[path] = {"sig": versions[table], "data": data, "view": _make_view(data)}
+        if "users" in versions:
+            _cache_users(users_entry, changed, versions["users"])
+
+def _int_param(params: Dict[str, Any], name: str) -> Optional[int]:
+    try:
+        return int(params.get(name))
+    except Exception:
+        return None
+
+def _price_param(params: Dict[str, Any]) -> Tuple[Optional[int], str]:
+    price = params.get("price", None)
+    try:
+        price = int(price)
+    except Exception:
+        return None, "price must be int"
+    if price < 0:
+        return None, "price must be >=0"
+    return price, ""
+
+def apply_operator_action(b: PlanBatch, action: Dict[str, Any]) -> Tuple[bool, str, bool]:
+    # -> (ok, message, restart_needed); store changes go to `b`, side effects to b.defer()
     a_type = action.get("type")
     params = action.get("params") or {}
+    admin_id = b.admin_id
 
     if a_type == "get_stats":
-        users = get_users()
-        orders = get_orders()
-        products = get_products()
+        users = users_view()
+        orders = orders_view()
+        products = products_view()
         stats = {
             "users": len(users),
             "orders": len(orders),
             "products": len(products),
-            "weapons": len([p for p in products if p.get("type") == "weapon"]),
-            "armors": len([p for p in products if p.get("type") == "armor"]),
-            "escorts": len([p for p in products if p.get("type") == "escort"]),
+            "weapons": len(paginate_products("weapon")),
+            "armors": len(paginate_products("armor")),
+            "escorts": len(paginate_products("escort")),
+            "awaiting_check": len(orders_by_status("awaiting_check")),
         }
         return True, json.dumps(stats, ensure_ascii=False), False
 
+    if a_type == "find_orders":
+        if params.get("user_id") is not None:
+            found = orders_of_user(int(params["user_id"]))
+            if params.get("status"):
+                found = [o for o in found if o.get("status") == params["status"]]
+        elif params.get("status"):
+            found = orders_by_status(str(params["status"]))
+        else:
+            return False, "find_orders needs status or user_id", False
+        brief = [{k: o.get(k) for k in ("id", "user_id", "status", "total", "created_ts")} for o in found[-50:]]
+        return True, json.dumps({"count": len(found), "orders": brief}, ensure_ascii=False), False
+
     if a_type == "restart_bot":
-        log_event("ai_restart_requested", user_id=admin_id)
         return True, "restart scheduled", True
 
     if a_type == "broadcast":
         txt = str(params.get("text", "")).strip()
         if not txt:
             return False, "broadcast text empty", False
-        users = get_users()
-        cnt = 0
-        for uid in list(users.keys()):
-            try:
-                bot.send_message(int(uid), txt)
-                cnt += 1
-            except Exception:
-                pass
-        log_event("ai_broadcast", user_id=admin_id, extra={"sent": cnt})
-        return True, f"broadcast sent to {cnt}", False
+
+        def run_broadcast():
+            job = start_broadcast(admin_id, admin_id, txt)
+            log_event("ai_broadcast", user_id=admin_id, extra={"job_id": job["id"]})
+            return True, f"broadcast job #{job['id']} started for {job['total']} users"
+        b.defer(run_broadcast)
+        return True, "broadcast will start after commit", False
 
     if a_type == "set_payment_phone":
         phone = str(params.get("phone", "")).strip()
         if not phone:
             return False, "phone empty", False
-        cfg = get_config()
-        cfg["payment_phone"] = phone
-        save_config(cfg)
+        b.set_config({"payment_phone": phone})
         return True, "payment_phone updated", False
 
     if a_type == "set_manager_username":
         uname = str(params.get("username", "")).replace("@", "").strip()
         if not uname:
             return False, "username empty", False
-        cfg = get_config()
-        cfg["order_manager_username"] = uname
-        save_config(cfg)
+        b.set_config({"order_manager_username": uname})
         return True, "support username updated", False
 
-    if a_type == "add_admin":
-        try:
-            new_id = int(params.get("user_id"))
-        except Exception:
+    if a_type == "add_admin":
+        new_id = _int_param(params, "user_id")
+        if new_id is None:
             return False, "user_id must be int", False
-        users = get_users()
-        uid_str = str(new_id)
-        users.setdefault(uid_str, {"username": "", "cart": [], "is_admin": False, "awaiting_payment_order_id": None})
-        users[uid_str]["is_admin"] = True
-        save_users(users)
+        b.update_user(new_id, {"is_admin": True})
         return True, f"user {new_id} is admin", False
 
     if a_type == "remove_admin":
-        try:
-            rem_id = int(params.get("user_id"))
-        except Exception:
+        rem_id = _int_param(params, "user_id")
+        if rem_id is None:
             return False, "user_id must be int", False
-        users = get_users()
-        uid_str = str(rem_id)
-        if uid_str in users and users[uid_str].get("is_admin"):
-            users[uid_str]["is_admin"] = False
-            save_users(users)
-            return True, f"user {rem_id} removed from admins", False
-        return False, "not an admin", False
+        u = b.user(rem_id)
+        if u is None or not u.get("is_admin"):
+            return False, "not an admin", False
+        b.update_user(rem_id, {"is_admin": False})
+        return True, f"user {rem_id} removed from admins", False
 
     if a_type == "order_reject":
-        try:
-            oid = int(params.get("order_id"))
-        except Exception:
+        oid = _int_param(params, "order_id")
+        if oid is None:
             return False, "order_id must be int", False
+        if get_order(oid) is None:
+            return False, f"order #{oid} not found", False
         reason = str(params.get("reason", "Оплата отклонена")).strip()
-        ok = reject_order(admin_id, oid, reason)
-        return ok, f"order #{oid} rejected", False
+        b.defer(lambda: (reject_order(admin_id, oid, reason), f"order #{oid} rejected"))
+        return True, f"order #{oid} will be rejected", False
 
     if a_type == "send_message_to_user":
-        try:
-            uid = int(params.get("user_id"))
-        except Exception:
+        uid = _int_param(params, "user_id")
+        if uid is None:
             return False, "user_id must be int", False
         txt = str(params.get("text", "")).strip()
         if not txt:
             return False, "text empty", False
-        try:
-            bot.send_message(uid, txt)
-        except Exception as e:
-            return False, f"send failed: {e}", False
-        return True, f"sent to {uid}", False
 
-    if a_type == "add_product":
+        def send():
+            try:
+                bot.send_message(uid, txt)
+            except Exception as e:
+                return False, f"send failed: {e}"
+            return True, f"sent to {uid}"
+        b.defer(send)
+        return True, f"will send to {uid}", False
+
+    if a_type in ("add_product", "add_escort"):
         title = str(params.get("title", "")).strip()
-        ptype = str(params.get("type", "")).strip().lower()
+        ptype = "escort" if a_type == "add_escort" else str(params.get("type", "")).strip().lower()
         category = str(params.get("category", "")).strip()
         description = normalize_description(str(params.get("description", "")).strip())
-        price = params.get("price", None)
-        if not title or ptype not in ("weapon", "armor") or price is None:
+        if not title or ptype not in ("weapon", "armor", "escort") or params.get("price") is None:
+            return False, f"invalid params for {a_type}", False
+        if a_type == "add_product" and ptype == "escort":
             return False, "invalid params for add_product", False
-        try:
-            price = int(price)
-            if price < 0:
-                return False, "price must be >=0", False
-        except Exception:
-            return False, "price must be int", False
-        products = get_products()
-        pid = generate_product_id(products)
-        products.append({"id": pid, "title": title, "type": ptype, "category": category, "price": price, "description": description})
-        save_products(products)
-        return True, f"added product id={pid}", False
-
-    if a_type == "add_escort":
-        title = str(params.get("title", "")).strip()
-        category = str(params.get("category", "")).strip()
-        description = normalize_description(str(params.get("description", "")).strip())
-        price = params.get("price", None)
-        if not title or price is None:
-            return False, "invalid params for add_escort", False
-        try:
-            price = int(price)
-            if price < 0:
-                return False, "price must be >=0", False
-        except Exception:
-            return False, "price must be int", False
-        products = get_products()
-        pid = generate_product_id(products)
-        products.append({"id": pid, "title": title, "type": "escort", "category": category, "price": price, "description": description})
-        save_products(products)
-        return True, f"added escort id={pid}", False
-
-    if a_type == "set_description":
-        try:
-            pid = int(params.get("id"))
-        except Exception:
-            return False, "id must be int", False
-        desc = normalize_description(str(params.get("description", "")).strip())
-        products = get_products()
-        p = next((x for x in products if x.get("id") == pid), None)
-        if not p:
-            return False, "not found", False
-        p["description"] = desc
-        save_products(products)
-        return True, f"description updated id={pid}", False
-
-    if a_type == "clear_description":
-        try:
-            pid = int(params.get("id"))
-        except Exception:
+        price, err = _price_param(params)
+        if price is None:
+            return False, err, False
+        pid = b.add_product({"title": title, "type": ptype, "category": category, "price": price, "description": description})
+        return True, f"added {'escort' if ptype == 'escort' else 'product'} id={pid}", False
+
+    if a_type in ("set_description", "clear_description"):
+        pid = _int_param(params, "id")
+        if pid is None:
             return False, "id must be int", False
-        products = get_products()
-        p = next((x for x in products if x.get("id") == pid), None)
-        if not p:
+        desc = normalize_description(str(params.get("description", "")).strip()) if a_type == "set_description" else ""
+        if not b.update_product(pid, {"description": desc}):
             return False, "not found", False
-        p["description"] = ""
-        save_products(products)
-        return True, f"description cleared id={pid}", False
+        return True, f"description {'updated' if desc else 'cleared'} id={pid}", False
 
     if a_type in ("delete_product", "delete_escort"):
-        try:
-            pid = int(params.get("id"))
-        except Exception:
+        pid = _int_param(params, "id")
+        if pid is None:
             return False, "id must be int", False
-        products = get_products()
-        p = next((x for x in products if x.get("id") == pid), None)
+        p = b.product(pid)
         if not p:
             return False, "not found", False
         if a_type == "delete_product" and p.get("type") not in ("weapon", "armor"):
             return False, "id is not weapon/armor", False
         if a_type == "delete_escort" and p.get("type") != "escort":
             return False, "id is not escort", False
-        products = [x for x in products if x.get("id") != pid]
-        save_products(products)
+        b.remove_product(pid)
         return True, f"deleted id={pid}", False
 
     if a_type in ("change_price", "change_escort_price"):
-        try:
-            pid = int(params.get("id"))
-            price = int(params.get("price"))
-            if price < 0:
-                return False, "price must be >=0", False
-        except Exception:
-            return False, "id/price must be int", False
-        products = get_products()
-        p = next((x for x in products if x.get("id") == pid), None)
+        pid = _int_param(params, "id")
+        price, err = _price_param(params)
+        if pid is None or price is None:
+            return False, err if pid is not None else "id/price must be int", False
+        p = b.product(pid)
         if not p:
             return False, "not found", False
         if a_type == "change_price" and p.get("type") not in ("weapon", "armor"):
             return False, "id is not weapon/armor", False
         if a_type == "change_escort_price" and p.get("type") != "escort":
             return False, "id is not escort", False
-        p["price"] = price
-        save_products(products)
+        b.update_product(pid, {"price": price})
         return True, f"updated id={pid} price={price}", False
 
     return False, f"unknown action: {a_type}", False
 
+def execute_operator_plan(admin_id: int, actions: List[Dict[str, Any]], dry_run: bool = False) -> Dict[str, Any]:
+    # -> {"committed", "dry_run", "restart", "results": [{"ok", "type", "msg"}, ...]}
+    b = PlanBatch(admin_id, dry_run)
+    results = []
+    restart = False
+    # orders first (see store_lock): stats / find_orders read them under the plan's
+    # locks, and next_order_id() takes config while holding orders
+    with store_lock(ORDERS_FILE), store_lock(PRODUCTS_FILE), store_lock(CONFIG_FILE), store_lock(USERS_FILE):
+        for a in actions:
+            b.index = len(results)
+            try:
+                ok, msg, r = apply_operator_action(b, a if isinstance(a, dict) else {})
+            except Exception as e:
+                log_error("apply_operator_action", e, user_id=admin_id)
+                ok, msg, r = False, f"error: {e}", False
+            results.append({"ok": ok, "type": a.get("type") if isinstance(a, dict) else None, "msg": msg})
+            restart = restart or (ok and r)
+        committed = all(r["ok"] for r in results) and not dry_run
+        error, partial = None, []
+        if committed:
+            try:
+                b.commit()
+            except Exception as e:
+                log_error("plan_commit", e, user_id=admin_id)
+                committed, error, partial = False, str(e), getattr(e, "written", [])
+    if committed:
+        for i, fn in b.effects:
+            try:
+                results[i]["ok"], results[i]["msg"] = fn()
+            except Exception as e:
+                log_error("operator_effect", e, user_id=admin_id)
+                results[i]["ok"], results[i]["msg"] = False, f"error: {e}"
+        log_event("ai_plan_applied", user_id=admin_id, extra={"actions": len(actions), "stores": sorted(b.dirty)})
+        if restart:
+            log_event("ai_restart_requested", user_id=admin_id)
+    report = {"committed": committed, "dry_run": dry_run, "restart": committed and restart, "results": results}
+    if error:
+        report["error"], report["partial"] = error, partial
+    return report
+
+def execute_operator_action(admin_id: int, action: Dict[str, Any]) -> Tuple[bool, str, bool]:
+    report = execute_operator_plan(admin_id, [action])
+    res = report["results"][0]
+    return res["ok"], res["msg"], report["restart"]
+
+def render_plan_report(report: Dict[str, Any]) -> str:
+    if report["dry_run"]:
+        head = "🧪 <b>Проверка (ничего не изменено):</b>"
+    elif report["committed"]:
+        head = "<b>Результаты:</b>"
+    elif report.get("partial"):
+        head = (f"⚠️ <b>План применён частично</b>: сохранено {', '.join(report['partial'])}, "
+                f"ошибка записи: {safe_html(report['error'])}. Побочные действия не выполнены:")
+    elif report.get("error"):
+        head = f"⛔ <b>План не сохранён</b> ({safe_html(report['error'])}), изменений нет:"
+    else:
+        head = "⛔ <b>План не применён</b> — исправьте ошибки, изменений нет:"
+    return head + "\n<pre>" + safe_html(json.dumps(report["results"], ensure_ascii=False, indent=2)) + "</pre>"
+
+# ================== CATALOG IMPORT / EXPORT ==================
+# Admins keep the catalog in spreadsheets: a CSV (comma or semicolon) or JSONL file
+# sent to the bot is parsed row by row straight from the download stream and
+# upserted by id, or by title for rows without an id, into a PlanBatch.
+# Download and validation finish before the product/config locks are taken, so
+# a slow URL never blocks other writes (next_order_id takes the config lock).
+# The batch is committed once, and only if no row failed validation. The export
+# is written row by row to a temp file in the same columns, so the round trip works.
+
+CATALOG_FIELDS = ("id", "type", "title", "category", "price", "description")
+CATALOG_TYPES = ("weapon", "armor", "escort")
+IMPORT_MAX_BYTES = 20 * 1024 * 1024  # Bot API download limit
+IMPORT_SHOW_ERRORS = 20
+IMPORT_SHOW_CHANGES = 15
+
+def catalog_file_format(file_name: str) -> Optional[str]:
+    name = (file_name or "").lower()
+    if name.endswith(".csv"):
+        return "csv"
+    if name.endswith((".jsonl", ".ndjson")):
+        return "jsonl"
+    return None
+
+def iter_catalog_rows(stream, fmt: str):
+    # -> (line number, row dict or None if unparsable) from a text stream
+    if fmt == "jsonl":
+        for n, line in enumerate(stream, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError:
+                row = None
+            yield n, row if isinstance(row, dict) else None
+        return
+    first = stream.readline()
+    delimiter = ";" if first.count(";") > first.count(",") else ","
+    reader = csv.DictReader(itertools.chain([first], stream), delimiter=delimiter)
+    for row in reader:
+        yield reader.line_num, {str(k).strip().lower(): v for k, v in row.items() if k is not None}
+
+def clean_catalog_row(row: Optional[Dict[str, Any]]) -> Tuple[Optional[Dict[str, Any]], str]:
+    # -> (non-empty fields, normalized; "id" if given), or (None, error)
+    if row is None:
+        return None, "не удалось разобрать строку"
+    out: Dict[str, Any] = {}
+    for k in CATALOG_FIELDS:
+        v = row.get(k)
+        if isinstance(v, str):
+            v = v.strip()
+        if v is None or v == "":
+            continue
+        out[k] = v
+    if "id" in out:
+        try:
+            out["id"] = int(out["id"])
+        except (TypeError, ValueError):
+            return None, f"id должен быть числом: {out['id']!r}"
+    if "type" in out:
+        out["type"] = str(out["type"]).lower()
+        if out["type"] not in CATALOG_TYPES:
+            return None, f"тип должен быть weapon/armor/escort: {out['type']!r}"
+    if "price" in out:
+        price = out["price"]
+        if isinstance(price, str):
+            price = price.replace(" ", "").replace(" ", "")
+        if isinstance(price, bool) or (isinstance(price, float) and not price.is_integer()):
+            return None, f"цена должна быть целым числом: {out['price']!r}"
+        try:
+            price = int(price)
+        except (TypeError, ValueError):
+            return None, f"цена должна быть целым числом: {out['price']!r}"
+        if price < 0:
+            return None, "цена должна быть >= 0"
+        out["price"] = price
+    for k in ("title", "category"):
+        if k in out:
+            out[k] = str(out[k])
+    if "description" in out:
+        out["description"] = normalize_description(str(out["description"]))
+    if "id" not in out and "title" not in out:
+        return None, "нужен id или title"
+    return out, ""
+
+def import_catalog(admin_id: int, rows, dry_run: bool = False) -> Dict[str, Any]:
+    b = PlanBatch(admin_id, dry_run)
+    report: Dict[str, Any] = {"rows": 0, "added": [], "updated": 0, "unchanged": 0,
+                              "changes": [], "errors": [], "committed": False}
+    # validation needs no store: consume `rows` before taking the locks
+    cleaned = [(line, *clean_catalog_row(row)) for line, row in rows]
+    with store_lock(PRODUCTS_FILE), store_lock(CONFIG_FILE):
+        by_title = {str(p.get("title", "")).strip().lower(): p for p in b.products()}
+        for line, fields, err in cleaned:
+            report["rows"] += 1
+            if fields is not None:
+                pid = fields.pop("id", None)
+                p = b.product(pid) if pid is not None else by_title.get(fields["title"].lower())
+                if pid is not None and p is None:
+                    err = f"товар id={pid} не найден"
+                elif p is None:
+                    missing = [k for k in ("title", "type", "price") if k not in fields]
+                    if missing:
+                        err = "для нового товара нужны: " + ", ".join(missing)
+                    else:
+                        new_id = b.add_product({"category": "", "description": "", **fields})
+                        by_title[fields["title"].lower()] = b.product(new_id)
+                        report["added"].append(new_id)
+                        continue
+                else:
+                    changes = {k: v for k, v in fields.items() if p.get(k) != v}
+                    if not changes:
+                        report["unchanged"] += 1
+                        continue
+                    for k, v in changes.items():
+                        if len(report["changes"]) < IMPORT_SHOW_CHANGES:
+                            old = p.get(k)
+                            if k == "description":
+                                old, v = preview_description(old or "", 30), preview_description(v, 30)
+                            report["changes"].append(f"#{p.get('id')} {k}: {old} → {v}")
+                    if "title" in changes:
+                        by_title.pop(str(p.get("title", "")).strip().lower(), None)
+                        by_title[changes["title"].lower()] = p
+                    b.update_product(p["id"], changes)
+                    report["updated"] += 1
+                    continue
+            report["errors"].append(f"строка {line}: {err}")
+        if not report["errors"] and not dry_run:
+            try:
+                b.commit()
+                report["committed"] = True
+            except Exception as e:
+                log_error("catalog_import_commit", e, user_id=admin_id)
+                report["errors"].append(f"не удалось сохранить: {e}")
+                report["partial"] = getattr(e, "written", [])
+    if report["committed"]:
+        log_event("catalog_import", user_id=admin_id, extra={
+            "rows": report["rows"], "added": len(report["added"]), "updated": report["updated"]
+        })
+    return report
+
+def import_catalog_from_url(admin_id: int, url: str, fmt: str) -> Dict[str, Any]:
+    # parses while downloading (the raw file is never held in memory as a whole);
+    # the download is finished before import_catalog takes any lock
+    with tg_session.get(url, stream=True, timeout=(TG_CONNECT_TIMEOUT, 60)) as resp:
+        resp.raise_for_status()
+        resp.raw.decode_content = True
+        resp.raw.auto_close = False  # TextIOWrapper reads past the end once more
+        stream = io.TextIOWrapper(resp.raw, encoding="utf-8-sig", newline="")
+        rows = list(iter_catalog_rows(stream, fmt))
+    return import_catalog(admin_id, rows)
+
+def render_import_report(report: Dict[str, Any]) -> str:
+    lines = [
+        f"📥 <b>Импорт каталога</b>: строк {report['rows']}",
+        f"➕ добавлено: <b>{len(report['added'])}</b> | ✏️ изменено: <b>{report['updated']}</b> | "
+        f"без изменений: {report['unchanged']}",
+    ]
+    if report["errors"]:
+        saved = f"сохранено только: {', '.join(report['partial'])}" if report.get("partial") else "ничего не сохранено"
+        lines.append(f"\n⛔ Ошибок: <b>{len(report['errors'])}</b> — {saved}.")
+        lines.append("<pre>" + safe_html("\n".join(report["errors"][:IMPORT_SHOW_ERRORS])) + "</pre>")
+        return "\n".join(lines)
+    if report["added"]:
+        ids = report["added"]
+        lines.append(f"Новые ID: <code>{ids[0]}</code>…<code>{ids[-1]}</code>" if len(ids) > 1 else f"Новый ID: <code>{ids[0]}</code>")
+    if report["changes"]:
+        more = report["updated"] > len(report["changes"])
+        lines.append("<pre>" + safe_html("\n".join(report["changes"]) + ("\n…" if more else "")) + "</pre>")
+    return "\n".join(lines)
+
+def export_catalog(fmt: str) -> str:
+    # -> path of a temp file with the whole catalog; the caller removes it
+    fd, path = tempfile.mkstemp(prefix="catalog-", suffix="." + fmt)
+    # BOM so Excel opens the Cyrillic CSV as UTF-8
+    with os.fdopen(fd, "w", encoding="utf-8-sig" if fmt == "csv" else "utf-8", newline="") as f:
+        if fmt == "csv":
+            w = csv.writer(f)
+            w.writerow(CATALOG_FIELDS)
+            for p in products_view():
+                w.writerow(["" if p.get(k) is None else p.get(k) for k in CATALOG_FIELDS])
+        else:
+            for p in products_view():
+                f.write(json.dumps({k: p.get(k) for k in CATALOG_FIELDS}, ensure_ascii=False) + "\n")
+    return path
+
+def send_catalog_export(chat_id: int, fmt: str):
+    path = export_catalog(fmt)
+    try:
+        with open(path, "rb") as f:
+            bot.send_document(
+                chat_id, f, visible_file_name=time.strftime(f"catalog-%Y%m%d-%H%M.{fmt}"),
+                caption=f"📤 Каталог: {len(products_view())} товаров ({fmt.upper()})"
+            )
+    finally:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
 # ================== COMMANDS ==================
 
 @bot.message_handler(commands=["start"])
@@ -1081,33 +4222,63 @@ def add_admin_handler(message):
 @cooldown_guard
 def photo_handler(message):
     uid = message.from_user.id
-    users = get_users()
-    suid = str(uid)
+    u = get_user_view(uid)
 
-    if suid not in users or not users[suid].get("awaiting_payment_order_id"):
+    if u is None or not u.get("awaiting_payment_order_id"):
         bot.reply_to(message, "Фото не привязано к заказу. Сначала оформите заказ через корзину.")
         return
 
-    order_id = users[suid]["awaiting_payment_order_id"]
-    orders = get_orders()
-    order = next((o for o in orders if o.get("id") == order_id), None)
+    order_id = u["awaiting_payment_order_id"]
+    photo = message.photo[-1]
+    reused = [o["id"] for o in orders_with_photo(photo.file_unique_id) if o.get("id") != order_id]
+    order = update_order(order_id, {
+        "payment_photo_file_id": photo.file_id,
+        "payment_photo_unique_id": photo.file_unique_id,
+        "photo_reused_in": reused,
+        "status": "awaiting_check",
+        "paid_photo_received_ts": now_ts()
+    })
     if not order:
         bot.reply_to(message, "Заказ не найден.")
-        users[suid]["awaiting_payment_order_id"] = None
-        save_users(users)
+        update_user(uid, {"awaiting_payment_order_id": None})
         return
+    if reused:
+        log_event("payment_photo_reused", user_id=uid, extra={"order_id": order_id, "other_orders": reused})
 
-    file_id = message.photo[-1].file_id
-    order["payment_photo_file_id"] = file_id
-    order["status"] = "awaiting_check"
-    order["paid_photo_received_ts"] = now_ts()
-    save_orders(orders)
-
-    users[suid]["awaiting_payment_order_id"] = None
-    save_users(users)
+    update_user(uid, {"awaiting_payment_order_id": None})
 
     bot.reply_to(message, "✅ Фото оплаты получено. Ожидайте проверки администратором.")
-    send_order_log_to_admins(order)
+    if not enqueue_prescreen(order_id):
+        send_order_log_to_admins(order)
+
+# ================== DOCUMENTS ==================
+
+@bot.message_handler(content_types=["document"])
+@cooldown_guard
+def document_handler(message):
+    uid = message.from_user.id
+    st = get_state(uid)
+    if not st or st.get("action") != "admin_catalog_import" or not is_admin(uid):
+        bot.reply_to(message, "Файл не ожидается.")
+        return
+    doc = message.document
+    fmt = catalog_file_format(doc.file_name)
+    if fmt is None:
+        bot.reply_to(message, "❌ Нужен файл .csv или .jsonl. Повторите или «Отмена».")
+        return
+    if (doc.file_size or 0) > IMPORT_MAX_BYTES:
+        bot.reply_to(message, "❌ Файл больше 20 МБ.")
+        return
+    try:
+        file_info = bot.get_file(doc.file_id)
+        report = import_catalog_from_url(uid, telegram_file_url(file_info.file_path), fmt)
+    except Exception as e:
+        log_error("catalog_import", e, user_id=uid)
+        bot.reply_to(message, "❌ Не удалось загрузить файл. Повторите или «Отмена».")
+        return
+    if report["committed"]:
+        clear_state(uid)
+    bot.send_message(message.chat.id, render_import_report(report))
 
 # ================== TEXT ==================
 
@@ -1144,7 +4315,7 @@ def text_handler(message):
         show_cart(message.chat.id, uid)
         return
     if text == "📞 Оплата":
-        cfg = get_config()
+        cfg = config_view()
         send_clean(
             message.chat.id,
             f"📞 Номер для оплаты: <b>{safe_html(cfg.get('payment_phone','не указан'))}</b>\n\n"
@@ -1177,15 +4348,16 @@ def text_handler(message):
         set_state(uid, "broadcast")
         return
     if text == "📊 Статистика" and is_admin(uid):
-        users = get_users()
-        orders = get_orders()
-        products = get_products()
+        users = users_view()
+        orders = orders_view()
+        products = products_view()
         send_clean(
             message.chat.id,
             f"📊 <b>Статистика</b>\n\n"
             f"👥 Пользователей: <b>{len(users)}</b>\n"
-            f"📦 Заказов: <b>{len(orders)}</b>\n"
-            f"🛒 Товаров: <b>{len(products)}</b>",
+            f"📦 Заказов: <b>{len(orders)}</b> (ждут проверки: <b>{len(orders_by_status('awaiting_check'))}</b>)\n"
+            f"🛒 Товаров: <b>{len(products)}</b>\n\n"
+            + runtime_stats_text(),
             reply_markup=admin_main_menu()
         )
         return
@@ -1193,7 +4365,7 @@ def text_handler(message):
         send_clean(message.chat.id, "📜 Выберите период:", reply_markup=admin_logs_menu())
         return
     if text == "👥 Админы" and is_admin(uid):
-        users = get_users()
+        users = users_view()
         admins = [(k, v) for k, v in users.items() if v.get("is_admin")]
         if admins:
             lines = ["👥 <b>Админы</b>:"]
@@ -1227,7 +4399,7 @@ def handle_state_text(message, st):
     data = st.get("data", {})
 
     if action == "admin_login":
-        cfg = get_config()
+        cfg = config_view()
         if text == cfg.get("admin_password", "1234"):
             update_user(uid, {"is_admin": True})
             clear_state(uid)
@@ -1237,16 +4409,9 @@ def handle_state_text(message, st):
         return
 
     if action == "broadcast":
-        users = get_users()
-        cnt = 0
-        for u in list(users.keys()):
-            try:
-                bot.send_message(int(u), text)
-                cnt += 1
-            except Exception:
-                pass
+        job = start_broadcast(uid, chat_id, text)
         clear_state(uid)
-        send_clean(chat_id, f"✅ Отправлено: {cnt}", reply_markup=admin_main_menu())
+        send_clean(chat_id, f"✅ Рассылка #{job['id']} запущена: {job['total']} получателей.", reply_markup=admin_main_menu())
         return
 
     if action == "user_add_to_cart_by_id":
@@ -1312,25 +4477,19 @@ def handle_state_text(message, st):
 
     # admin settings
     if action == "change_admin_password":
-        cfg = get_config()
-        cfg["admin_password"] = text
-        save_config(cfg)
+        update_config({"admin_password": text})
         clear_state(uid)
         send_clean(chat_id, "✅ Пароль обновлён.", reply_markup=admin_main_menu())
         return
 
     if action == "change_payment_phone":
-        cfg = get_config()
-        cfg["payment_phone"] = text
-        save_config(cfg)
+        update_config({"payment_phone": text})
         clear_state(uid)
         send_clean(chat_id, "✅ Номер оплаты обновлён.", reply_markup=admin_main_menu())
         return
 
     if action == "change_manager_username":
-        cfg = get_config()
-        cfg["order_manager_username"] = text.replace("@", "").strip()
-        save_config(cfg)
+        update_config({"order_manager_username": text.replace("@", "").strip()})
         clear_state(uid)
         send_clean(chat_id, "✅ Username поддержки обновлён.", reply_markup=admin_main_menu())
         return
@@ -1342,11 +4501,7 @@ def handle_state_text(message, st):
         except Exception:
             bot.send_message(chat_id, "❌ Введите корректный User ID числом.")
             return
-        users = get_users()
-        uid_str = str(new_id)
-        users.setdefault(uid_str, {"username": "", "cart": [], "is_admin": False, "awaiting_payment_order_id": None})
-        users[uid_str]["is_admin"] = True
-        save_users(users)
+        update_user(new_id, {"is_admin": True})
         clear_state(uid)
         send_clean(chat_id, f"✅ Пользователь <code>{new_id}</code> теперь админ.", reply_markup=admin_main_menu())
         return
@@ -1357,17 +4512,18 @@ def handle_state_text(message, st):
         except Exception:
             bot.send_message(chat_id, "❌ Введите корректный User ID числом.")
             return
-        users = get_users()
-        uid_str = str(rem_id)
-        if uid_str in users and users[uid_str].get("is_admin"):
-            users[uid_str]["is_admin"] = False
-            save_users(users)
+        if is_admin(rem_id):
+            update_user(rem_id, {"is_admin": False})
             clear_state(uid)
             send_clean(chat_id, f"✅ Админ-права сняты с <code>{rem_id}</code>.", reply_markup=admin_main_menu())
         else:
             bot.send_message(chat_id, "❌ Этот ID не админ или не найден.")
         return
 
+    if action == "admin_catalog_import":
+        bot.send_message(chat_id, "📎 Отправьте файл .csv или .jsonl документом (или «Отмена»).")
+        return
+
     # admin add product with description
     if action == "admin_add_product" and step == 0:
         if len(text) < 2:
@@ -1409,17 +4565,13 @@ def handle_state_text(message, st):
 
     if action == "admin_add_product" and step == 4:
         desc = "" if text.strip() == "-" else normalize_description(text)
-        products = get_products()
-        pid = generate_product_id(products)
-        products.append({
-            "id": pid,
+        pid = add_product({
             "title": data["title"],
             "type": data["type"],
             "category": data.get("category", ""),
             "price": int(data["price"]),
             "description": desc
         })
-        save_products(products)
         clear_state(uid)
         send_clean(chat_id, f"✅ Товар добавлен. ID: <code>{pid}</code>", reply_markup=admin_main_menu())
         return
@@ -1455,17 +4607,13 @@ def handle_state_text(message, st):
 
     if action == "admin_add_escort" and step == 3:
         desc = "" if text.strip() == "-" else normalize_description(text)
-        products = get_products()
-        pid = generate_product_id(products)
-        products.append({
-            "id": pid,
+        pid = add_product({
             "title": data["title"],
             "type": "escort",
             "category": data.get("category", ""),
             "price": int(data["price"]),
             "description": desc
         })
-        save_products(products)
         clear_state(uid)
         send_clean(chat_id, f"✅ Сопровождение добавлено. ID: <code>{pid}</code>", reply_markup=admin_main_menu())
         return
@@ -1477,13 +4625,11 @@ def handle_state_text(message, st):
         except Exception:
             bot.send_message(chat_id, "❌ Введите ID числом:")
             return
-        products = get_products()
-        p = next((x for x in products if x.get("id") == pid and x.get("type") in ("weapon","armor")), None)
-        if not p:
+        p = find_product_by_id(pid)
+        if not p or p.get("type") not in ("weapon","armor"):
             bot.send_message(chat_id, "❌ Товар (weapon/armor) не найден.")
             return
-        products = [x for x in products if x.get("id") != pid]
-        save_products(products)
+        remove_product(pid)
         clear_state(uid)
         send_clean(chat_id, f"✅ Товар ID <code>{pid}</code> удалён.", reply_markup=admin_main_menu())
         return
@@ -1494,13 +4640,11 @@ def handle_state_text(message, st):
         except Exception:
             bot.send_message(chat_id, "❌ Введите ID числом:")
             return
-        products = get_products()
-        p = next((x for x in products if x.get("id") == pid and x.get("type") == "escort"), None)
-        if not p:
+        p = find_product_by_id(pid)
+        if not p or p.get("type") != "escort":
             bot.send_message(chat_id, "❌ Сопровождение не найдено.")
             return
-        products = [x for x in products if x.get("id") != pid]
-        save_products(products)
+        remove_product(pid)
         clear_state(uid)
         send_clean(chat_id, f"✅ Сопровождение ID <code>{pid}</code> удалено.", reply_markup=admin_main_menu())
         return
@@ -1529,14 +4673,10 @@ def handle_state_text(message, st):
             bot.send_message(chat_id, "❌ Цена должна быть числом >=0. Повторите:")
             return
         pid = int(data["pid"])
-        products = get_products()
-        p = next((x for x in products if x.get("id") == pid), None)
-        if not p:
+        if not update_product(pid, {"price": price}):
             bot.send_message(chat_id, "❌ Товар не найден.")
             clear_state(uid)
             return
-        p["price"] = price
-        save_products(products)
         clear_state(uid)
         send_clean(chat_id, f"✅ Цена обновлена для ID <code>{pid}</code>: <b>{price} TMT</b>", reply_markup=admin_main_menu())
         return
@@ -1565,14 +4705,10 @@ def handle_state_text(message, st):
             bot.send_message(chat_id, "❌ Цена должна быть числом >=0. Повторите:")
             return
         pid = int(data["pid"])
-        products = get_products()
-        p = next((x for x in products if x.get("id") == pid), None)
-        if not p:
+        if not update_product(pid, {"price": price}):
             bot.send_message(chat_id, "❌ Товар не найден.")
             clear_state(uid)
             return
-        p["price"] = price
-        save_products(products)
         clear_state(uid)
         send_clean(chat_id, f"✅ Цена сопровождения обновлена для ID <code>{pid}</code>: <b>{price} TMT</b>", reply_markup=admin_main_menu())
         return
@@ -1595,14 +4731,11 @@ def handle_state_text(message, st):
 
     if action == "admin_change_desc" and step == 1:
         pid = int(data["pid"])
-        products = get_products()
-        p = next((x for x in products if x.get("id") == pid), None)
-        if not p:
+        desc = "" if text.strip() == "-" else normalize_description(text)
+        if not update_product(pid, {"description": desc}):
             bot.send_message(chat_id, "❌ Товар не найден.")
             clear_state(uid)
             return
-        p["description"] = "" if text.strip() == "-" else normalize_description(text)
-        save_products(products)
         clear_state(uid)
         send_clean(chat_id, f"✅ Описание обновлено для ID <code>{pid}</code>.", reply_markup=admin_main_menu())
         return
@@ -1618,8 +4751,7 @@ def handle_state_text(message, st):
 
     if action == "order_send_message":
         oid = int(data.get("order_id"))
-        orders = get_orders()
-        o = next((x for x in orders if x.get("id") == oid), None)
+        o = get_order(oid)
         if not o:
             bot.send_message(chat_id, "Заказ не найден.")
             clear_state(uid)
@@ -1634,35 +4766,15 @@ def handle_state_text(message, st):
 
     # AI operator
     if action == "ai_operator_full":
+        if AI_STREAMING:
+            ai_operator_plan_streamed(uid, chat_id, text)
+            return
         raw, obj = ai_operator_plan(uid, text)
         if not obj:
             bot.send_message(chat_id, "Не удалось получить план. Попробуйте иначе.")
             return
-
-        actions = obj.get("actions", [])
-        summary = obj.get("summary", "")
-        risk = (obj.get("risk") or "medium").lower()
-
-        if not actions:
-            bot.send_message(chat_id, f"Нужно уточнение:\n{safe_html(summary)}")
-            return
-
-        key = short_hash({"admin_id": uid, "ts": now_ts(), "actions": actions})
-        pending_ai_actions[key] = {"admin_id": uid, "created_ts": now_ts(), "actions": actions, "summary": summary, "risk": risk}
-
-        lines = ["🧰 <b>План</b>"]
-        if risk == "high":
-            lines.append("⚠️ <b>Опасно</b>: проверьте внимательно.")
-        if summary:
-            lines.append(f"\n<b>Summary:</b> {safe_html(summary)}")
-        lines.append("\n<b>Actions:</b>")
-        for i, a in enumerate(actions, 1):
-            lines.append(f"{i}) <code>{a.get('type')}</code> {safe_html(json.dumps(a.get('params', {}), ensure_ascii=False))}")
-
-        kb = types.InlineKeyboardMarkup()
-        kb.add(types.InlineKeyboardButton("✅ Подтвердить", callback_data=f"ai_apply_{key}"))
-        kb.add(types.InlineKeyboardButton("❌ Отказаться", callback_data=f"ai_deny_{key}"))
-        bot.send_message(chat_id, "\n".join(lines), reply_markup=kb)
+        plan_text, kb = render_ai_plan(uid, obj)
+        bot.send_message(chat_id, plan_text, reply_markup=kb)
         return
 
     bot.send_message(chat_id, "Неизвестное состояние. Напишите «Отмена».")
@@ -1670,11 +4782,9 @@ def handle_state_text(message, st):
 # ================== CALLBACKS ==================
 
 def admin_list_products_text(filter_type: Optional[str] = None) -> str:
-    products = get_products()
+    products = paginate_products(filter_type) if filter_type else products_view()
     lines = ["<b>Товары:</b>"]
     for p in products:
-        if filter_type and p.get("type") != filter_type:
-            continue
         lines.append(f"• ID <code>{p.get('id')}</code> | {safe_html(p.get('title',''))} | {p.get('type')} | {p.get('price')} TMT")
     if len(lines) == 1:
         return "<b>Товары:</b>\n(пусто)"
@@ -1695,7 +4805,7 @@ def callback_handler(call):
         return
 
     if data == "open_cart":
-        show_cart(chat_id, uid)
+        show_cart(chat_id, uid, call.message.message_id)
         bot.answer_callback_query(call.id)
         return
 
@@ -1714,9 +4824,8 @@ def callback_handler(call):
         if ptype not in ("weapon", "armor", "escort"):
             bot.answer_callback_query(call.id, "Ошибка.", show_alert=True)
             return
-        text, pages = render_products_list_text(ptype, page)
-        kb = products_list_kb(ptype, page, pages)
-        send_clean(chat_id, text, reply_markup=kb)
+        text, kb = catalog_page(ptype, page)
+        send_clean(chat_id, text, reply_markup=kb, message_id=call.message.message_id)
         bot.answer_callback_query(call.id)
         return
 
@@ -1738,10 +4847,8 @@ def callback_handler(call):
             bot.answer_callback_query(call.id, "Пусто.", show_alert=True)
             return
         idx = find_index_by_id(items, pid)
-        p = items[idx]
-        text = render_product_page_text(p, idx, len(items), ptype)
-        kb = product_page_kb(ptype, idx, len(items), int(p.get("id")))
-        send_clean(chat_id, text, reply_markup=kb)
+        text, kb = product_page(ptype, idx)
+        send_clean(chat_id, text, reply_markup=kb, message_id=call.message.message_id)
         bot.answer_callback_query(call.id)
         return
 
@@ -1762,10 +4869,8 @@ def callback_handler(call):
             bot.answer_callback_query(call.id, "Пусто.", show_alert=True)
             return
         idx = max(0, min(idx, len(items) - 1))
-        p = items[idx]
-        text = render_product_page_text(p, idx, len(items), ptype)
-        kb = product_page_kb(ptype, idx, len(items), int(p.get("id")))
-        send_clean(chat_id, text, reply_markup=kb)
+        text, kb = product_page(ptype, idx)
+        send_clean(chat_id, text, reply_markup=kb, message_id=call.message.message_id)
         bot.answer_callback_query(call.id)
         return
 
@@ -1812,14 +4917,9 @@ def callback_handler(call):
             return
 
         clear_cart(uid)
+        update_user(uid, {"awaiting_payment_order_id": order["id"]})
 
-        users = get_users()
-        suid = str(uid)
-        users.setdefault(suid, {"username": username or "", "cart": [], "is_admin": False, "awaiting_payment_order_id": None})
-        users[suid]["awaiting_payment_order_id"] = order["id"]
-        save_users(users)
-
-        cfg = get_config()
+        cfg = config_view()
         send_clean(
             chat_id,
             "✅ <b>Заказ оформлен!</b>\n\n"
@@ -1896,6 +4996,22 @@ def callback_handler(call):
         bot.answer_callback_query(call.id)
         return
 
+    if data == "admin_catalog_import" and is_admin(uid):
+        bot.answer_callback_query(call.id)
+        bot.send_message(
+            chat_id,
+            "📥 Отправьте файл <b>.csv</b> или <b>.jsonl</b> (или «Отмена»).\n"
+            f"Колонки: <code>{', '.join(CATALOG_FIELDS)}</code>\n"
+            "Строки с id обновляют товар, без id — ищутся по названию или добавляются."
+        )
+        set_state(uid, "admin_catalog_import", 0, {})
+        return
+
+    if data.startswith("admin_catalog_export_") and is_admin(uid):
+        bot.answer_callback_query(call.id, "Готовлю файл...")
+        send_catalog_export(chat_id, "jsonl" if data.endswith("jsonl") else "csv")
+        return
+
     if data == "admin_add_product" and is_admin(uid):
         bot.answer_callback_query(call.id)
         bot.send_message(chat_id, "Введите название товара (или «Отмена»):")
@@ -1989,13 +5105,13 @@ def callback_handler(call):
     if data.startswith("admin_logs_") and is_admin(uid):
         now = now_ts()
         if data == "admin_logs_1h":
-            logs = [l for l in get_logs() if now - 3600 <= int(l.get("timestamp", 0)) <= now]
+            logs = query_logs(now - 3600, limit=50)
         elif data == "admin_logs_24h":
-            logs = [l for l in get_logs() if now - 86400 <= int(l.get("timestamp", 0)) <= now]
+            logs = query_logs(now - 86400, limit=50)
         elif data == "admin_logs_7d":
-            logs = [l for l in get_logs() if now - 7*86400 <= int(l.get("timestamp", 0)) <= now]
+            logs = query_logs(now - 7*86400, limit=50)
         else:
-            logs = get_logs()
+            logs = query_logs(limit=50)
 
         if not logs:
             bot.send_message(chat_id, "Логи отсутствуют.")
@@ -2008,6 +5124,18 @@ def callback_handler(call):
         bot.answer_callback_query(call.id)
         return
 
+    if data.startswith("bc_cancel_") and is_admin(uid):
+        try:
+            job_id = int(data.split("_")[-1])
+        except Exception:
+            bot.answer_callback_query(call.id, "Ошибка.", show_alert=True)
+            return
+        if cancel_broadcast(job_id):
+            bot.answer_callback_query(call.id, "Останавливаю рассылку...")
+        else:
+            bot.answer_callback_query(call.id, "Рассылка уже завершена.", show_alert=True)
+        return
+
     # AI panel
     if data == "ai_info_scout" and is_admin(uid):
         bot.answer_callback_query(call.id)
@@ -2020,7 +5148,7 @@ def callback_handler(call):
         set_state(uid, "ai_operator_full", 0, {})
         return
 
-    if data.startswith("ai_apply_") or data.startswith("ai_deny_"):
+    if data.startswith(("ai_apply_", "ai_dry_", "ai_deny_")):
         key = data.split("_", 2)[-1]
         rec = pending_ai_actions.get(key)
         if not rec:
@@ -2030,24 +5158,26 @@ def callback_handler(call):
             bot.answer_callback_query(call.id, "Это не ваш план.", show_alert=True)
             return
 
+        if data.startswith("ai_dry_"):
+            bot.answer_callback_query(call.id, "Проверяю...")
+            bot.send_message(chat_id, render_plan_report(execute_operator_plan(uid, rec.get("actions", []), dry_run=True)))
+            return
+
         if data.startswith("ai_deny_"):
             pending_ai_actions.pop(key, None)
             bot.answer_callback_query(call.id, "Отклонено.")
             bot.send_message(chat_id, "❌ План отклонён.")
             return
 
+        # claim the plan first so a double click cannot apply it twice
+        if pending_ai_actions.pop(key) is None:
+            bot.answer_callback_query(call.id, "План устарел.", show_alert=True)
+            return
         bot.answer_callback_query(call.id, "Выполняю...")
-        results = []
-        restart_needed = False
-        for a in rec.get("actions", []):
-            ok, msg, r = execute_operator_action(uid, a)
-            results.append({"ok": ok, "type": a.get("type"), "msg": msg})
-            restart_needed = restart_needed or r
-
-        pending_ai_actions.pop(key, None)
-        bot.send_message(chat_id, "<b>Результаты:</b>\n<pre>" + safe_html(json.dumps(results, ensure_ascii=False, indent=2)) + "</pre>")
+        report = execute_operator_plan(uid, rec.get("actions", []))
+        bot.send_message(chat_id, render_plan_report(report))
 
-        if restart_needed:
+        if report["restart"]:
             bot.send_message(chat_id, "🔄 Перезапуск через 1 секунду...")
             time.sleep(1)
             restart_self()
@@ -2055,56 +5185,37 @@ def callback_handler(call):
 
     # payment check
     if data.startswith("check_payment_") or data.startswith("check_payment_deep_"):
-        deep = data.startswith("check_payment_deep_")
-        try:
-            order_id = int(data.split("_")[-1])
-        except Exception:
-            bot.answer_callback_query(call.id, "Некорректный ID.", show_alert=True)
-            return
-
-        orders = get_orders()
-        order = next((o for o in orders if o.get("id") == order_id), None)
-        if not order:
-            bot.answer_callback_query(call.id, "Заказ не найден.", show_alert=True)
-            return
-        if not order.get("payment_photo_file_id"):
-            bot.answer_callback_query(call.id, "Фото отсутствует.", show_alert=True)
-            return
-
-        try:
-            file_info = bot.get_file(order["payment_photo_file_id"])
-            file_url = f"https://api.telegram.org/file/bot{TOKEN}/{file_info.file_path}"
-        except Exception:
-            bot.answer_callback_query(call.id, "Ошибка получения фото.", show_alert=True)
+        order, deep, err = payment_check_target(data)
+        if err:
+            bot.answer_callback_query(call.id, err, show_alert=True)
             return
+        order_id = order["id"]
 
-        bot.answer_callback_query(call.id, "ИИ анализирует...")
+        verdict = cached_payment_verdict(order, deep)
+        if verdict is None:
+            try:
+                file_info = bot.get_file(order["payment_photo_file_id"])
+                file_url = telegram_file_url(file_info.file_path)
+            except Exception:
+                bot.answer_callback_query(call.id, "Ошибка получения фото.", show_alert=True)
+                return
 
-        kb = types.InlineKeyboardMarkup()
-        if order.get("username"):
-            kb.add(types.InlineKeyboardButton("💬 Перейти в чат", url=user_chat_url(order["username"])))
-        kb.add(types.InlineKeyboardButton("✉️ Отправить сообщение", callback_data=f"order_msg_{order_id}"))
-        kb.add(types.InlineKeyboardButton("❌ Заказ отклонён", callback_data=f"order_reject_{order_id}"))
+        bot.answer_callback_query(call.id, "ИИ анализирует..." if verdict is None else "Уже проверено.")
 
+        caption, kb = payment_check_card(order, deep)
         try:
-            bot.send_photo(
-                chat_id,
-                order["payment_photo_file_id"],
-                caption=(
-                    f"📦 Заказ <b>#{order_id}</b>\n"
-                    f"Пользователь: <code>{order.get('user_id')}</code> @{order.get('username') or 'нет'}\n"
-                    f"Сумма: <b>{order.get('total')} TMT</b>\n"
-                    f"Режим: <b>{'подробный' if deep else 'обычный'}</b>"
-                ),
-                reply_markup=kb
-            )
+            bot.send_photo(chat_id, order["payment_photo_file_id"], caption=caption, reply_markup=kb)
         except Exception:
             pass
 
-        verdict = ai_check_payment_image(order, file_url, deep=deep)
-        order["ai_verdict_last"] = verdict
-        order["ai_verdict_last_ts"] = now_ts()
-        save_orders(orders)
+        if verdict is None and deep and AI_STREAMING:
+            verdict = payment_verdict_streamed(order, file_url, chat_id, deep)
+            update_order(order_id, {"ai_verdict_last": verdict, "ai_verdict_last_ts": now_ts()})
+            return
+        if verdict is None:
+            verdict = payment_verdict(order, file_url, deep=deep)
+        # re-read under the lock: the order may have changed during the AI call
+        update_order(order_id, {"ai_verdict_last": verdict, "ai_verdict_last_ts": now_ts()})
 
         bot.send_message(chat_id, f"🧠 <b>Проверка по заказу #{order_id}</b>:\n\n{verdict}")
         return
@@ -2133,10 +5244,506 @@ def callback_handler(call):
 
     bot.answer_callback_query(call.id)
 
+# ================== WEBHOOK ==================
+# `python bot.py --webhook`: Telegram POSTs updates to WEBHOOK_PATH; each request
+# is checked against the secret token header and queued into the same dispatcher
+# as polling. A full backlog answers 503 so Telegram retries later. Several
+# instances can sit behind one load balancer. Local test:
+#   curl -H "X-Telegram-Bot-Api-Secret-Token: $WEBHOOK_SECRET" -d @update.json localhost:8443/webhook
+
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL", "").strip().rstrip("/")  # public https base; empty = don't call setWebhook
+WEBHOOK_HOST = os.environ.get("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.environ.get("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET", "").strip() or secrets.token_urlsafe(32)
+WEBHOOK_MAX_BODY = 1024 * 1024
+WEBHOOK_QUEUE_TIMEOUT = 5.0
+
+def _webhook_reply(start_response, status: str, body: str = "", headers: Optional[List[Tuple[str, str]]] = None):
+    data = body.encode("utf-8")
+    start_response(status, [("Content-Type", "text/plain; charset=utf-8"), ("Content-Length", str(len(data)))] + (headers or []))
+    return [data]
+
+def webhook_app(environ, start_response):
+    path = environ.get("PATH_INFO", "")
+    method = environ.get("REQUEST_METHOD", "GET")
+    if path == "/healthz" and method == "GET":
+        return _webhook_reply(start_response, "200 OK", json.dumps(dispatcher.stats() if dispatcher else {}))
+    if path != WEBHOOK_PATH:
+        return _webhook_reply(start_response, "404 Not Found")
+    if method != "POST":
+        return _webhook_reply(start_response, "405 Method Not Allowed", headers=[("Allow", "POST")])
+    token = environ.get("HTTP_X_TELEGRAM_BOT_API_SECRET_TOKEN", "")
+    if not hmac.compare_digest(token.encode("utf-8"), WEBHOOK_SECRET.encode("utf-8")):
+        return _webhook_reply(start_response, "403 Forbidden")
+    try:
+        length = int(environ.get("CONTENT_LENGTH") or 0)
+    except ValueError:
+        length = 0
+    if length <= 0 or length > WEBHOOK_MAX_BODY:
+        return _webhook_reply(start_response, "413 Payload Too Large" if length > 0 else "400 Bad Request")
+    try:
+        update = types.Update.de_json(environ["wsgi.input"].read(length).decode("utf-8"))
+    except Exception as e:
+        log_error("webhook_parse", e)
+        return _webhook_reply(start_response, "400 Bad Request")
+    if not dispatcher.submit(update_key(update), update, timeout=WEBHOOK_QUEUE_TIMEOUT):
+        return _webhook_reply(start_response, "503 Service Unavailable", headers=[("Retry-After", "5")])
+    return _webhook_reply(start_response, "200 OK", "ok")
+
+class _WebhookServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+class _QuietHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+def make_webhook_server(host: str = WEBHOOK_HOST, port: int = WEBHOOK_PORT) -> WSGIServer:
+    start_dispatcher()
+    return make_server(host, port, webhook_app, server_class=_WebhookServer, handler_class=_QuietHandler)
+
+def run_webhook():
+    server = make_webhook_server()
+    if WEBHOOK_URL:
+        bot.remove_webhook()
+        bot.set_webhook(
+            url=WEBHOOK_URL + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            max_connections=max(BOT_WORKERS, 40),
+        )
+    print(f"webhook: listening on {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+    try:
+        server.serve_forever()
+    finally:
+        dispatcher.drain(10)
+        flush_pending_writes()
+
+# ================== CLUSTER ==================
+# `python bot.py --cluster N`: the ingress process (polling or --webhook) only
+# writes updates into the update_queue table of STATE_DB_FILE, sharded by user
+# id, and supervises N `--worker K --shards N` processes. Worker K consumes
+# shard K in order, so one user's updates always land on the same worker.
+# The worker keeps reading past rows still in flight (the dispatcher keeps each
+# user's updates in order), so a slow handler only holds up its own user.
+# Delivery is at-least-once: each row is deleted once its update is handled.
+# Jobs that must run once (broadcasts, log compaction) take a lease first.
+
+CLUSTER_SHARD: Optional[int] = None  # set in worker processes
+CLUSTER_SHARDS = 1
+CLUSTER_MODE = False
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+CLUSTER_QUEUE_BATCH = 100
+CLUSTER_POLL_INTERVAL = 0.02
+MAINTENANCE_INTERVAL = 60
+
+cluster_control = StateStore("cluster", ttl=300, persistent=True)
+
+def owns_user(user_id) -> bool:
+    # per-user background work belongs to the worker that owns the user's shard
+    if CLUSTER_SHARD is None:
+        return True
+    try:
+        return int(user_id) % CLUSTER_SHARDS == CLUSTER_SHARD
+    except (TypeError, ValueError):
+        return CLUSTER_SHARD == 0
+
+def acquire_lease(name: str, ttl: float) -> bool:
+    # take or renew a named lease; always granted to a single process
+    if not CLUSTER_MODE:
+        return True
+    conn = state_conn()
+    now = time.time()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        row = conn.execute("SELECT owner, expires FROM leases WHERE name = ?", (name,)).fetchone()
+        if row and row[0] != WORKER_ID and row[1] > now:
+            conn.execute("ROLLBACK")
+            return False
+        conn.execute("INSERT OR REPLACE INTO leases(name, owner, expires) VALUES (?, ?, ?)", (name, WORKER_ID, now + ttl))
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    return True
+
+def release_lease(name: str):
+    if CLUSTER_MODE:
+        state_conn().execute("DELETE FROM leases WHERE name = ? AND owner = ?", (name, WORKER_ID))
+
+def run_maintenance():
+    resume_broadcasts()  # picks up jobs whose worker died; each job has its own lease
+    if not acquire_lease("maintenance", MAINTENANCE_INTERVAL * 2):
+        return
+    if STORAGE_BACKEND == "sqlite":
+        sql_compact_logs()
+    for store in (states, pending_ai_actions, last_clean_message):
+        store.sweep()
+
+def _maintenance_loop():
+    while True:
+        time.sleep(MAINTENANCE_INTERVAL)
+        safe_execute("maintenance", None, None, run_maintenance)
+
+def start_maintenance():
+    threading.Thread(target=_maintenance_loop, name="maintenance", daemon=True).start()
+
+def update_to_json(update: types.Update) -> str:
+    # telebot keeps the raw dict of every top-level object in `.json`
+    raw = {"update_id": update.update_id}
+    for name, value in vars(update).items():
+        if isinstance(getattr(value, "json", None), dict):
+            raw[name] = value.json
+    return json.dumps(raw, ensure_ascii=False)
+
+class SharedUpdateQueue:
+    # dispatcher stand-in for the ingress: same submit/drain/stats interface
+    def __init__(self, shards: int, max_pending: int = BOT_MAX_PENDING):
+        self.shards = shards
+        self.max_pending = max_pending
+
+    def shard_of(self, key) -> int:
+        if isinstance(key, tuple):
+            key = key[-1]
+        return int(key) % self.shards
+
+    def depth(self) -> int:
+        return state_conn().execute("SELECT COUNT(*) FROM update_queue").fetchone()[0]
+
+    def submit(self, key, item, timeout: Optional[float] = None) -> bool:
+        deadline = None if timeout is None else time.time() + timeout
+        while self.depth() >= self.max_pending:
+            if deadline is not None and time.time() >= deadline:
+                return False
+            time.sleep(0.05)
+        state_conn().execute(
+            "INSERT INTO update_queue(shard, payload) VALUES (?, ?)", (self.shard_of(key), update_to_json(item))
+        )
+        return True
+
+    def drain(self, timeout: Optional[float] = None) -> bool:
+        deadline = None if timeout is None else time.time() + timeout
+        while self.depth():
+            if deadline is not None and time.time() >= deadline:
+                return False
+            time.sleep(0.05)
+        return True
+
+    def stats(self) -> Dict[str, int]:
+        return {"queue_depth": self.depth(), "active": 0, "users_queued": 0, "workers": self.shards}
+
+def _process_queued(item: Tuple[int, types.Update]):
+    # (queue seq, update): the row goes once its update is handled, so a crash only
+    # replays updates that had not finished
+    seq, update = item
+    try:
+        _process_one_update(update)
+    finally:
+        state_conn().execute("DELETE FROM update_queue WHERE seq = ?", (seq,))
+
+def pump_shard(shard: int, after: int = 0) -> int:
+    # hands the shard's rows queued after seq `after` to the dispatcher (blocking
+    # while its backlog is full) -> the last seq read
+    rows = state_conn().execute(
+        "SELECT seq, payload FROM update_queue WHERE shard = ? AND seq > ? ORDER BY seq LIMIT ?",
+        (shard, after, CLUSTER_QUEUE_BATCH)
+    ).fetchall()
+    for seq, payload in rows:
+        after = seq
+        try:
+            update = types.Update.de_json(payload)
+        except Exception as e:
+            log_error("cluster_parse", e)
+            state_conn().execute("DELETE FROM update_queue WHERE seq = ?", (seq,))
+            continue
+        dispatcher.submit(update_key(update), (seq, update))
+    return after
+
+def run_worker(shard: int, shards: int):
+    global CLUSTER_SHARD, CLUSTER_SHARDS, CLUSTER_MODE
+    CLUSTER_SHARD, CLUSTER_SHARDS, CLUSTER_MODE = shard, shards, True
+    start_dispatcher(process=_process_queued)
+    resume_broadcasts()
+    resume_prescreens()
+    start_maintenance()
+    last = 0
+    idle = CLUSTER_POLL_INTERVAL
+    while True:
+        seq = pump_shard(shard, last)
+        if seq == last:
+            time.sleep(idle)
+            idle = min(idle * 2, 0.5)
+            continue
+        idle = CLUSTER_POLL_INTERVAL
+        last = seq
+
+def _spawn_worker(shard: int, shards: int) -> subprocess.Popen:
+    script = os.path.abspath(__file__)
+    return subprocess.Popen([sys.executable, script, "--worker", str(shard), "--shards", str(shards)])
+
+def run_cluster(shards: int, webhook: bool = False):
+    global dispatcher, CLUSTER_MODE
+    # every store the workers write (config and broadcasts included) must be SQLite:
+    # JSON files only have thread-level locks
+    if STORAGE_BACKEND != "sqlite" or STATE_BACKEND != "sqlite":
+        raise RuntimeError("--cluster needs STORAGE_BACKEND=sqlite and STATE_BACKEND=sqlite")
+    CLUSTER_MODE = True
+    dispatcher = SharedUpdateQueue(shards)
+    bot.process_new_updates = dispatch_updates
+    workers = [_spawn_worker(k, shards) for k in range(shards)]
+
+    def stop_workers():
+        for p in workers:
+            if p.poll() is None:
+                p.terminate()
+        for p in workers:
+            try:
+                p.wait(10)
+            except subprocess.TimeoutExpired:
+                p.kill()
+
+    def supervise():
+        while True:
+            time.sleep(1)
+            if cluster_control.pop("restart") is not None:
+                log_event("bot_restart", extra={"argv": sys.argv})
+                stop_workers()
+                os.execv(sys.executable, [sys.executable, os.path.abspath(__file__)] + sys.argv[1:])
+            for k, p in enumerate(workers):
+                if p.poll() is not None:
+                    log_event("cluster_worker_restart", extra={"shard": k, "code": p.returncode})
+                    workers[k] = _spawn_worker(k, shards)
+
+    atexit.register(stop_workers)
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    threading.Thread(target=supervise, name="cluster-supervisor", daemon=True).start()
+    if webhook:
+        run_webhook()
+        return
+    while True:
+        try:
+            bot.infinity_polling(timeout=60, long_polling_timeout=60)
+        except Exception as e:
+            log_error("infinity_polling", e)
+            time.sleep(2)
+
+# ================== ASYNC RUNTIME ==================
+# Alternative entry point: python bot.py --async
+# AsyncTeleBot does the polling and the Groq calls go through AsyncGroq on the event
+# loop, so hundreds of admins/users waiting on the model cost coroutines, not threads.
+# Everything else reuses the regular (sync, cache-backed) handlers on a small pool.
+
+ASYNC_SYNC_WORKERS = int(os.environ.get("ASYNC_SYNC_WORKERS", "8"))
+ASYNC_MAX_INFLIGHT = int(os.environ.get("ASYNC_MAX_INFLIGHT", "500"))
+
+async_bot = None
+_async_pool: Optional[ThreadPoolExecutor] = None
+_async_inflight: Optional[asyncio.Semaphore] = None
+_async_user_locks: Dict[Any, list] = {}  # key -> [asyncio.Lock, holders+waiters]
+
+async def arun_storage(fn, *args, **kwargs):
+    # storage and other blocking helpers, off the event loop
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_async_pool, functools.partial(fn, *args, **kwargs))
+
+async def aupdate_order(order_id: int, fields: Dict[str, Any]):
+    return await arun_storage(update_order, order_id, fields)
+
+async def ai_check_payment_image_async(order: Dict[str, Any], file_url: str, deep: bool = False) -> str:
+    try:
+        completion = await llm.acomplete(**payment_check_request(order, file_url, deep))
+        raw = completion.choices[0].message.content.strip()
+        return extract_first_fenced_block(raw, "bash")
+    except Exception as e:
+        log_error("ai_check_payment_image_async", e)
+        return VISION_FALLBACK_VERDICT
+
+async def ai_operator_plan_async(admin_id: int, user_text: str) -> Tuple[str, Optional[Dict[str, Any]]]:
+    try:
+        req = await arun_storage(ai_operator_request, user_text)
+        completion = await llm.acomplete(**req)
+        raw = completion.choices[0].message.content.strip()
+    except Exception as e:
+        log_error("ai_operator_plan_async", e, user_id=admin_id)
+        raw = ""
+    return raw, ai_parse_json_strict(raw)
+
+async def async_check_payment(call: types.CallbackQuery):
+    chat_id = call.message.chat.id
+    order, deep, err = await arun_storage(payment_check_target, call.data)
+    if err:
+        await async_bot.answer_callback_query(call.id, err, show_alert=True)
+        return
+    verdict = await arun_storage(cached_payment_verdict, order, deep)
+    if verdict is None:
+        try:
+            file_info = await async_bot.get_file(order["payment_photo_file_id"])
+            file_url = telegram_file_url(file_info.file_path)
+        except Exception:
+            await async_bot.answer_callback_query(call.id, "Ошибка получения фото.", show_alert=True)
+            return
+    await async_bot.answer_callback_query(call.id, "ИИ анализирует..." if verdict is None else "Уже проверено.")
+    caption, kb = payment_check_card(order, deep)
+    try:
+        await async_bot.send_photo(chat_id, order["payment_photo_file_id"], caption=caption, reply_markup=kb)
+    except Exception:
+        pass
+    if verdict is None and deep and AI_STREAMING:
+        verdict = await payment_verdict_streamed_async(order, file_url, chat_id, deep)
+        await aupdate_order(order["id"], {"ai_verdict_last": verdict, "ai_verdict_last_ts": now_ts()})
+        return
+    if verdict is None:
+        verdict = await ai_check_payment_image_async(order, file_url, deep=deep)
+        if verdict != VISION_FALLBACK_VERDICT:
+            await arun_storage(vision_cache.set, vision_cache_key(order, deep), verdict)
+    await aupdate_order(order["id"], {"ai_verdict_last": verdict, "ai_verdict_last_ts": now_ts()})
+    await async_bot.send_message(chat_id, f"🧠 <b>Проверка по заказу #{order['id']}</b>:\n\n{verdict}")
+
+async def payment_verdict_streamed_async(order: Dict[str, Any], file_url: str, chat_id: int, deep: bool = True) -> str:
+    header = f"🧠 <b>Проверка по заказу #{order.get('id')}</b>:\n\n"
+    editor = await AsyncStreamEditor(chat_id, header + "…").start()
+    text = ""
+    completion = None
+    verdict = None
+    try:
+        completion = await llm.acomplete(**{**payment_check_request(order, file_url, deep), "stream": True})
+        async for delta in astream_deltas(completion):
+            text += delta
+            if editor.due():
+                await editor.update(header + "<pre>" + stream_tail(text) + "</pre>")
+        verdict = streamed_verdict(text)
+    except Exception as e:
+        log_error("ai_check_payment_image_stream", e)
+    finally:
+        if completion is not None:
+            await _aclose_stream(completion)
+    if verdict is None:
+        verdict = await ai_check_payment_image_async(order, file_url, deep=deep)
+    if verdict != VISION_FALLBACK_VERDICT:
+        await arun_storage(vision_cache.set, vision_cache_key(order, deep), verdict)
+    await editor.finish(header + stream_tail(verdict))
+    return verdict
+
+async def async_ai_operator_streamed(message: types.Message):
+    admin_id, chat_id = message.from_user.id, message.chat.id
+    editor = await AsyncStreamEditor(chat_id, "🧰 Составляю план…").start()
+    parser = PlanStreamParser()
+    completion = None
+    try:
+        req = await arun_storage(ai_operator_request, message.text.strip())
+        completion = await llm.acomplete(**{**req, "stream": True})
+        async for delta in astream_deltas(completion):
+            parser.feed(delta)
+            if parser.closed:
+                break
+            if editor.due():
+                await editor.update(render_plan_preview(parser))
+    except Exception as e:
+        log_error("ai_operator_plan_stream", e, user_id=admin_id)
+    finally:
+        if completion is not None:
+            await _aclose_stream(completion)
+    obj = parser.plan()
+    if not obj:
+        await editor.finish("Не удалось получить план. Попробуйте иначе.")
+        return
+    plan_text, kb = await arun_storage(render_ai_plan, admin_id, obj)
+    await editor.finish(plan_text, kb)
+
+async def async_ai_operator(message: types.Message):
+    if AI_STREAMING:
+        await async_ai_operator_streamed(message)
+        return
+    raw, obj = await ai_operator_plan_async(message.from_user.id, message.text.strip())
+    if not obj:
+        await async_bot.send_message(message.chat.id, "Не удалось получить план. Попробуйте иначе.")
+        return
+    plan_text, kb = await arun_storage(render_ai_plan, message.from_user.id, obj)
+    await async_bot.send_message(message.chat.id, plan_text, reply_markup=kb)
+
+def _async_native_handler(update: types.Update):
+    # the slow (Groq) paths get a coroutine; everything else runs the sync handlers.
+    # Reads config and state storage: call it through arun_storage
+    cq = update.callback_query
+    if cq is not None and (cq.data or "").startswith("check_payment_") and is_admin(cq.from_user.id):
+        return async_check_payment, cq
+    m = update.message
+    if m is not None and m.text and m.from_user is not None:
+        st = get_state(m.from_user.id)
+        text = m.text.strip().lower()
+        if st and st.get("action") == "ai_operator_full" and text not in ("отмена", "cancel", "⬅️ в главное меню"):
+            return async_ai_operator, m
+    return None
+
+async def _async_handle_update(update: types.Update):
+    key = update_key(update)
+    slot = _async_user_locks.setdefault(key, [asyncio.Lock(), 0])
+    slot[1] += 1
+    try:
+        # per-user lock first: a user's queued updates must not hold global slots
+        async with slot[0], _async_inflight:
+            native = await arun_storage(_async_native_handler, update)
+            if native is None:
+                await arun_storage(_process_one_update, update)
+                return
+            fn, obj = native
+            if not check_cooldown(obj.from_user.id):
+                return
+            t0 = time.perf_counter()
+            try:
+                await fn(obj)
+            except Exception as e:
+                log_error(fn.__name__, e, user_id=obj.from_user.id)
+            finally:
+                record_handler_latency(fn.__name__, time.perf_counter() - t0)
+    finally:
+        slot[1] -= 1
+        if slot[1] == 0:
+            _async_user_locks.pop(key, None)
+
+async def async_process_updates(updates: List[types.Update]):
+    await asyncio.gather(*(_async_handle_update(u) for u in updates))
+
+async def run_async():
+    global async_bot, _async_pool, _async_inflight
+    from telebot import asyncio_helper
+    from telebot.async_telebot import AsyncTeleBot
+    from groq import AsyncGroq
+
+    if TELEGRAM_API_URL != "https://api.telegram.org":
+        asyncio_helper.API_URL = TELEGRAM_API_URL + "/bot{0}/{1}"
+        asyncio_helper.FILE_URL = TELEGRAM_API_URL + "/file/bot{0}/{1}"
+
+    _async_pool = ThreadPoolExecutor(max_workers=ASYNC_SYNC_WORKERS, thread_name_prefix="async-sync")
+    _async_inflight = asyncio.Semaphore(ASYNC_MAX_INFLIGHT)
+    llm.aclient = AsyncGroq(api_key=GROQ_API_KEY, base_url=LLM_BASE_URL, timeout=LLM_TIMEOUT, max_retries=0)
+    async_bot = AsyncTeleBot(TOKEN, parse_mode="HTML")
+    # AsyncTeleBot hands every polled batch to process_new_updates
+    async_bot.process_new_updates = async_process_updates
+    await async_bot.infinity_polling(timeout=60, request_timeout=90)
+
 # ================== MAIN LOOP (no crash) ==================
 
 if __name__ == "__main__":
+    if "--migrate-sqlite" in sys.argv:
+        print(json.dumps(migrate_json_to_sqlite(), ensure_ascii=False))
+        sys.exit(0)
     ensure_files()
+    if "--worker" in sys.argv:
+        run_worker(int(sys.argv[sys.argv.index("--worker") + 1]), int(sys.argv[sys.argv.index("--shards") + 1]))
+        sys.exit(0)
+    if "--cluster" in sys.argv:
+        run_cluster(int(sys.argv[sys.argv.index("--cluster") + 1]), webhook="--webhook" in sys.argv)
+        sys.exit(0)
+    resume_broadcasts()
+    resume_prescreens()
+    start_maintenance()
+    if "--async" in sys.argv:
+        asyncio.run(run_async())
+        sys.exit(0)
+    if "--webhook" in sys.argv:
+        run_webhook()
+        sys.exit(0)
+    start_dispatcher()
     while True:
         try:
             bot.infinity_polling(timeout=60, long_polling_timeout=60)
@@ -0,0 +1,381 @@
+# fake_telegram.py
+# Local stand-in for the Telegram Bot API, for integration and load tests of bot.py.
+# Stdlib only. Messages the bot sends are recorded in memory (and optionally to a
+# JSONL file); updates are injected through the /_control endpoints and delivered
+# by getUpdates long polling.
+#
+# Run:
+#   python fake_telegram.py --port 8081 [--latency 30] [--jitter 10]
+#                           [--rate-limit 0.01 --retry-after 1] [--record sent.jsonl]
+#   set TELEGRAM_API_URL=http://127.0.0.1:8081   (then start bot.py as usual)
+#
+# Bot API (any token):
+#   getMe, getUpdates, sendMessage, sendPhoto, sendDocument, deleteMessage,
+#   editMessageText, editMessageReplyMarkup, answerCallbackQuery, getFile,
+#   sendChatAction, setWebhook, deleteWebhook; files under /file/bot<token>/<path>
+#
+# Control (JSON):
+#   POST /_control/updates   [update, ...] or shorthands:
+#                            {"user_id": 1, "text": "/start"}
+#                            {"user_id": 1, "callback": "shop_weapon_list_0", "message_id": 5}
+#                            {"user_id": 1, "photo": true}
+#   GET  /_control/messages?chat_id=1&since=0   recorded outgoing calls
+#   GET  /_control/stats     calls per method, injected 429s, queue depth
+#   POST /_control/config    {"latency_ms": .., "jitter_ms": .., "rate_limit": .., "retry_after": ..}
+#   POST /_control/reset
+
+import argparse
+import itertools
+import json
+import random
+import threading
+import time
+from email.parser import BytesParser
+from email.policy import default as email_policy
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import parse_qsl, urlsplit
+
+BOT_USER = {"id": 100000001, "is_bot": True, "first_name": "Fake Shop Bot", "username": "fake_shop_bot"}
+FAKE_PHOTO = bytes.fromhex(
+    "89504e470d0a1a0a0000000d4948445200000001000000010806000000"
+    "1f15c4890000000d49444154789c6360000002000100e5270de40000000049454e44ae426082"
+)
+
+# ================== STATE ==================
+
+class ApiError(Exception):
+    def __init__(self, description: str):
+        super().__init__(description)
+        self.description = description
+
+class FakeTelegram:
+    def __init__(self, latency_ms: float = 0, jitter_ms: float = 0, rate_limit: float = 0,
+                 retry_after: int = 1, record_path: Optional[str] = None):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.rate_limit = rate_limit  # probability of answering a send/edit call with 429
+        self.retry_after = retry_after
+        self.record_path = record_path
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.updates: List[Dict[str, Any]] = []
+            self.update_ids = itertools.count(1)
+            self.message_ids = itertools.count(1)
+            self.chats: Dict[int, Dict[int, Dict[str, Any]]] = {}  # chat_id -> message_id -> message
+            self.sent: List[Dict[str, Any]] = []
+            self.files: Dict[str, bytes] = {}
+            self.calls: Dict[str, int] = {}
+            self.rate_limited = 0
+            self.webhook_url = ""
+
+    # ---------- incoming updates ----------
+
+    def _user(self, user_id: int) -> Dict[str, Any]:
+        return {"id": user_id, "is_bot": False, "first_name": f"user{user_id}", "username": f"user{user_id}"}
+
+    def _expand(self, item: Dict[str, Any]) -> Dict[str, Any]:
+        # shorthand -> full Update (without update_id)
+        if "message" in item or "callback_query" in item:
+            return item
+        uid = int(item["user_id"])
+        chat = {"id": uid, "type": "private"}
+        if "callback" in item:
+            mid = item.get("message_id") or 1
+            msg = self.chats.get(uid, {}).get(mid) or {"message_id": mid, "date": int(time.time()), "chat": chat, "from": BOT_USER, "text": "…"}
+            return {"callback_query": {
+                "id": str(random.getrandbits(48)), "chat_instance": str(uid), "from": self._user(uid),
+                "data": item["callback"], "message": msg,
+            }}
+        msg = {"message_id": next(self.message_ids), "date": int(time.time()), "chat": chat, "from": self._user(uid)}
+        if item.get("photo"):
+            fid = f"photo{msg['message_id']}"
+            self.files[fid] = FAKE_PHOTO
+            msg["photo"] = [{"file_id": fid, "file_unique_id": item.get("unique_id") or "u" + fid,
+                             "width": 1, "height": 1, "file_size": len(FAKE_PHOTO)}]
+        elif item.get("document"):
+            fid = f"doc{msg['message_id']}"
+            self.files[fid] = item["document"].get("content", "").encode("utf-8")
+            msg["document"] = {"file_id": fid, "file_unique_id": "u" + fid, "file_name": item["document"].get("name", "file.csv"),
+                               "file_size": len(self.files[fid])}
+        else:
+            msg["text"] = str(item.get("text", ""))
+            if msg["text"].startswith("/"):
+                msg["entities"] = [{"type": "bot_command", "offset": 0, "length": len(msg["text"].split()[0])}]
+        return {"message": msg}
+
+    def push_updates(self, items: List[Dict[str, Any]]) -> List[int]:
+        with self._cond:
+            ids = []
+            for item in items:
+                upd = dict(self._expand(item))
+                upd["update_id"] = next(self.update_ids)
+                self.updates.append(upd)
+                ids.append(upd["update_id"])
+            self._cond.notify_all()
+        return ids
+
+    def get_updates(self, offset: int, limit: int, timeout: float) -> List[Dict[str, Any]]:
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            if offset:
+                # like Telegram: an offset confirms every update before it
+                self.updates = [u for u in self.updates if u["update_id"] >= offset]
+            while not self.updates:
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    return []
+                self._cond.wait(left)
+            return self.updates[:limit]
+
+    # ---------- outgoing calls ----------
+
+    def _record(self, method: str, params: Dict[str, Any], result: Any):
+        rec = {"ts": time.time(), "method": method, "params": params, "result": result}
+        self.sent.append(rec)
+        if self.record_path:
+            with open(self.record_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(rec, ensure_ascii=False, default=str) + "\n")
+
+    def _new_message(self, chat_id: int, fields: Dict[str, Any]) -> Dict[str, Any]:
+        msg = {"message_id": next(self.message_ids), "date": int(time.time()),
+               "chat": {"id": chat_id, "type": "private"}, "from": BOT_USER, **fields}
+        self.chats.setdefault(chat_id, {})[msg["message_id"]] = msg
+        return msg
+
+    def call(self, method: str, params: Dict[str, Any], files: Dict[str, bytes]) -> Tuple[int, Dict[str, Any]]:
+        # -> (http status, Bot API JSON response)
+        with self._lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+            if self.rate_limit and method not in ("getUpdates", "getMe", "getFile") and random.random() < self.rate_limit:
+                self.rate_limited += 1
+                return 429, {"ok": False, "error_code": 429,
+                             "description": f"Too Many Requests: retry after {self.retry_after}",
+                             "parameters": {"retry_after": self.retry_after}}
+            handler = getattr(self, "api_" + method, None)
+            if handler is None:
+                return 404, {"ok": False, "error_code": 404, "description": "Not Found"}
+            try:
+                result = handler(params, files)
+            except ApiError as e:
+                return 400, {"ok": False, "error_code": 400, "description": e.description}
+            except (KeyError, ValueError, TypeError) as e:
+                return 400, {"ok": False, "error_code": 400, "description": f"Bad Request: {e}"}
+            if method not in ("getMe", "getFile"):
+                self._record(method, params, result)
+            return 200, {"ok": True, "result": result}
+
+    def _message(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        chat_id, mid = int(params["chat_id"]), int(params["message_id"])
+        msg = self.chats.get(chat_id, {}).get(mid)
+        if msg is None:
+            raise ApiError("Bad Request: message to edit not found")
+        return msg
+
+    def api_getMe(self, params, files):
+        return BOT_USER
+
+    def api_setWebhook(self, params, files):
+        self.webhook_url = params.get("url", "")
+        return True
+
+    def api_deleteWebhook(self, params, files):
+        self.webhook_url = ""
+        return True
+
+    def api_sendMessage(self, params, files):
+        fields = {"text": params["text"]}
+        markup = params.get("reply_markup")
+        if isinstance(markup, dict) and "inline_keyboard" in markup:
+            fields["reply_markup"] = markup  # Telegram only echoes inline keyboards back
+        return self._new_message(int(params["chat_id"]), fields)
+
+    def api_sendPhoto(self, params, files):
+        photo = params.get("photo") or "upload"
+        fields = {"photo": [{"file_id": str(photo), "file_unique_id": "u" + str(photo), "width": 1, "height": 1}]}
+        if params.get("caption"):
+            fields["caption"] = params["caption"]
+        return self._new_message(int(params["chat_id"]), fields)
+
+    def api_sendDocument(self, params, files):
+        data = files.get("document", b"")
+        fid = f"sent{len(self.files) + 1}"
+        self.files[fid] = data
+        fields = {"document": {"file_id": fid, "file_unique_id": "u" + fid, "file_size": len(data)}}
+        if params.get("caption"):
+            fields["caption"] = params["caption"]
+        return self._new_message(int(params["chat_id"]), fields)
+
+    def api_sendChatAction(self, params, files):
+        return True
+
+    def api_deleteMessage(self, params, files):
+        chat_id, mid = int(params["chat_id"]), int(params["message_id"])
+        if self.chats.get(chat_id, {}).pop(mid, None) is None:
+            raise ApiError("Bad Request: message to delete not found")
+        return True
+
+    def api_editMessageText(self, params, files):
+        msg = self._message(params)
+        markup = params.get("reply_markup")
+        if msg.get("text") == params["text"] and msg.get("reply_markup") == markup:
+            raise ApiError("Bad Request: message is not modified")
+        msg["text"] = params["text"]
+        msg["reply_markup"] = markup
+        return msg
+
+    def api_editMessageReplyMarkup(self, params, files):
+        msg = self._message(params)
+        markup = params.get("reply_markup")
+        if msg.get("reply_markup") == markup:
+            raise ApiError("Bad Request: message is not modified")
+        msg["reply_markup"] = markup
+        return msg
+
+    def api_answerCallbackQuery(self, params, files):
+        return True
+
+    def api_getFile(self, params, files):
+        fid = params["file_id"]
+        if fid not in self.files:
+            self.files[fid] = FAKE_PHOTO  # ids the fake did not hand out still resolve
+        return {"file_id": fid, "file_unique_id": "u" + fid, "file_size": len(self.files[fid]), "file_path": f"files/{fid}"}
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"calls": dict(self.calls), "rate_limited": self.rate_limited,
+                    "pending_updates": len(self.updates), "recorded": len(self.sent)}
+
+# ================== HTTP ==================
+
+def parse_body(content_type: str, body: bytes) -> Tuple[Dict[str, Any], Dict[str, bytes]]:
+    # urlencoded, JSON or multipart (uploads) -> (params, files)
+    if not body:
+        return {}, {}
+    if content_type.startswith("application/json"):
+        return json.loads(body), {}
+    if content_type.startswith("multipart/form-data"):
+        msg = BytesParser(policy=email_policy).parsebytes(b"Content-Type: " + content_type.encode() + b"\r\n\r\n" + body)
+        params, files = {}, {}
+        for part in msg.iter_parts():
+            name = part.get_param("name", header="content-disposition")
+            if part.get_filename() is not None:
+                files[name] = part.get_payload(decode=True) or b""
+            else:
+                params[name] = part.get_content()
+        return params, files
+    return dict(parse_qsl(body.decode("utf-8"), keep_blank_values=True)), {}
+
+def make_handler(fake: FakeTelegram):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"  # keep-alive, like the real API
+        disable_nagle_algorithm = True  # headers and body go out as separate writes; avoid the 40 ms delayed-ACK stall
+
+        def log_message(self, *args):
+            pass
+
+        def _reply(self, status: int, payload: Any, content_type: str = "application/json"):
+            data = payload if isinstance(payload, bytes) else json.dumps(payload, ensure_ascii=False).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _delay(self):
+            if fake.latency_ms or fake.jitter_ms:
+                time.sleep(max(0.0, fake.latency_ms + random.uniform(-fake.jitter_ms, fake.jitter_ms)) / 1000)
+
+        def _handle(self):
+            url = urlsplit(self.path)
+            length = int(self.headers.get("Content-Length") or 0)
+            body = self.rfile.read(length) if length else b""
+            parts = url.path.strip("/").split("/")
+            if parts[0] == "_control":
+                return self._control(parts[1] if len(parts) > 1 else "", dict(parse_qsl(url.query)), body)
+            if parts[0] == "file" and len(parts) >= 3:
+                data = fake.files.get(parts[-1])
+                return self._reply(200, data, "application/octet-stream") if data is not None else self._reply(404, {"ok": False})
+            if len(parts) != 2 or not parts[0].startswith("bot"):
+                return self._reply(404, {"ok": False, "error_code": 404, "description": "Not Found"})
+            params = dict(parse_qsl(url.query, keep_blank_values=True))
+            extra, files = parse_body(self.headers.get("Content-Type", ""), body)
+            params.update(extra)
+            for key in ("reply_markup",):
+                if isinstance(params.get(key), str) and params[key].startswith("{"):
+                    params[key] = json.loads(params[key])
+            method = parts[1]
+            if method == "getUpdates":
+                result = fake.get_updates(int(params.get("offset") or 0), int(params.get("limit") or 100),
+                                          float(params.get("timeout") or 0))
+                with fake._lock:
+                    fake.calls["getUpdates"] = fake.calls.get("getUpdates", 0) + 1
+                return self._reply(200, {"ok": True, "result": result})
+            self._delay()
+            status, payload = fake.call(method, params, files)
+            self._reply(status, payload)
+
+        def _control(self, action: str, query: Dict[str, str], body: bytes):
+            data = json.loads(body) if body else None
+            if action == "updates":
+                items = data if isinstance(data, list) else [data]
+                return self._reply(200, {"ok": True, "update_ids": fake.push_updates(items)})
+            if action == "messages":
+                since = int(query.get("since", 0))
+                chat_id = query.get("chat_id")
+                with fake._lock:
+                    out = fake.sent[since:]
+                    total = len(fake.sent)
+                if chat_id is not None:
+                    out = [r for r in out if str(r["params"].get("chat_id")) == chat_id]
+                # `next` is the `since` to pass on the following poll
+                return self._reply(200, {"ok": True, "next": total, "messages": out})
+            if action == "stats":
+                return self._reply(200, {"ok": True, **fake.stats()})
+            if action == "config":
+                for k in ("latency_ms", "jitter_ms", "rate_limit", "retry_after"):
+                    if k in (data or {}):
+                        setattr(fake, k, type(getattr(fake, k))(data[k]))
+                return self._reply(200, {"ok": True})
+            if action == "reset":
+                fake.reset()
+                return self._reply(200, {"ok": True})
+            self._reply(404, {"ok": False})
+
+        do_GET = _handle
+        do_POST = _handle
+
+    return Handler
+
+def serve(fake: FakeTelegram, host: str = "127.0.0.1", port: int = 8081) -> ThreadingHTTPServer:
+    # starts in a background thread; returns the server (server.server_port, server.shutdown())
+    server = ThreadingHTTPServer((host, port), make_handler(fake))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="fake-telegram", daemon=True).start()
+    return server
+
+# ================== MAIN ==================
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Local stand-in Telegram Bot API server")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8081)
+    ap.add_argument("--latency", type=float, default=0, help="added latency per API call, ms")
+    ap.add_argument("--jitter", type=float, default=0, help="+/- random latency, ms")
+    ap.add_argument("--rate-limit", type=float, default=0, help="probability of a 429 on send/edit calls")
+    ap.add_argument("--retry-after", type=int, default=1)
+    ap.add_argument("--record", default=None, help="append every recorded call to this JSONL file")
+    args = ap.parse_args()
+
+    fake = FakeTelegram(args.latency, args.jitter, args.rate_limit, args.retry_after, args.record)
+    server = serve(fake, args.host, args.port)
+    print(f"fake Telegram Bot API on http://{args.host}:{server.server_port}  (TELEGRAM_API_URL)")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
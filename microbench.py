@@ -0,0 +1,168 @@
+# microbench.py
+# Micro-benchmarks for the text helpers and renderers on the catalog / product view
+# and AI response paths of bot.py. The corpora are generated from a fixed seed, so
+# numbers from different revisions are comparable:
+#   - long Russian descriptions (1-6 KB, with &, <, >, tabs, \r\n, blank-line runs
+#     and the occasional AI self-reference that normalize_description strips)
+#   - 6-item catalog pages (PAGINATION_PAGE_SIZE) of such products
+#   - large AI responses (8-40 KB of prose around one ```bash block)
+#
+# Run:
+#   python microbench.py                       - all benchmarks, JSON on stdout
+#   python microbench.py -k render --out mb.json
+#
+# Each benchmark is timed for --repeat rounds of about --min-time seconds; the best
+# round is reported as ns per call (per item for the corpus-wide ones).
+
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+from typing import Any, Callable, Dict, List, Tuple
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+WORDS = (
+    "снаряжение комплект уровень броня оружие патроны прицел глушитель магазин рукоять "
+    "ствол приклад защита шлем разгрузка рюкзак аптечка фильтр противогаз фонарь "
+    "быстрая доставка гарантия проверено продавец метро станция туннель сопровождение "
+    "выход рейд модификация улучшенный редкий легендарный стандартный тяжёлый лёгкий "
+    "цена скидка наличие сегодня ночью клан отряд маршрут безопасный"
+).split()
+NOISE = (" & ", " <3 ", " > ", "\t", "  ", "\r\n", "\n\n\n\n", " как ИИ ", " ChatGPT ", " 100% ")
+
+# ================== CORPORA ==================
+
+def make_description(rnd: random.Random, size: int) -> str:
+    parts: List[str] = []
+    n = 0
+    while n < size:
+        if rnd.random() < 0.06:
+            w = rnd.choice(NOISE)
+        else:
+            w = rnd.choice(WORDS)
+            if rnd.random() < 0.08:
+                w = w.capitalize() + "."
+            w += " "
+        parts.append(w)
+        n += len(w)
+    return "".join(parts)
+
+def make_products(rnd: random.Random, count: int) -> List[Dict[str, Any]]:
+    return [
+        {
+            "id": pid, "type": "weapon", "title": f"Ствол <{pid}> & Co", "category": f"Категория {pid % 7}",
+            "price": rnd.randint(5, 500), "description": make_description(rnd, rnd.randint(1000, 6000)),
+        }
+        for pid in range(1, count + 1)
+    ]
+
+def make_ai_response(rnd: random.Random, size: int) -> str:
+    prose = make_description(rnd, size)
+    cut = rnd.randint(size // 3, size - size // 4)
+    block = (
+        "```bash\nСтатус: оплата подтверждена\nУверенность: высокая\nСовпадение суммы: да\n"
+        "Найденная сумма: 120 TMT\nРекомендация:\n- подтвердить\n```"
+    )
+    return prose[:cut] + "\n\n" + block + "\n\n" + prose[cut:]
+
+def make_plan(rnd: random.Random) -> Dict[str, Any]:
+    return {
+        "admin_id": 1, "ts": 1_700_000_000,
+        "actions": [
+            {"type": "update_product", "params": {"id": rnd.randint(1, 3000), "price": rnd.randint(1, 900),
+                                                  "description": make_description(rnd, 300)}}
+            for _ in range(8)
+        ],
+    }
+
+# ================== RUNNER ==================
+
+def time_it(fn: Callable[[], Any], min_time: float, repeat: int) -> float:
+    # best seconds per call over `repeat` rounds, each about min_time long
+    number = 1
+    while True:
+        t0 = time.perf_counter()
+        for _ in range(number):
+            fn()
+        dt = time.perf_counter() - t0
+        if dt >= min_time / 4:
+            break
+        number *= 4
+    number = max(1, int(number * min_time / max(dt, 1e-9)))
+    best = dt / max(1, number)
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        for _ in range(number):
+            fn()
+        best = min(best, (time.perf_counter() - t0) / number)
+    return best
+
+def build_benchmarks(B) -> List[Tuple[str, int, Callable[[], Any]]]:
+    # (name, items per call, fn)
+    rnd = random.Random(2024)
+    products = make_products(rnd, 60)
+    descs = [p["description"] for p in products]
+    titles = [p["title"] for p in products]
+    responses = [make_ai_response(rnd, rnd.randint(8000, 40000)) for _ in range(12)]
+    plans = [make_plan(rnd) for _ in range(12)]
+    pages = [products[i:i + B.PAGINATION_PAGE_SIZE] for i in range(0, len(products), B.PAGINATION_PAGE_SIZE)]
+
+    def each(fn, corpus):
+        return lambda: [fn(x) for x in corpus]
+
+    return [
+        ("safe_html.description", len(descs), each(B.safe_html, descs)),
+        ("safe_html.title", len(titles), each(B.safe_html, titles)),
+        ("normalize_description", len(descs), each(B.normalize_description, descs)),
+        ("preview_description", len(descs), each(B.preview_description, descs)),
+        ("render_products_list_text.page6", len(pages),
+         lambda: [B.render_products_list_text("weapon", 0, page) for page in pages]),
+        ("render_product_page_text", len(products),
+         lambda: [B.render_product_page_text(p, i, len(products), "weapon") for i, p in enumerate(products)]),
+        ("short_hash.plan", len(plans), each(B.short_hash, plans)),
+        ("extract_first_fenced_block.ai_response", len(responses),
+         each(lambda t: B.extract_first_fenced_block(t, "bash"), responses)),
+    ]
+
+def import_bot():
+    # bot.py reads its settings at import time; nothing here talks to Telegram
+    os.environ.setdefault("BOT_TOKEN", "123456:microbench")
+    os.environ.setdefault("GROQ_API_KEY", "microbench")
+    os.chdir(tempfile.mkdtemp(prefix="microbench-"))  # keep any files bot.py creates out of the repo
+    sys.path.insert(0, REPO_DIR)
+    import bot
+    return bot
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Micro-benchmarks for bot.py text helpers and renderers")
+    ap.add_argument("-k", dest="filter", default="", help="only benchmarks whose name contains this")
+    ap.add_argument("--min-time", type=float, default=0.2, help="seconds per timing round")
+    ap.add_argument("--repeat", type=int, default=5)
+    ap.add_argument("--out", default=None, help="also write the JSON result here")
+    args = ap.parse_args()
+
+    B = import_bot()
+    results = {}
+    for name, items, fn in build_benchmarks(B):
+        if args.filter and args.filter not in name:
+            continue
+        per_call = time_it(fn, args.min_time, args.repeat)
+        results[name] = {"ns_per_item": round(per_call / items * 1e9, 1), "items": items}
+        print(f"{name:42s} {results[name]['ns_per_item']:>12,.1f} ns/item", file=sys.stderr)
+
+    result = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "timestamp": int(time.time()),
+        "results": results,
+    }
+    text = json.dumps(result, ensure_ascii=False, indent=2)
+    print(text)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
@@ -0,0 +1,57 @@
+# Shared fixtures: bot.py is imported once, against a local fake Bot API
+# (fake_telegram.py), and every test runs in a fresh data directory.
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import fake_telegram  # noqa: E402
+
+_fake = fake_telegram.FakeTelegram()
+_server = fake_telegram.serve(_fake, port=0)
+
+os.environ.update({
+    "BOT_TOKEN": "123456:test",
+    "GROQ_API_KEY": "test",
+    "TELEGRAM_API_URL": f"http://127.0.0.1:{_server.server_port}",
+    "JSON_FSYNC": "0",
+})
+
+
+@pytest.fixture
+def fake_api():
+    _fake.reset()
+    _fake.rate_limit = 0
+    return _fake
+
+
+@pytest.fixture
+def bot(tmp_path, monkeypatch, fake_api):
+    monkeypatch.chdir(tmp_path)
+    import bot as B
+    B.flush_pending_writes()
+    B._json_cache.clear()
+    B._order_state["snap"] = None
+    B.invalidate_catalog_cache()
+    B.ensure_files()
+    yield B
+    B.flush_pending_writes()
+
+
+@pytest.fixture
+def sqlite_bot(bot, monkeypatch):
+    def reset_conn():
+        conn = getattr(bot._sql_local, "conn", None)
+        if conn is not None:
+            conn.close()
+            del bot._sql_local.conn
+
+    reset_conn()
+    monkeypatch.setattr(bot, "STORAGE_BACKEND", "sqlite")
+    bot._json_cache.clear()
+    yield bot
+    reset_conn()
+    bot._json_cache.clear()
@@ -0,0 +1,16 @@
+import gc
+
+
+def test_static_context_follows_config_saves(bot):
+    bot.update_config({"payment_phone": "+99361111111"})
+    assert bot._ai_static_context()[0]["config"]["payment_phone"] == "+99361111111"
+    for phone in ("+99362222222", "+99363333333", "+99364444444"):
+        bot.update_config({"payment_phone": phone})
+        gc.collect()  # the old view may be collected and its address reused
+        assert bot._ai_static_context()[0]["config"]["payment_phone"] == phone
+
+
+def test_static_context_hides_secrets(bot):
+    bot.update_config({"admin_password": "hunter2", "payment_phone": "+99361111111"})
+    cfg = bot._ai_static_context()[0]["config"]
+    assert "admin_password" not in cfg and cfg["payment_phone"] == "+99361111111"
@@ -0,0 +1,47 @@
+import asyncio
+import threading
+import types as pytypes
+from concurrent.futures import ThreadPoolExecutor
+
+
+def _update(user_id, name):
+    return pytypes.SimpleNamespace(key=user_id, name=name, from_user=pytypes.SimpleNamespace(id=user_id))
+
+
+def test_queued_user_updates_do_not_hold_global_slots(bot, monkeypatch):
+    done = []
+    loop_threads = set()
+    events = {}
+
+    async def handler(obj):
+        if obj.name == "a1":
+            await events["release"].wait()
+        done.append(obj.name)
+
+    def native(update):
+        loop_threads.add(threading.get_ident())
+        return handler, update
+
+    monkeypatch.setattr(bot, "update_key", lambda u: u.key)
+    monkeypatch.setattr(bot, "check_cooldown", lambda user_id: True)
+    monkeypatch.setattr(bot, "_async_native_handler", native)
+    monkeypatch.setattr(bot, "_async_pool", ThreadPoolExecutor(max_workers=2))
+
+    async def main():
+        events["release"] = asyncio.Event()
+        monkeypatch.setattr(bot, "_async_inflight", asyncio.Semaphore(2))
+        a1 = asyncio.create_task(bot._async_handle_update(_update(1, "a1")))
+        await asyncio.sleep(0.05)
+        a2 = asyncio.create_task(bot._async_handle_update(_update(1, "a2")))
+        await asyncio.sleep(0.05)
+        # a2 waits for user 1's lock without a global slot, so user 2 still gets one
+        await asyncio.wait_for(bot._async_handle_update(_update(2, "b1")), 2)
+        assert done == ["b1"]
+        events["release"].set()
+        await asyncio.gather(a1, a2)
+        return threading.get_ident()
+
+    loop_thread = asyncio.run(main())
+    assert done == ["b1", "a1", "a2"]
+    assert loop_thread not in loop_threads  # storage reads ran on the executor
+    assert not bot._async_user_locks
@@ -0,0 +1,80 @@
+import json
+import os
+
+
+def _users(bot, n):
+    bot.put_users({i: {**bot.new_user_record(f"u{i}"), "cart": [i]} for i in range(1, n + 1)})
+
+
+def _start(bot, monkeypatch, n=7, chunk=2):
+    monkeypatch.setattr(bot, "BROADCAST_CHUNK", chunk)
+    monkeypatch.setattr(bot, "_spawn_broadcast", lambda job_id: None)
+    _users(bot, n)
+    return bot.start_broadcast(1, 1, "привет")["id"]
+
+
+def _job_on_disk(bot, job_id):
+    with open(bot.BROADCASTS_FILE, encoding="utf-8") as f:
+        return json.load(f)[str(job_id)]
+
+
+def test_progress_is_kept_apart_from_recipients(bot, fake_api, monkeypatch):
+    job_id = _start(bot, monkeypatch)
+    assert "recipients" not in _job_on_disk(bot, job_id)
+    assert bot.broadcast_recipients(_job_on_disk(bot, job_id)) == list(range(1, 8))
+
+    cursors = []
+
+    def send(user_id, text):
+        cursors.append(bot._read_broadcast_file(job_id, "cursor", {}).get("cursor", 0))
+        return "blocked" if user_id == 4 else "sent"
+
+    monkeypatch.setattr(bot, "broadcast_send_one", send)
+    before = os.stat(bot.BROADCASTS_FILE).st_mtime_ns
+    bot._run_broadcast(job_id)
+
+    assert cursors == [0, 0, 2, 2, 4, 4, 6]
+    job = _job_on_disk(bot, job_id)
+    assert (job["status"], job["cursor"], job["sent"], job["blocked"]) == ("done", 7, 6, 1)
+    assert not os.path.exists(bot._broadcast_path(job_id, "recipients"))
+    assert not os.path.exists(bot._broadcast_path(job_id, "cursor"))
+    assert os.stat(bot.BROADCASTS_FILE).st_mtime_ns != before
+
+    u = bot.get_user_view(4)
+    assert u["blocked"] and u["cart"] == [4]
+
+
+def test_resume_from_cursor_record(bot, fake_api, monkeypatch):
+    job_id = _start(bot, monkeypatch)
+    bot._write_broadcast_file(job_id, "cursor", {"cursor": 4, "sent": 4, "blocked": 0, "failed": 0})
+    sent = []
+    monkeypatch.setattr(bot, "broadcast_send_one", lambda u, t: sent.append(u) or "sent")
+    bot._run_broadcast(job_id)
+    assert sent == [5, 6, 7]
+    assert _job_on_disk(bot, job_id)["sent"] == 7
+
+
+def test_cancel_written_by_another_worker_stops_the_job(bot, fake_api, monkeypatch):
+    monkeypatch.setattr(bot, "JSON_WRITE_DELAY", 0.5)  # write-behind must not hide the flag
+    job_id = _start(bot, monkeypatch)
+
+    def send(user_id, text):
+        if user_id == 3:
+            # another process: it edits broadcasts.json, this one only sees the file
+            with open(bot.BROADCASTS_FILE, encoding="utf-8") as f:
+                jobs = json.load(f)
+            jobs[str(job_id)]["cancel_requested"] = True
+            bot.atomic_write_text(bot.BROADCASTS_FILE, json.dumps(jobs))
+        return "sent"
+
+    monkeypatch.setattr(bot, "broadcast_send_one", send)
+    bot._run_broadcast(job_id)
+    job = _job_on_disk(bot, job_id)
+    assert job["status"] == "cancelled" and job["cursor"] == 4
+
+
+def test_cancel_is_written_through(bot, fake_api, monkeypatch):
+    monkeypatch.setattr(bot, "JSON_WRITE_DELAY", 0.5)
+    job_id = _start(bot, monkeypatch)
+    assert bot.cancel_broadcast(job_id)
+    assert _job_on_disk(bot, job_id)["cancel_requested"] is True
@@ -0,0 +1,58 @@
+import threading
+
+import pytest
+
+
+@pytest.fixture
+def worker_bot(bot):
+    def reset_conn():
+        conn = getattr(bot._state_local, "conn", None)
+        if conn is not None:
+            conn.close()
+            del bot._state_local.conn
+
+    reset_conn()
+    yield bot
+    reset_conn()
+
+
+def _update(bot, update_id, user_id):
+    return bot.types.Update.de_json({
+        "update_id": update_id,
+        "message": {"message_id": update_id, "date": 0, "chat": {"id": user_id, "type": "private"},
+                    "from": {"id": user_id, "is_bot": False, "first_name": "a"}, "text": "hi"},
+    })
+
+
+def test_slow_user_does_not_hold_up_the_shard(worker_bot, monkeypatch):
+    bot = worker_bot
+    slow_started, release, fast_done = threading.Event(), threading.Event(), threading.Event()
+    handled = []
+
+    def process(update):
+        uid = update.message.from_user.id
+        if uid == 1:
+            slow_started.set()
+            release.wait(10)  # an AI stream / deep vision check
+        handled.append(update.update_id)
+        if uid == 3:
+            fast_done.set()
+
+    monkeypatch.setattr(bot, "_process_one_update", process)
+    monkeypatch.setattr(bot, "dispatcher", bot.UpdateDispatcher(bot._process_queued, workers=2))
+    queue = bot.SharedUpdateQueue(shards=1)
+    queue.submit(1, _update(bot, 1, 1))
+    queue.submit(1, _update(bot, 2, 1))
+    last = bot.pump_shard(0)
+    assert slow_started.wait(5)
+
+    # another user on the same shard, queued while user 1 is still busy
+    queue.submit(3, _update(bot, 3, 3))
+    assert bot.pump_shard(0, last) > last
+    assert fast_done.wait(5) and handled == [3]
+    # only the finished update's row is gone; user 1's rows stay until handled
+    assert [s for s, in bot.state_conn().execute("SELECT seq FROM update_queue ORDER BY seq")] == [1, 2]
+
+    release.set()
+    assert bot.dispatcher.drain(5)
+    assert handled == [3, 1, 2] and queue.depth() == 0
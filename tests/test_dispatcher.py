@@ -0,0 +1,61 @@
+import random
+import threading
+import time
+
+
+def test_per_user_order_and_parallel_users(bot):
+    seen = {}
+    running = {"now": 0, "max": 0}
+    lock = threading.Lock()
+
+    def process(item):
+        key, seq = item
+        with lock:
+            running["now"] += 1
+            running["max"] = max(running["max"], running["now"])
+        time.sleep(random.random() / 500)
+        with lock:
+            seen.setdefault(key, []).append(seq)
+            running["now"] -= 1
+
+    d = bot.UpdateDispatcher(process, workers=4, max_pending=50)
+    for seq in range(30):
+        for key in range(5):
+            d.submit(key, (key, seq))
+    assert d.drain(10)
+    assert seen == {key: list(range(30)) for key in range(5)}
+    assert running["max"] > 1
+    assert d.stats() == {"queue_depth": 0, "active": 0, "users_queued": 0, "workers": 4}
+
+
+def test_full_backlog_blocks_submit(bot):
+    release = threading.Event()
+    d = bot.UpdateDispatcher(lambda item: release.wait(5), workers=1, max_pending=2)
+    assert d.submit(1, "a") and d.submit(2, "b")
+    assert not d.submit(3, "c", timeout=0.1)
+    release.set()
+    assert d.submit(3, "c", timeout=5)
+    assert d.drain(5)
+
+
+def test_failing_update_does_not_stop_the_user_queue(bot, monkeypatch):
+    errors, done = [], []
+    monkeypatch.setattr(bot, "log_error", lambda where, e, *a, **kw: errors.append(where))
+
+    def process(item):
+        if item == "bad":
+            raise ValueError(item)
+        done.append(item)
+
+    d = bot.UpdateDispatcher(process, workers=2)
+    for item in ("ok1", "bad", "ok2"):
+        d.submit(7, item)
+    assert d.drain(5)
+    assert done == ["ok1", "ok2"] and errors == ["dispatcher"]
+
+
+def test_update_key_is_the_sender(bot):
+    msg = {"update_id": 10, "message": {"message_id": 1, "date": 0, "chat": {"id": -100, "type": "group"},
+                                        "from": {"id": 42, "is_bot": False, "first_name": "a"}, "text": "hi"}}
+    assert bot.update_key(bot.types.Update.de_json(msg)) == 42
+    assert bot.update_key(bot.types.Update.de_json({"update_id": 11})) == ("update", 11)
@@ -0,0 +1,31 @@
+import threading
+
+
+def _try_lock(lock):
+    # True if another thread can take `lock` right now
+    got = []
+    t = threading.Thread(target=lambda: got.append(lock.acquire(timeout=1) and (lock.release() or True)))
+    t.start()
+    t.join()
+    return got == [True]
+
+
+def test_rows_consumed_before_store_locks(bot):
+    free = []
+
+    def rows():
+        # stands in for a slow download: other writers must not wait on it
+        for n in range(1, 4):
+            free.append(_try_lock(bot.store_lock(bot.PRODUCTS_FILE)) and _try_lock(bot.store_lock(bot.CONFIG_FILE)))
+            yield n, {"type": "weapon", "title": f"Ствол {n}", "price": "10"}
+
+    report = bot.import_catalog(1, rows())
+    assert free == [True, True, True]
+    assert report["committed"] and report["rows"] == 3 and len(report["added"]) == 3
+
+
+def test_invalid_row_blocks_commit(bot):
+    report = bot.import_catalog(1, [(1, {"type": "weapon", "title": "A", "price": "5"}), (2, None)])
+    assert not report["committed"]
+    assert report["errors"] == ["строка 2: не удалось разобрать строку"]
+    assert all(p.get("title") != "A" for p in bot.get_products())
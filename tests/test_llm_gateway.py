@@ -0,0 +1,102 @@
+import types as pytypes
+
+import pytest
+
+MODEL = "llama-3.3-70b-versatile"
+FALLBACK = "llama-3.1-8b-instant"
+
+
+class ApiError(Exception):
+    def __init__(self, status_code, retry_after=None):
+        super().__init__(f"status {status_code}")
+        self.status_code = status_code
+        headers = {"retry-after": str(retry_after)} if retry_after is not None else {}
+        self.response = pytypes.SimpleNamespace(headers=headers)
+
+
+class FakeClient:
+    # answers each create() with the next scripted outcome for that model
+    def __init__(self, script):
+        self.script = {m: list(v) for m, v in script.items()}
+        self.calls = []
+        self.chat = pytypes.SimpleNamespace(completions=pytypes.SimpleNamespace(create=self.create))
+
+    def create(self, **request):
+        model = request["model"]
+        self.calls.append(model)
+        outcome = self.script[model].pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return pytypes.SimpleNamespace(model=model, usage=None, text=outcome)
+
+
+@pytest.fixture
+def gateway(bot, monkeypatch):
+    monkeypatch.setattr(bot, "LLM_RPM", 60000)
+    monkeypatch.setattr(bot, "llm_backoff", lambda attempt: 0.0)
+    monkeypatch.setattr(bot, "LLM_FALLBACKS", {MODEL: [FALLBACK]})
+
+    def make(script):
+        return bot.LLMGateway(FakeClient(script))
+    return make
+
+
+def test_breaker_transitions(bot, monkeypatch):
+    clock = [100.0]
+    monkeypatch.setattr(bot.time, "monotonic", lambda: clock[0])
+    b = bot.CircuitBreaker(failures=3, cooldown=10)
+    for _ in range(2):
+        b.failure()
+    assert b.state == "closed" and b.allow()
+    b.failure()
+    assert b.state == "open" and not b.allow()
+
+    clock[0] += 10
+    assert b.allow() and b.state == "half_open"  # one probe
+    assert not b.allow()  # the rest wait for it
+    b.failure()
+    assert b.state == "open" and not b.allow()
+
+    clock[0] += 10
+    assert b.allow()
+    b.success()
+    assert b.state == "closed" and b.failures == 0 and b.allow()
+
+
+def test_retries_5xx_then_succeeds(bot, gateway):
+    g = gateway({MODEL: [ApiError(503), ApiError(500), "ok"]})
+    assert g.complete(model=MODEL, messages=[]).text == "ok"
+    assert g.client.calls == [MODEL] * 3
+    s = g.slot(MODEL)
+    assert (s.counts["retries"], s.counts["errors"], s.counts["calls"]) == (2, 2, 1)
+    assert s.breaker.state == "closed" and s.breaker.failures == 0
+
+
+def test_fatal_error_goes_straight_to_fallback(bot, gateway):
+    g = gateway({MODEL: [ApiError(400)], FALLBACK: ["fb"]})
+    resp = g.complete(model=MODEL, messages=[])
+    assert resp.model == FALLBACK and g.client.calls == [MODEL, FALLBACK]
+    assert g.slot(MODEL).breaker.state == "closed"  # a bad request says nothing about the model
+    assert g.slot(FALLBACK).counts["fallbacks"] == 1
+
+
+def test_long_retry_after_skips_to_fallback(bot, gateway):
+    g = gateway({MODEL: [ApiError(429, retry_after=bot.LLM_MAX_RETRY_AFTER + 1)], FALLBACK: ["fb"]})
+    assert g.complete(model=MODEL, messages=[]).model == FALLBACK
+    assert g.client.calls == [MODEL, FALLBACK]
+    assert g.slot(MODEL).hold_until > 0
+
+
+def test_open_breaker_skips_model_and_last_error_raised(bot, gateway, monkeypatch):
+    monkeypatch.setattr(bot, "LLM_MAX_RETRIES", 10)
+    g = gateway({MODEL: [ApiError(502)] * 5 + ["late"], FALLBACK: [ApiError(401)]})
+    with pytest.raises(ApiError) as e:
+        g.complete(model=MODEL, messages=[])
+    assert e.value.status_code == 401
+    # the breaker opened after LLM_BREAKER_FAILURES straight errors instead of using all retries
+    assert g.client.calls == [MODEL] * bot.LLM_BREAKER_FAILURES + [FALLBACK]
+    assert g.slot(MODEL).breaker.state == "open"
+
+    g.client.script[FALLBACK] = ["fb"]
+    assert g.complete(model=MODEL, messages=[]).model == FALLBACK
+    assert g.client.calls[-1] == FALLBACK and g.client.calls.count(MODEL) == bot.LLM_BREAKER_FAILURES
@@ -0,0 +1,84 @@
+import os
+
+import pytest
+
+PLAN = [
+    {"type": "set_payment_phone", "params": {"phone": "+99365"}},
+    {"type": "add_product", "params": {"title": "Ствол", "type": "weapon", "price": 10}},
+    {"type": "add_admin", "params": {"user_id": 42}},
+]
+
+
+def _stores(bot):
+    return (dict(bot.config_view()), list(bot.products_view()), dict(bot.users_view()))
+
+
+@pytest.fixture(params=["json", "sqlite"])
+def plan_bot(request):
+    bot = request.getfixturevalue("bot" if request.param == "json" else "sqlite_bot")
+    bot.ensure_files()
+    return bot
+
+
+def _next_id(bot):
+    with bot.store_lock(bot.PRODUCTS_FILE):
+        return bot.generate_product_id()
+
+
+def test_invalid_action_leaves_every_store_unchanged(plan_bot):
+    bot = plan_bot
+    before = _stores(bot)
+    report = bot.execute_operator_plan(1, PLAN + [{"type": "no_such_action"}])
+    assert not report["committed"] and [r["ok"] for r in report["results"]] == [True, True, True, False]
+    bot._json_cache.clear()
+    assert _stores(bot) == before
+    # the id the rejected plan showed was never taken
+    assert _next_id(bot) == int(report["results"][1]["msg"].rsplit("=", 1)[1])
+
+
+def test_dry_run_writes_nothing_and_takes_no_ids(plan_bot):
+    bot = plan_bot
+    before = _stores(bot)
+    mtimes = {p: os.stat(p).st_mtime_ns for p in (bot.CONFIG_FILE, bot.PRODUCTS_FILE, bot.USERS_FILE)}
+    report = bot.execute_operator_plan(1, PLAN, dry_run=True)
+    assert report["dry_run"] and not report["committed"]
+    assert {p: os.stat(p).st_mtime_ns for p in mtimes} == mtimes
+    bot._json_cache.clear()
+    assert _stores(bot) == before
+    assert _next_id(bot) == int(report["results"][1]["msg"].rsplit("=", 1)[1])
+
+
+def test_plan_commit(plan_bot):
+    bot = plan_bot
+    report = bot.execute_operator_plan(1, PLAN)
+    assert report["committed"]
+    pid = int(report["results"][1]["msg"].rsplit("=", 1)[1])
+    bot._json_cache.clear()
+    assert bot.config_view()["payment_phone"] == "+99365"
+    assert bot.find_product_by_id(pid)["title"] == "Ствол"
+    assert bot.users_view()["42"]["is_admin"]
+    assert _next_id(bot) == pid + 1
+
+
+def test_sqlite_commit_is_one_transaction(sqlite_bot, monkeypatch):
+    bot = sqlite_bot
+    bot.ensure_files()
+    before = _stores(bot)
+    columns = bot.SQL_COLUMNS["users"]
+    # users are written last: config and products are already in the transaction
+    monkeypatch.setitem(bot.SQL_COLUMNS, "users", ("id", "is_admin", "no_such_column"))
+    report = bot.execute_operator_plan(1, PLAN)
+    assert not report["committed"] and report["partial"] == [] and "no_such_column" in report["error"]
+    bot.SQL_COLUMNS["users"] = columns
+    bot._json_cache.clear()
+    assert _stores(bot) == before
+
+
+def test_json_commit_failure_reports_saved_stores(bot, monkeypatch):
+    def failing_save(products):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(bot, "save_products", failing_save)
+    report = bot.execute_operator_plan(1, PLAN)
+    assert not report["committed"] and report["partial"] == ["config"]
+    assert "частично" in bot.render_plan_report(report)
@@ -0,0 +1,69 @@
+import os
+
+
+def _consistent(view, index):
+    for oid, pos in index.by_id.items():
+        assert view[pos]["id"] == oid
+    for status, ids in index.by_status.items():
+        for oid in ids:
+            assert view[index.by_id[oid]]["status"] == status
+
+
+def test_snapshot_survives_append_and_update(bot):
+    for i in range(1, 4):
+        bot.append_order({"id": i, "user_id": 7, "status": "new", "items": []})
+    view, index = bot._order_snapshot()
+
+    bot.append_order({"id": 4, "user_id": 7, "status": "new", "items": []})
+    bot.update_order(2, {"status": "confirmed"})
+
+    # the pair taken before the writes still describes the same orders
+    assert len(view) == 3 and 4 not in index.by_id
+    assert set(index.by_status["new"]) == {1, 2, 3}
+    _consistent(view, index)
+
+    view2, index2 = bot._order_snapshot()
+    _consistent(view2, index2)
+    assert [o["id"] for o in bot.orders_by_status("new")] == [1, 3, 4]
+    assert bot.get_order(2)["status"] == "confirmed"
+    assert [o["id"] for o in bot.orders_of_user(7)] == [1, 2, 3, 4]
+
+
+def test_index_rebuilt_after_reload(bot):
+    bot.append_order({"id": 1, "user_id": 1, "status": "new", "items": []})
+    bot.flush_pending_writes()
+    bot._json_cache.clear()
+    assert bot.get_order(1)["status"] == "new"
+
+
+def test_order_updates_are_journaled(bot, monkeypatch):
+    monkeypatch.setattr(bot, "ORDER_VIEW_CHUNK", 4)
+    for i in range(1, 11):
+        bot.append_order({"id": i, "user_id": i % 3, "status": "pending_payment", "items": []})
+    size = os.path.getsize(bot.ORDERS_FILE)
+    view, index = bot._order_snapshot()
+    bot.update_order(6, {"status": "awaiting_check"})
+    bot.append_order({"id": 11, "user_id": 1, "status": "pending_payment", "items": []})
+
+    # orders.json is not rewritten; the snapshot taken before still holds
+    assert os.path.getsize(bot.ORDERS_FILE) == size
+    assert view[5]["status"] == "pending_payment" and len(view) == 10
+    _consistent(view, index)
+    view2, index2 = bot._order_snapshot()
+    _consistent(view2, index2)
+    assert [o["id"] for o in bot.orders_by_status("awaiting_check")] == [6]
+
+    bot._json_cache.clear()  # restart: orders.json + journal replay
+    assert bot.get_order(6)["status"] == "awaiting_check"
+    assert [o["id"] for o in bot.orders_view()] == list(range(1, 12))
+
+
+def test_order_journal_compacted(bot, monkeypatch):
+    monkeypatch.setattr(bot, "ORDERS_JOURNAL_MAX", 3)
+    for i in range(1, 8):
+        bot.append_order({"id": i, "user_id": 1, "status": "pending_payment", "items": []})
+    with open(bot._journal_path(bot.ORDERS_FILE), encoding="utf-8") as f:
+        assert len(f.readlines()) == 1
+    bot._json_cache.clear()
+    assert [o["id"] for o in bot.orders_view()] == list(range(1, 8))
+    assert [o["id"] for o in bot.orders_of_user(1)] == list(range(1, 8))
@@ -0,0 +1,45 @@
+import threading
+import time
+
+
+def _order_awaiting_check(bot):
+    bot.put_user(1, {**bot.new_user_record("admin"), "is_admin": True})
+    bot.append_order({"id": 1, "user_id": 5, "username": "", "items": [], "total": 10,
+                      "status": "awaiting_check", "payment_photo_file_id": "photo1"})
+
+
+def test_admins_notified_by_deadline_when_model_hangs(bot, fake_api, monkeypatch):
+    _order_awaiting_check(bot)
+    release = threading.Event()
+
+    def slow_verdict(order):
+        release.wait(10)
+        return "Статус: оплата подтверждена"
+
+    monkeypatch.setattr(bot, "PRESCREEN_DEADLINE", 0.3)
+    monkeypatch.setattr(bot, "_prescreen_verdict", slow_verdict)
+    t0 = time.monotonic()
+    bot.prescreen_order(1)
+    assert time.monotonic() - t0 < 2
+
+    sent = [r for r in fake_api.sent if r["method"] == "sendPhoto"]
+    assert len(sent) == 1 and "Предпроверка" not in sent[0]["params"]["caption"]
+    assert bot.get_order(1)["admins_notified_ts"]
+    assert not bot.get_order(1).get("ai_verdict_last")
+
+    # the verdict that arrives later is kept on the order
+    release.set()
+    for _ in range(100):
+        if bot.get_order(1).get("ai_verdict_last"):
+            break
+        time.sleep(0.02)
+    assert bot.get_order(1)["ai_verdict_last"] == "Статус: оплата подтверждена"
+
+
+def test_verdict_in_time_goes_into_notification(bot, fake_api, monkeypatch):
+    _order_awaiting_check(bot)
+    monkeypatch.setattr(bot, "_prescreen_verdict", lambda order: "Статус: оплата подтверждена")
+    bot.prescreen_order(1)
+    sent = [r for r in fake_api.sent if r["method"] == "sendPhoto"]
+    assert "Предпроверка" in sent[0]["params"]["caption"]
+    assert bot.get_order(1)["ai_verdict_last"] == "Статус: оплата подтверждена"
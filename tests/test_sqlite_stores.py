@@ -0,0 +1,43 @@
+import json
+import sqlite3
+
+
+def _other_process_sets(bot, table, key, value):
+    # what another --cluster process does: its own connection, one row, a version bump
+    conn = sqlite3.connect(bot.SQLITE_FILE, isolation_level=None)
+    conn.execute(f"INSERT OR REPLACE INTO {table}(id, data) VALUES (?, ?)", (str(key), json.dumps(value)))
+    conn.execute("UPDATE meta SET value = value + 1 WHERE key = ?", ("ver:" + table,))
+    conn.close()
+
+
+def test_first_start_takes_over_json_files(sqlite_bot):
+    bot = sqlite_bot
+    with open(bot.CONFIG_FILE, "w", encoding="utf-8") as f:
+        json.dump({**bot.DEFAULT_CONFIG, "payment_phone": "+99361"}, f)
+    with open(bot.BROADCASTS_FILE, "w", encoding="utf-8") as f:
+        json.dump({"1": {"id": 1, "status": "done"}}, f)
+    bot.ensure_files()
+    assert bot.sql_load("config")["payment_phone"] == "+99361"
+    assert bot.get_broadcasts() == {"1": {"id": 1, "status": "done"}}
+
+
+def test_config_writes_from_other_processes_are_kept(sqlite_bot):
+    bot = sqlite_bot
+    bot.ensure_files()
+    assert bot.config_view()["payment_phone"] == "TMT_PHONE"
+    _other_process_sets(bot, "config", "payment_phone", "+99362")
+    bot.update_config({"order_manager_username": "manager"})
+    cfg = bot.sql_load("config")
+    assert cfg["payment_phone"] == "+99362" and cfg["order_manager_username"] == "manager"
+    assert bot.config_view()["payment_phone"] == "+99362"
+
+
+def test_cancel_from_other_process_is_seen(sqlite_bot, monkeypatch):
+    bot = sqlite_bot
+    bot.ensure_files()
+    monkeypatch.setattr(bot, "_spawn_broadcast", lambda job_id: None)
+    job = bot.start_broadcast(1, 1, "привет")
+    assert not bot.broadcast_cancel_requested(job["id"])
+    _other_process_sets(bot, "broadcasts", job["id"], {**job, "cancel_requested": True})
+    assert bot.broadcast_cancel_requested(job["id"])
+    assert bot.start_broadcast(1, 1, "ещё")["id"] == job["id"] + 1
@@ -0,0 +1,121 @@
+import json
+import os
+
+import pytest
+
+
+def test_load_json_hands_out_private_copies(bot):
+    bot.save_json(bot.PRODUCTS_FILE, [{"id": 1, "title": "A", "tags": ["x"]}])
+    first = bot.get_products()
+    first[0]["tags"].append("y")
+    first[0]["title"] = "B"
+    assert bot.get_products() == [{"id": 1, "title": "A", "tags": ["x"]}]
+    assert bot.products_view()[0]["title"] == "A"
+
+
+def test_put_users_appends_to_journal(bot):
+    bot.put_user(1, bot.new_user_record("a"))
+    size = os.path.getsize(bot.USERS_FILE)
+    view = bot.users_view()
+    for i in range(5):
+        bot.put_user(1, {**bot.new_user_record("a"), "cart": [i]})
+    # the users file is not rewritten and readers keep the same view
+    assert os.path.getsize(bot.USERS_FILE) == size
+    assert bot.users_view() is view and view["1"]["cart"] == [4]
+    with open(bot._journal_path(bot.USERS_FILE), encoding="utf-8") as f:
+        assert len(f.readlines()) == 6
+
+    bot._json_cache.clear()  # restart: users.json + journal replay
+    assert bot.users_view()["1"]["cart"] == [4]
+
+
+def test_new_user_gets_new_view(bot):
+    bot.put_user(1, bot.new_user_record("a"))
+    view = bot.users_view()
+    bot.put_user(2, bot.new_user_record("b"))
+    assert "2" not in view and "2" in bot.users_view()
+
+
+def test_journal_compacted(bot, monkeypatch):
+    monkeypatch.setattr(bot, "USERS_JOURNAL_MAX", 3)
+    for i in range(7):
+        bot.put_user(i, bot.new_user_record(str(i)))
+    with open(bot._journal_path(bot.USERS_FILE), encoding="utf-8") as f:
+        assert len(f.readlines()) == 1
+    bot._json_cache.clear()
+    assert sorted(bot.users_view()) == [str(i) for i in range(7)]
+
+
+def test_torn_journal_line_dropped(bot):
+    bot.put_user(1, bot.new_user_record("a"))
+    with open(bot._journal_path(bot.USERS_FILE), "a", encoding="utf-8") as f:
+        f.write('{"2": {"usern')
+    bot._json_cache.clear()
+    assert list(bot.users_view()) == ["1"]
+    bot.put_user(3, bot.new_user_record("c"))
+    bot._json_cache.clear()
+    assert sorted(bot.users_view()) == ["1", "3"]
+
+
+def _on_disk(path):
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def test_saves_are_synchronous_by_default(bot):
+    assert bot.JSON_WRITE_DELAY == 0
+    bot.save_json(bot.PRODUCTS_FILE, [{"id": 1}])
+    assert _on_disk(bot.PRODUCTS_FILE) == [{"id": 1}]
+
+
+def test_write_behind_keeps_orders_synchronous(bot, monkeypatch):
+    monkeypatch.setattr(bot, "JSON_WRITE_DELAY", 0.05)
+    bot.append_order({"id": 1, "user_id": 1, "status": "awaiting_payment", "items": []})
+    with open(bot._journal_path(bot.ORDERS_FILE), encoding="utf-8") as f:
+        assert json.loads(f.readline())[0]["id"] == 1
+    bot.save_json(bot.PRODUCTS_FILE, [{"id": 2}])
+    assert bot.flush_pending_writes(5)
+    assert _on_disk(bot.PRODUCTS_FILE) == [{"id": 2}]
+
+
+def test_writer_failure_goes_to_log_error(bot, monkeypatch):
+    monkeypatch.setattr(bot, "JSON_WRITE_DELAY", 0.01)
+    errors = []
+    monkeypatch.setattr(bot, "log_error", lambda where, e, **kw: errors.append((where, kw.get("extra"))))
+    real_write = bot.atomic_write_text
+    failures = iter([OSError("disk full")])
+
+    def flaky(path, text):
+        err = next(failures, None)
+        if err:
+            raise err
+        real_write(path, text)
+
+    monkeypatch.setattr(bot, "atomic_write_text", flaky)
+    bot.save_json(bot.PRODUCTS_FILE, [{"id": 3}])
+    assert bot.flush_pending_writes(5)
+    assert errors == [("json_writer", {"path": bot.PRODUCTS_FILE})]
+    assert _on_disk(bot.PRODUCTS_FILE) == [{"id": 3}]
+
+
+def test_unreadable_store_without_snapshot_refuses_writes(bot):
+    for i in range(3):
+        bot.put_user(i, bot.new_user_record(str(i)))
+    bot.flush_pending_writes()
+    with open(bot.USERS_FILE, "w", encoding="utf-8") as f:
+        f.write('{"0": {"username": "0"')  # damaged by hand, no snapshot to restore
+    os.remove(bot._journal_path(bot.USERS_FILE))
+    bot._json_cache.clear()
+
+    assert bot.users_view() == {}  # reads degrade to the default...
+    with pytest.raises(bot.StoreUnreadable):  # ...but nothing is written over the file
+        bot.put_user(7, bot.new_user_record("7"))
+    with pytest.raises(bot.StoreUnreadable):
+        bot.save_users(bot.get_users())
+    with open(bot.USERS_FILE, encoding="utf-8") as f:
+        assert f.read() == '{"0": {"username": "0"'
+
+    with open(bot.USERS_FILE, "w", encoding="utf-8") as f:
+        f.write('{"0": {"username": "0"}}')  # repaired
+    bot.put_user(7, bot.new_user_record("7"))
+    assert sorted(bot.users_view()) == ["0", "7"]
@@ -0,0 +1,73 @@
+import socket
+import types
+
+import pytest
+import requests
+
+
+@pytest.fixture
+def sender(bot, fake_api, monkeypatch):
+    sleeps, timeouts = [], []
+    bucket = bot.TokenBucket(1000)
+    monkeypatch.setattr(bot, "broadcast_bucket", bucket)
+    monkeypatch.setattr(bot, "tg_api_counts", {})
+    monkeypatch.setattr(bot, "tg_api_latency", {})
+
+    def sleep(seconds):
+        sleeps.append(seconds)
+        fake_api.rate_limit = 0  # Telegram lets us through after the wait
+
+    request = bot.tg_session.request
+
+    def spy(method, url, **kw):
+        timeouts.append(kw.get("timeout"))
+        return request(method, url, **kw)
+
+    monkeypatch.setattr(bot.time, "sleep", sleep)
+    monkeypatch.setattr(bot.tg_session, "request", spy)
+
+    def send(api_method="sendMessage", files=None, base=None):
+        url = f"{base or bot.TELEGRAM_API_URL}/bot{bot.TOKEN}/{api_method}"
+        return bot.tg_request_sender("post", url, params={"chat_id": 1, "text": "hi"}, files=files, timeout=99)
+
+    return types.SimpleNamespace(send=send, sleeps=sleeps, timeouts=timeouts, bucket=bucket)
+
+
+def test_429_waits_retry_after_and_pauses_broadcasts(bot, fake_api, sender):
+    fake_api.rate_limit, fake_api.retry_after = 1.0, 2
+    resp = sender.send()
+    assert resp.status_code == 200 and resp.json()["result"]["text"] == "hi"
+    assert sender.sleeps == [2.0]
+    assert sender.bucket.reserve() > 1  # the whole bot is held back, broadcasts included
+    assert bot.tg_api_counts["sendMessage"] == {"calls": 1, "retries": 1, "errors": 0}
+    assert sender.timeouts == [(bot.TG_CONNECT_TIMEOUT, bot.TG_READ_TIMEOUT)] * 2
+
+
+def test_long_retry_after_is_left_to_the_caller(bot, fake_api, sender):
+    fake_api.rate_limit, fake_api.retry_after = 1.0, bot.TG_MAX_RETRY_AFTER + 5
+    assert sender.send().status_code == 429
+    assert sender.sleeps == [] and fake_api.calls["sendMessage"] == 1
+    assert bot.tg_api_counts["sendMessage"]["errors"] == 1
+
+
+def test_uploads_are_not_resent(bot, fake_api, sender):
+    fake_api.rate_limit = 1.0
+    resp = sender.send("sendPhoto", files={"photo": ("p.png", b"x")})
+    assert resp.status_code == 429 and fake_api.calls["sendPhoto"] == 1
+    assert sender.timeouts == [(bot.TG_CONNECT_TIMEOUT, bot.TG_METHOD_TIMEOUTS["sendPhoto"])]
+
+
+def test_connection_errors_back_off_then_raise(bot, sender):
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]  # nothing listens here once the socket is closed
+    with pytest.raises(requests.ConnectionError):
+        sender.send(base=f"http://127.0.0.1:{port}")
+    assert sender.sleeps == [0.5 * 2 ** i for i in range(bot.TG_MAX_RETRIES)]
+    assert bot.tg_api_counts["sendMessage"]["errors"] == bot.TG_MAX_RETRIES + 1
+
+
+def test_long_polling_keeps_its_timeout(bot, fake_api, sender):
+    url = f"{bot.TELEGRAM_API_URL}/bot{bot.TOKEN}/getUpdates"
+    bot.tg_request_sender("get", url, params={"timeout": 0}, timeout=(5, 30))
+    assert sender.timeouts == [(5, 30)]
@@ -0,0 +1,59 @@
+import html
+import types as pytypes
+
+VERDICT = "```bash\nСтатус: реальное\nУверенность: высокая\n```"
+
+
+def _chunks(*parts):
+    for p in parts:
+        yield pytypes.SimpleNamespace(choices=[pytypes.SimpleNamespace(delta=pytypes.SimpleNamespace(content=p))])
+
+
+def _order(photo):
+    return {"id": 3, "total": 10, "payment_photo_file_id": photo, "payment_photo_unique_id": photo}
+
+
+def _fake_llm(monkeypatch, bot, stream_parts, full=VERDICT):
+    calls = []
+
+    def complete(**kw):
+        calls.append("stream" if kw.get("stream") else "sync")
+        if kw.get("stream"):
+            return _chunks(*stream_parts)
+        return pytypes.SimpleNamespace(choices=[pytypes.SimpleNamespace(message=pytypes.SimpleNamespace(content=full))])
+
+    monkeypatch.setattr(bot.llm, "complete", complete)
+    return calls
+
+
+def test_complete_stream_is_cached(bot, fake_api, monkeypatch):
+    calls = _fake_llm(monkeypatch, bot, ["```bash\nСтатус: ", "реальное\nУверенность: высокая\n```"])
+    order = _order("vision-complete")
+    assert bot.payment_verdict_streamed(order, "http://x/p.jpg", 1) == VERDICT
+    assert calls == ["stream"]
+    assert bot.cached_payment_verdict(order, True) == VERDICT
+
+
+def test_truncated_stream_falls_back_to_sync_call(bot, fake_api, monkeypatch):
+    calls = _fake_llm(monkeypatch, bot, ["```bash\nСтатус: реаль"])
+    order = _order("vision-truncated")
+    assert bot.payment_verdict_streamed(order, "http://x/p.jpg", 1) == VERDICT
+    assert calls == ["stream", "sync"]
+    assert bot.cached_payment_verdict(order, True) == VERDICT
+
+
+def test_empty_stream_not_cached_when_fallback_fails(bot, fake_api, monkeypatch):
+    calls = _fake_llm(monkeypatch, bot, [], full="")
+    monkeypatch.setattr(bot, "ai_check_payment_image", lambda *a, **kw: bot.VISION_FALLBACK_VERDICT)
+    order = _order("vision-empty")
+    assert bot.payment_verdict_streamed(order, "http://x/p.jpg", 1) == bot.VISION_FALLBACK_VERDICT
+    assert calls == ["stream"]
+    assert bot.cached_payment_verdict(order, True) is None
+
+
+def test_final_edit_fits_message_limit(bot, fake_api, monkeypatch):
+    long_verdict = "```bash\n" + "Комментарий: <длинный> & текст\n" * 400 + "```"
+    _fake_llm(monkeypatch, bot, [long_verdict])
+    bot.payment_verdict_streamed(_order("vision-long"), "http://x/p.jpg", 1)
+    final = [r for r in fake_api.sent if r["method"] == "editMessageText"][-1]["params"]["text"]
+    assert len(html.unescape(final)) <= 4096
@@ -0,0 +1,74 @@
+import io
+import json
+from wsgiref.util import setup_testing_defaults
+
+import pytest
+
+UPDATE = {"update_id": 5, "message": {"message_id": 1, "date": 0, "chat": {"id": 42, "type": "private"},
+                                      "from": {"id": 42, "is_bot": False, "first_name": "a"}, "text": "/start"}}
+
+
+class FakeDispatcher:
+    def __init__(self, accept=True):
+        self.accept = accept
+        self.submitted = []
+
+    def submit(self, key, item, timeout=None):
+        if self.accept:
+            self.submitted.append((key, item.update_id))
+        return self.accept
+
+    def stats(self):
+        return {"queue_depth": len(self.submitted)}
+
+
+@pytest.fixture
+def webhook(bot, monkeypatch):
+    monkeypatch.setattr(bot, "WEBHOOK_SECRET", "s3cret")
+    monkeypatch.setattr(bot, "dispatcher", FakeDispatcher())
+
+    def call(method="POST", path=None, token="s3cret", body=json.dumps(UPDATE)):
+        data = body.encode("utf-8")
+        environ = {"REQUEST_METHOD": method, "PATH_INFO": path or bot.WEBHOOK_PATH,
+                   "CONTENT_LENGTH": str(len(data)), "wsgi.input": io.BytesIO(data)}
+        if token is not None:
+            environ["HTTP_X_TELEGRAM_BOT_API_SECRET_TOKEN"] = token
+        setup_testing_defaults(environ)
+        status = []
+        out = b"".join(bot.webhook_app(environ, lambda s, h: status.append((s, dict(h)))))
+        return status[0][0], status[0][1], out.decode("utf-8")
+
+    return call
+
+
+def test_valid_update_is_queued(bot, webhook):
+    status, _, body = webhook()
+    assert (status, body) == ("200 OK", "ok")
+    assert bot.dispatcher.submitted == [(42, 5)]
+
+
+@pytest.mark.parametrize("token", [None, "", "wrong", "s3cret2"])
+def test_bad_secret_token_rejected(bot, webhook, token):
+    assert webhook(token=token)[0] == "403 Forbidden"
+    assert bot.dispatcher.submitted == []
+
+
+def test_other_requests_rejected(bot, webhook):
+    assert webhook(path="/other")[0] == "404 Not Found"
+    status, headers, _ = webhook(method="GET")
+    assert status == "405 Method Not Allowed" and headers["Allow"] == "POST"
+    assert webhook(body="")[0] == "400 Bad Request"
+    assert webhook(body="{not json")[0] == "400 Bad Request"
+    assert webhook(body="x" * (bot.WEBHOOK_MAX_BODY + 1))[0] == "413 Payload Too Large"
+    assert bot.dispatcher.submitted == []
+
+
+def test_full_backlog_asks_telegram_to_retry(bot, webhook):
+    bot.dispatcher.accept = False
+    status, headers, _ = webhook()
+    assert status == "503 Service Unavailable" and headers["Retry-After"] == "5"
+
+
+def test_healthz_needs_no_token(bot, webhook):
+    status, _, body = webhook(method="GET", path="/healthz", token=None)
+    assert status == "200 OK" and json.loads(body) == {"queue_depth": 0}